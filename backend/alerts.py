@@ -0,0 +1,30 @@
+import logging
+import os
+import threading
+
+import requests
+
+# Operational alerts for the admin: always logged, and sent to ADMIN_TELEGRAM_ID through
+# the admin bot's token at most once per ALERT_COOLDOWN per alert key across all workers.
+
+TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
+ADMIN_TELEGRAM_ID = os.getenv("ADMIN_TELEGRAM_ID")
+ALERT_COOLDOWN = int(os.getenv("ALERT_COOLDOWN", 900))
+
+def _send(text):
+    try:
+        requests.post(f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage",
+                      json={"chat_id": ADMIN_TELEGRAM_ID, "text": text}, timeout=10)
+    except Exception as e:
+        logging.warning(f"Admin alert could not be sent: {e}")
+
+def send_admin_alert(conn, alert_key, text):
+    logging.error(text)
+    if not TELEGRAM_BOT_TOKEN or not ADMIN_TELEGRAM_ID:
+        return
+    try:
+        if not conn.set(f"alert:{alert_key}", 1, nx=True, ex=ALERT_COOLDOWN):
+            return
+    except Exception:
+        pass  # Redis being down is itself worth hearing about
+    threading.Thread(target=_send, args=(text,), daemon=True).start()
@@ -0,0 +1,407 @@
+import asyncio
+import json
+import logging
+import os
+import time
+import uuid
+
+from rq import Queue
+from rq.exceptions import NoSuchJobError
+from rq.job import Job, JobStatus
+
+from backend.coordination import release_lock
+from supabase_client import owner_scope
+
+# OpenAI-compatible Batch API. Uploaded JSONL files and batch output live under BATCH_DIR
+# (shared by the API and the RQ workers on this host); batch state, counters and a bitmap
+# of finished lines live in Redis. One runner job per batch keeps BATCH_CONCURRENCY
+# requests in flight, each admitted by the shared rate limiter, so throughput is bounded
+# by total key quota rather than by client round trips. Batch calls may only use
+# BATCH_QUOTA_SHARE of each limit, which leaves headroom for interactive traffic. A runner
+# holds a lease while it works; if it dies, the recovery loop in the API workers
+# re-enqueues the batch, and the new runner skips lines that are already done.
+
+BATCH_DIR = os.getenv("BATCH_DIR", "batch_data")
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", 64))  # in-flight requests per running batch
+BATCH_QUOTA_SHARE = float(os.getenv("BATCH_QUOTA_SHARE", 0.8))  # fraction of each rate limit batches may use
+BATCH_MAX_REQUESTS = int(os.getenv("BATCH_MAX_REQUESTS", 50000))
+BATCH_MAX_FILE_BYTES = int(os.getenv("BATCH_MAX_FILE_BYTES", 200 * 1024 * 1024))
+BATCH_RECOVERY_INTERVAL = int(os.getenv("BATCH_RECOVERY_INTERVAL", 30))
+BATCH_LEASE_TTL = 30  # seconds; the runner refreshes it every BATCH_LEASE_TTL / 3
+BATCH_COMPLETION_WINDOWS = {"24h": 24 * 3600}
+BATCH_ENDPOINT = "/v1/chat/completions"
+BATCH_QUEUE = "gemini_batches"
+BATCH_RUNNER_FUNCTION = "backend.main.run_batch"
+ACTIVE_BATCHES_KEY = "batches:active"
+
+FINAL_STATUSES = ("completed", "failed", "expired", "cancelled")
+_TIMESTAMP_FIELDS = ("created_at", "in_progress_at", "expires_at", "finalizing_at", "completed_at",
+                     "failed_at", "expired_at", "cancelling_at", "cancelled_at")
+
+_recovery = None
+
+def file_key(file_id):
+    return f"batch:file:{file_id}"
+
+def batch_key(batch_id):
+    return f"batch:{batch_id}"
+
+def done_key(batch_id):
+    return f"batch:{batch_id}:done"
+
+def lease_key(batch_id):
+    return f"batch:{batch_id}:lease"
+
+def owner_batches_key(owner):
+    return f"batches:owner:{owner}"
+
+def file_path(file_id):
+    return os.path.join(BATCH_DIR, f"{file_id}.jsonl")
+
+def _decode(raw):
+    return {k.decode(): v.decode() for k, v in raw.items()}
+
+# --- Files ---
+
+def register_file(conn, owner, filename, purpose, size=0):
+    file_id = f"file-{uuid.uuid4().hex[:24]}"
+    meta = {"id": file_id, "filename": filename, "purpose": purpose, "bytes": size,
+            "created_at": int(time.time()), "owner": owner}
+    conn.hset(file_key(file_id), mapping=meta)
+    return {k: str(v) for k, v in meta.items()}
+
+async def save_upload(conn, user_api_key, upload, purpose):
+    # Streams the upload to disk. Returns (file_meta, None) or (None, error_message).
+    os.makedirs(BATCH_DIR, exist_ok=True)
+    tmp_path = os.path.join(BATCH_DIR, f".upload-{uuid.uuid4().hex}")
+    size = 0
+    try:
+        with open(tmp_path, "wb") as f:
+            while True:
+                chunk = await upload.read(1024 * 1024)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > BATCH_MAX_FILE_BYTES:
+                    return None, f"File is larger than {BATCH_MAX_FILE_BYTES} bytes"
+                f.write(chunk)
+        meta = register_file(conn, owner_scope(user_api_key), upload.filename or "upload.jsonl", purpose, size)
+        os.replace(tmp_path, file_path(meta["id"]))
+        return meta, None
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def get_file(conn, file_id, user_api_key):
+    raw = conn.hgetall(file_key(file_id))
+    if not raw:
+        return None
+    meta = _decode(raw)
+    if meta.get("owner") != owner_scope(user_api_key):
+        return None
+    return meta
+
+def file_view(meta):
+    size = os.path.getsize(file_path(meta["id"])) if os.path.exists(file_path(meta["id"])) else int(meta["bytes"])
+    return {
+        "id": meta["id"],
+        "object": "file",
+        "bytes": size,
+        "created_at": int(meta["created_at"]),
+        "filename": meta["filename"],
+        "purpose": meta["purpose"]
+    }
+
+# --- Batches ---
+
+def create_batch(conn, user, input_file_id, completion_window, metadata=None):
+    # user: {"id": user_api_keys.id, "scope": owner_scope of the key}; the key itself is not stored.
+    owner = user["scope"]
+    batch_id = f"batch_{uuid.uuid4().hex[:24]}"
+    now = int(time.time())
+    output = register_file(conn, owner, f"{batch_id}_output.jsonl", "batch_output")
+    errors = register_file(conn, owner, f"{batch_id}_errors.jsonl", "batch_output")
+    # Output files exist from the start, so results can be read while the batch runs.
+    os.makedirs(BATCH_DIR, exist_ok=True)
+    for file_id in (output["id"], errors["id"]):
+        open(file_path(file_id), "a").close()
+    batch = {
+        "id": batch_id,
+        "status": "validating",
+        "endpoint": BATCH_ENDPOINT,
+        "input_file_id": input_file_id,
+        "output_file_id": output["id"],
+        "error_file_id": errors["id"],
+        "completion_window": completion_window,
+        "created_at": now,
+        "expires_at": now + BATCH_COMPLETION_WINDOWS[completion_window],
+        "metadata": json.dumps(metadata or {}),
+        "owner": owner,
+        "user_api_key_id": user["id"] or "",
+        "total": 0,
+        "completed": 0,
+        "failed": 0,
+        "resumes": 0
+    }
+    pipe = conn.pipeline()
+    pipe.hset(batch_key(batch_id), mapping=batch)
+    pipe.zadd(owner_batches_key(owner), {batch_id: now})
+    pipe.sadd(ACTIVE_BATCHES_KEY, batch_id)
+    pipe.execute()
+    enqueue_runner(conn, batch_id)
+    return load_batch(conn, batch_id)
+
+def enqueue_runner(conn, batch_id):
+    job = Queue(BATCH_QUEUE, connection=conn).enqueue(BATCH_RUNNER_FUNCTION, batch_id, job_timeout=-1, result_ttl=3600)
+    conn.hset(batch_key(batch_id), "runner_job_id", job.id)
+
+def load_batch(conn, batch_id):
+    raw = conn.hgetall(batch_key(batch_id))
+    return _decode(raw) if raw else None
+
+def get_batch(conn, batch_id, user_api_key):
+    batch = load_batch(conn, batch_id)
+    if batch is None or batch.get("owner") != owner_scope(user_api_key):
+        return None
+    return batch
+
+def list_batches(conn, user_api_key, limit=20, after=None):
+    ids = [i.decode() for i in conn.zrevrange(owner_batches_key(owner_scope(user_api_key)), 0, -1)]
+    if after in ids:
+        ids = ids[ids.index(after) + 1:]
+    page = [b for b in (load_batch(conn, i) for i in ids[:limit + 1]) if b is not None]
+    return page[:limit], len(page) > limit
+
+def batch_view(batch):
+    view = {
+        "id": batch["id"],
+        "object": "batch",
+        "endpoint": batch["endpoint"],
+        "errors": json.loads(batch["errors"]) if batch.get("errors") else None,
+        "input_file_id": batch["input_file_id"],
+        "completion_window": batch["completion_window"],
+        "status": batch["status"],
+        "output_file_id": batch["output_file_id"],
+        "error_file_id": batch["error_file_id"],
+        "request_counts": {
+            "total": int(batch["total"]),
+            "completed": int(batch["completed"]),
+            "failed": int(batch["failed"])
+        },
+        "metadata": json.loads(batch["metadata"])
+    }
+    for field in _TIMESTAMP_FIELDS:
+        view[field] = int(batch[field]) if batch.get(field) else None
+    return view
+
+def set_status(conn, batch_id, status, **fields):
+    fields = {"status": status, f"{status}_at": int(time.time()), **fields}
+    pipe = conn.pipeline()
+    pipe.hset(batch_key(batch_id), mapping=fields)
+    if status in FINAL_STATUSES:
+        pipe.srem(ACTIVE_BATCHES_KEY, batch_id)
+    pipe.execute()
+
+def cancel_batch(conn, batch):
+    # The runner notices "cancelling" within a second and finalizes the batch.
+    if batch["status"] in FINAL_STATUSES or batch["status"] == "cancelling":
+        return
+    set_status(conn, batch["id"], "cancelling")
+
+# --- Runner (inside an RQ worker) ---
+
+def read_batch_input(batch_id, input_file_id):
+    # Returns (lines, None) or (None, [error, ...]) in the Batch API's errors shape.
+    lines = []
+    errors = []
+    seen = set()
+    try:
+        with open(file_path(input_file_id), encoding="utf-8") as f:
+            for number, raw in enumerate(f, 1):
+                if not raw.strip():
+                    continue
+                try:
+                    line = json.loads(raw)
+                    custom_id = line["custom_id"]
+                    if line.get("method", "POST") != "POST" or line.get("url") != BATCH_ENDPOINT:
+                        raise ValueError(f"only POST {BATCH_ENDPOINT} is supported")
+                    if not isinstance(line["body"].get("messages"), list):
+                        raise ValueError("body.messages must be a list")
+                    if line["body"].get("stream"):
+                        raise ValueError("streaming is not supported in batches")
+                    if custom_id in seen:
+                        raise ValueError(f"duplicate custom_id {custom_id}")
+                except (ValueError, KeyError, TypeError, AttributeError) as e:
+                    errors.append({"code": "invalid_request", "message": str(e), "param": None, "line": number})
+                    if len(errors) >= 100:
+                        break
+                    continue
+                seen.add(custom_id)
+                lines.append(line)
+    except (OSError, UnicodeDecodeError) as e:
+        # Not going to get better on a retry; the batch fails instead of being resumed forever.
+        logging.error(f"Batch {batch_id} input file {input_file_id} could not be read: {e}")
+        message = "The input file is missing" if isinstance(e, FileNotFoundError) else "The input file could not be read"
+        return None, [{"code": "invalid_file", "message": message, "param": None, "line": None}]
+    if not errors and len(lines) > BATCH_MAX_REQUESTS:
+        errors.append({"code": "too_many_requests", "message": f"A batch may have at most {BATCH_MAX_REQUESTS} requests",
+                       "param": None, "line": None})
+    if not errors and not lines:
+        errors.append({"code": "empty_file", "message": "The input file has no requests", "param": None, "line": None})
+    return (None, errors) if errors else (lines, None)
+
+def _is_done(bitmap, index):
+    byte = index >> 3
+    return byte < len(bitmap) and bitmap[byte] & (0x80 >> (index & 7))
+
+async def _keep_lease(conn, batch_id, runner_id):
+    while True:
+        await asyncio.sleep(BATCH_LEASE_TTL / 3)
+        conn.set(lease_key(batch_id), runner_id, ex=BATCH_LEASE_TTL)
+
+async def process_batch(conn, batch_id, complete):
+    # complete(body, user, deadline) -> {"status": http_status, "body": ...}
+    runner_id = uuid.uuid4().hex
+    if not conn.set(lease_key(batch_id), runner_id, nx=True, ex=BATCH_LEASE_TTL):
+        return "already running"
+    lease = asyncio.create_task(_keep_lease(conn, batch_id, runner_id))
+    try:
+        batch = load_batch(conn, batch_id)
+        if batch is None or batch["status"] in FINAL_STATUSES:
+            return "nothing to do"
+        if batch["status"] == "cancelling":
+            set_status(conn, batch_id, "cancelled")
+            return "cancelled"
+
+        lines, errors = await asyncio.to_thread(read_batch_input, batch_id, batch["input_file_id"])
+        if errors:
+            set_status(conn, batch_id, "failed", errors=json.dumps({"object": "list", "data": errors}))
+            return "failed"
+        if batch["status"] == "validating":
+            set_status(conn, batch_id, "in_progress", total=len(lines))
+        else:
+            conn.hincrby(batch_key(batch_id), "resumes", 1)
+
+        bitmap = conn.get(done_key(batch_id)) or b""
+        pending = asyncio.Queue()
+        for index in range(len(lines)):
+            if not _is_done(bitmap, index):
+                pending.put_nowait(index)
+        deadline = int(batch["expires_at"])
+        user = {"id": batch.get("user_api_key_id") or None, "scope": batch["owner"]}
+
+        with open(file_path(batch["output_file_id"]), "a", encoding="utf-8") as output, \
+                open(file_path(batch["error_file_id"]), "a", encoding="utf-8") as error_output:
+
+            async def run_lines():
+                while not pending.empty():
+                    index = pending.get_nowait()
+                    line = lines[index]
+                    try:
+                        result = await complete(line["body"], user, deadline)
+                    except Exception as e:
+                        result = {"status": 500, "body": {"error": {"message": str(e), "type": "server_error",
+                                                                    "param": None, "code": "server_error"}}}
+                    ok = result["status"] == 200
+                    record = {
+                        "id": f"batch_req_{uuid.uuid4().hex[:24]}",
+                        "custom_id": line["custom_id"],
+                        "response": {"status_code": result["status"], "request_id": uuid.uuid4().hex,
+                                     "body": result["body"]} if ok else None,
+                        "error": None if ok else result["body"].get("error")
+                    }
+                    target = output if ok else error_output
+                    target.write(json.dumps(record) + "\n")
+                    target.flush()
+                    # Written before it is marked done: a crash in between repeats the line, never loses it.
+                    pipe = conn.pipeline()
+                    pipe.setbit(done_key(batch_id), index, 1)
+                    pipe.hincrby(batch_key(batch_id), "completed" if ok else "failed", 1)
+                    pipe.execute()
+
+            runners = [asyncio.create_task(run_lines()) for _ in range(min(BATCH_CONCURRENCY, pending.qsize()))]
+            cancelled = False
+            try:
+                while any(not r.done() for r in runners):
+                    await asyncio.wait(runners, timeout=1)
+                    if conn.hget(batch_key(batch_id), "status") == b"cancelling":
+                        cancelled = True
+                        break
+            finally:
+                # Also on cancellation of the runner itself: nothing may write after the files close.
+                for r in runners:
+                    r.cancel()
+                await asyncio.gather(*runners, return_exceptions=True)
+            for r in runners:
+                if not r.cancelled() and r.exception() is not None:
+                    raise r.exception()
+
+        if cancelled:
+            set_status(conn, batch_id, "cancelled")
+            return "cancelled"
+        set_status(conn, batch_id, "finalizing")
+        if int(conn.hget(batch_key(batch_id), "resumes") or 0):
+            await asyncio.to_thread(_drop_repeated_lines, batch)
+        set_status(conn, batch_id, "expired" if time.time() > deadline else "completed")
+        return "done"
+    finally:
+        lease.cancel()
+        release_lock(conn, lease_key(batch_id), runner_id)
+
+def _drop_repeated_lines(batch):
+    # After a resume, a line finished right before the crash may appear twice.
+    for file_id in (batch["output_file_id"], batch["error_file_id"]):
+        path = file_path(file_id)
+        seen = set()
+        kept = []
+        with open(path, encoding="utf-8") as f:
+            for raw in f:
+                custom_id = json.loads(raw)["custom_id"]
+                if custom_id not in seen:
+                    seen.add(custom_id)
+                    kept.append(raw)
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            f.writelines(kept)
+        os.replace(path + ".tmp", path)
+
+# --- Recovery (in the API workers) ---
+
+def resume_stalled_batches(conn):
+    # Re-enqueues active batches whose runner is gone: no lease, and no runner job waiting.
+    resumed = []
+    for raw_id in conn.smembers(ACTIVE_BATCHES_KEY):
+        batch_id = raw_id.decode()
+        if conn.exists(lease_key(batch_id)):
+            continue
+        runner_job_id = conn.hget(batch_key(batch_id), "runner_job_id")
+        if runner_job_id is not None:
+            try:
+                status = Job.fetch(runner_job_id.decode(), connection=conn).get_status()
+            except NoSuchJobError:
+                status = None
+            if status in (JobStatus.QUEUED, JobStatus.DEFERRED, JobStatus.SCHEDULED):
+                continue
+        # A runner that is alive after all fails to take the lease and exits, so a spare is harmless.
+        # Several API workers run this loop; only one may re-enqueue.
+        if not conn.set(f"batch:{batch_id}:requeue", 1, nx=True, ex=BATCH_RECOVERY_INTERVAL):
+            continue
+        logging.warning(f"Resuming stalled batch {batch_id}")
+        enqueue_runner(conn, batch_id)
+        resumed.append(batch_id)
+    return resumed
+
+async def _recovery_loop(conn):
+    while True:
+        await asyncio.sleep(BATCH_RECOVERY_INTERVAL)
+        try:
+            resume_stalled_batches(conn)
+        except Exception as e:
+            logging.warning(f"Batch recovery check failed: {e}")
+
+def start_batch_recovery(conn):
+    global _recovery
+    _recovery = asyncio.create_task(_recovery_loop(conn))
+
+def stop_batch_recovery():
+    if _recovery is not None:
+        _recovery.cancel()
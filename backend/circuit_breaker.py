@@ -0,0 +1,207 @@
+import os
+import time
+
+# Circuit breakers for every Gemini key and every region, shared by all workers in Redis.
+# A breaker is closed while calls go through normally. It opens when, within one
+# BREAKER_WINDOW, at least BREAKER_MIN_CALLS calls were made and BREAKER_FAILURE_RATE of
+# them failed (5xx, timeout, dropped connection) or BREAKER_SLOW_RATE of them took longer
+# than BREAKER_SLOW_CALL seconds. rank_keys then leaves the key, or every key of the region,
+# out of the ranking without an upstream call. A breaker stays open for BREAKER_OPEN_SECONDS,
+# doubling on each consecutive trip up to BREAKER_OPEN_MAX. After that it is half-open: one
+# probe call at a time goes through, BREAKER_PROBES successes in a row close it, and a
+# failed or slow probe opens it again. Rate limiting (429) and bad requests don't count;
+# the scheduler's cooldown already handles 429s.
+
+BREAKER_ENABLED = os.getenv("BREAKER_ENABLED", "true").lower() == "true"
+BREAKER_WINDOW = int(os.getenv("BREAKER_WINDOW", 30))
+BREAKER_MIN_CALLS = int(os.getenv("BREAKER_MIN_CALLS", 10))
+BREAKER_FAILURE_RATE = float(os.getenv("BREAKER_FAILURE_RATE", 0.5))
+BREAKER_SLOW_CALL = float(os.getenv("BREAKER_SLOW_CALL", 20))
+BREAKER_SLOW_RATE = float(os.getenv("BREAKER_SLOW_RATE", 0.8))
+BREAKER_OPEN_SECONDS = float(os.getenv("BREAKER_OPEN_SECONDS", 15))
+BREAKER_OPEN_MAX = float(os.getenv("BREAKER_OPEN_MAX", 300))
+BREAKER_PROBES = int(os.getenv("BREAKER_PROBES", 2))
+BREAKER_PROBE_TIMEOUT = float(os.getenv("BREAKER_PROBE_TIMEOUT", 60))  # a probe that never reports frees its slot
+
+CLOSED = ("closed", 0.0, 0.0)
+
+# KEYS: (state hash, window hash) per breaker. Returns the state hashes that tripped open.
+# A closed breaker's trip count is kept until its hash expires, BREAKER_OPEN_MAX * 2 after
+# it closed, so a breaker that keeps tripping stays open longer each time.
+_RECORD_LUA = """
+local now = tonumber(ARGV[1])
+local failed = ARGV[2] == '1'
+local slow = ARGV[3] == '1'
+local window = tonumber(ARGV[4])
+local min_calls = tonumber(ARGV[5])
+local failure_rate = tonumber(ARGV[6])
+local slow_rate = tonumber(ARGV[7])
+local open_seconds = tonumber(ARGV[8])
+local open_max = tonumber(ARGV[9])
+local probes = tonumber(ARGV[10])
+local tripped = {}
+local function trip(state_key, window_key)
+  local trips = tonumber(redis.call('HGET', state_key, 'trips') or '0') + 1
+  local duration = math.min(open_seconds * 2 ^ (trips - 1), open_max)
+  redis.call('HSET', state_key, 'state', 'open', 'until', now + duration, 'trips', trips, 'successes', 0, 'probe_until', 0)
+  redis.call('EXPIRE', state_key, math.ceil(duration + open_max * 2))
+  redis.call('DEL', window_key)
+  table.insert(tripped, state_key)
+end
+for i = 1, #KEYS, 2 do
+  local state_key, window_key = KEYS[i], KEYS[i + 1]
+  local state = redis.call('HGET', state_key, 'state') or 'closed'
+  if state == 'half_open' then
+    if failed or slow then
+      trip(state_key, window_key)
+    elseif redis.call('HINCRBY', state_key, 'successes', 1) >= probes then
+      redis.call('HSET', state_key, 'state', 'closed', 'probe_until', 0)
+      redis.call('EXPIRE', state_key, math.ceil(open_max * 2))
+    else
+      redis.call('HSET', state_key, 'probe_until', 0)
+    end
+  elseif state == 'closed' then
+    local calls = redis.call('HINCRBY', window_key, 'calls', 1)
+    if calls == 1 then
+      redis.call('EXPIRE', window_key, window)
+    end
+    local failures = redis.call('HINCRBY', window_key, 'failures', failed and 1 or 0)
+    local slows = redis.call('HINCRBY', window_key, 'slow', slow and 1 or 0)
+    if calls >= min_calls and (failures >= calls * failure_rate or slows >= calls * slow_rate) then
+      trip(state_key, window_key)
+    end
+  end
+end
+return tripped
+"""
+
+# KEYS: state hashes of one call's breakers. Lets the call through (1) only if every breaker
+# is closed or due a probe, and then claims the probe slot of each one that is.
+_PROBE_LUA = """
+local now = tonumber(ARGV[1])
+local due = {}
+for _, state_key in ipairs(KEYS) do
+  local s = redis.call('HMGET', state_key, 'state', 'until', 'probe_until')
+  local state = s[1] or 'closed'
+  if state == 'open' then
+    if now < tonumber(s[2]) then
+      return 0
+    end
+    table.insert(due, state_key)
+  elseif state == 'half_open' then
+    if now < tonumber(s[3] or '0') then
+      return 0
+    end
+    table.insert(due, state_key)
+  end
+end
+for _, state_key in ipairs(due) do
+  redis.call('HSET', state_key, 'state', 'half_open', 'probe_until', now + tonumber(ARGV[2]))
+end
+return 1
+"""
+
+# KEYS: state hashes whose probe slot admit claimed. Frees the slots of a call that never went out.
+_RELEASE_LUA = """
+for _, state_key in ipairs(KEYS) do
+  if redis.call('HGET', state_key, 'state') == 'half_open' then
+    redis.call('HSET', state_key, 'probe_until', 0)
+  end
+end
+return 1
+"""
+
+_record_script = None
+_probe_script = None
+_release_script = None
+_states = {}  # scope -> (state, open until, probe until), as of this worker's last rank_keys
+
+def scopes(key):
+    return (f"key:{key['id']}", region_scope(key["region"]))
+
+def state_key(scope):
+    return f"breaker:{scope}"
+
+def window_key(scope):
+    return f"breaker_window:{scope}"
+
+def queue_reads(pipe, keys):
+    # Adds the state reads for keys' breakers to a pipeline; returns their scopes in order.
+    names = sorted({scope for key in keys for scope in scopes(key)})
+    for scope in names:
+        pipe.hmget(state_key(scope), "state", "until", "probe_until")
+    return names
+
+def remember(names, values):
+    # Returns {scope: (state, open until, probe until)} from queue_reads' results.
+    states = {}
+    for scope, (state, until, probe_until) in zip(names, values):
+        states[scope] = (state.decode(), float(until or 0), float(probe_until or 0)) if state else CLOSED
+    _states.update(states)
+    return states
+
+def region_scope(region):
+    return f"region:{region}"
+
+def scope_blocked_until(scope, states, now):
+    # When a call under this one breaker may go out again, or None if it may go out now.
+    state, until, probe_until = states.get(scope, CLOSED)
+    if state == "open" and until > now:
+        return until
+    if state == "half_open" and probe_until > now:
+        return probe_until  # another worker's probe is in flight
+    return None
+
+def admit(conn, key):
+    # Whether a call on key may go out; claims the probe slot of a breaker that is due one.
+    if not BREAKER_ENABLED:
+        return True
+    due = [state_key(s) for s in scopes(key) if _states.get(s, CLOSED)[0] != "closed"]
+    if not due:
+        return True
+    global _probe_script
+    if _probe_script is None:
+        _probe_script = conn.register_script(_PROBE_LUA)
+    return bool(_probe_script(keys=due, args=[time.time(), BREAKER_PROBE_TIMEOUT]))
+
+def release(conn, key):
+    # Gives back the probe slots admit claimed when the call is not sent after all.
+    if not BREAKER_ENABLED:
+        return
+    due = [state_key(s) for s in scopes(key) if _states.get(s, CLOSED)[0] != "closed"]
+    if not due:
+        return
+    global _release_script
+    if _release_script is None:
+        _release_script = conn.register_script(_RELEASE_LUA)
+    _release_script(keys=due)
+
+def record(conn, key, failed, latency):
+    # Counts one finished call against key's breakers; returns the scopes it tripped open.
+    if not BREAKER_ENABLED:
+        return []
+    global _record_script
+    if _record_script is None:
+        _record_script = conn.register_script(_RECORD_LUA)
+    tripped = _record_script(
+        keys=[name for scope in scopes(key) for name in (state_key(scope), window_key(scope))],
+        args=[time.time(), int(failed), int(latency is not None and latency >= BREAKER_SLOW_CALL), BREAKER_WINDOW,
+              BREAKER_MIN_CALLS, BREAKER_FAILURE_RATE, BREAKER_SLOW_RATE, BREAKER_OPEN_SECONDS, BREAKER_OPEN_MAX,
+              BREAKER_PROBES])
+    scopes_tripped = [name.decode()[len("breaker:"):] for name in tripped]
+    for scope in scopes_tripped:
+        _states[scope] = ("open", time.time() + BREAKER_OPEN_SECONDS, 0.0)
+    return scopes_tripped
+
+def breaker_states(conn, keys):
+    # {scope: (state, open until, probe until)} for keys and their regions, read fresh.
+    pipe = conn.pipeline(transaction=False)
+    names = queue_reads(pipe, keys)
+    return remember(names, pipe.execute())
+
+def describe(state, now=None):
+    name, until, _ = state
+    if name == "open":
+        remaining = until - (now or time.time())
+        return f"open ({int(remaining) + 1}s)" if remaining > 0 else "probing soon"
+    return "half-open" if name == "half_open" else "closed"
@@ -0,0 +1,150 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+
+import redis
+
+from backend.gemini_client import create_cached_content, update_cached_content_ttl
+from backend.metrics import CONTEXT_CACHE
+
+# Gemini context caching for stable prompt prefixes: the systemInstruction plus the leading
+# contents that come from the client's fixed messages, such as a bot's base prompt. Once a
+# prefix of at least CONTEXT_CACHE_MIN_TOKENS has been sent CONTEXT_CACHE_MIN_USES times
+# within CONTEXT_CACHE_TTL, a cachedContents entry is created for it in the background.
+# Entries belong to the project of the Gemini key that created them, so there is one per
+# (key, model, prefix). Later calls on that key send only the rest of the conversation plus
+# the entry's name, so the prefix is neither re-sent nor re-processed and its tokens are
+# billed at the cached rate. Entries still in use are extended CONTEXT_CACHE_REFRESH_MARGIN
+# before they expire. A changed prompt hashes differently, so its old entry is never
+# referenced again and runs out on its own. Entry names are shared across workers in Redis
+# and memoized in each worker.
+
+CONTEXT_CACHE_ENABLED = os.getenv("CONTEXT_CACHE_ENABLED", "true").lower() == "true"
+CONTEXT_CACHE_TTL = int(os.getenv("CONTEXT_CACHE_TTL", 3600))
+CONTEXT_CACHE_REFRESH_MARGIN = int(os.getenv("CONTEXT_CACHE_REFRESH_MARGIN", 600))
+CONTEXT_CACHE_MIN_TOKENS = int(os.getenv("CONTEXT_CACHE_MIN_TOKENS", 4096))  # Gemini rejects smaller caches
+CONTEXT_CACHE_MIN_USES = int(os.getenv("CONTEXT_CACHE_MIN_USES", 3))
+CONTEXT_CACHE_FAILURE_TTL = int(os.getenv("CONTEXT_CACHE_FAILURE_TTL", 3600))  # no new attempt for a rejected prefix
+CONTEXT_CACHE_LOCAL_TTL = 10  # seconds a worker trusts its memo of a missing entry
+EXPIRY_SAFETY = 30  # entries this close to expiring are not referenced any more
+
+PREFIX_FIELD = "_cachePrefix"  # internal payload field, stripped before sending
+
+_entries = {}  # slot -> (entry name or None, expires_at, memo valid until)
+_tasks = set()
+
+def mark_prefix(payload, prefix_length, prefix_tokens):
+    # Tags a Gemini payload whose systemInstruction and first prefix_length contents are a
+    # candidate for caching. prefix_length None means the systemInstruction is not stable.
+    if not CONTEXT_CACHE_ENABLED or prefix_length is None or prefix_tokens < CONTEXT_CACHE_MIN_TOKENS:
+        return payload
+    if prefix_length == 0 and "systemInstruction" not in payload:
+        return payload
+    prefix = json.dumps([payload.get("systemInstruction"), payload["contents"][:prefix_length]], sort_keys=True)
+    payload[PREFIX_FIELD] = {"length": prefix_length, "hash": hashlib.sha256(prefix.encode()).hexdigest()[:32]}
+    return payload
+
+def strip_prefix(payload):
+    return {k: v for k, v in payload.items() if k != PREFIX_FIELD}
+
+def _spawn(coro):
+    task = asyncio.ensure_future(coro)
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+
+def _lookup(conn, slot, now):
+    memo = _entries.get(slot)
+    if memo is not None and memo[2] > now:
+        return memo[0], memo[1]
+    raw = conn.get(f"ctxcache:entry:{slot}")
+    name, expires = json.loads(raw) if raw else (None, 0)
+    _entries[slot] = (name, expires, min(expires, now + CONTEXT_CACHE_LOCAL_TTL) if name else now + CONTEXT_CACHE_LOCAL_TTL)
+    return name, expires
+
+def _remember(conn, slot, name, expires):
+    conn.set(f"ctxcache:entry:{slot}", json.dumps([name, expires]), ex=max(1, int(expires - time.time())))
+    _entries[slot] = (name, expires, expires)
+
+def forget(conn, slot):
+    # The entry was rejected upstream (expired or deleted behind our back).
+    _entries.pop(slot, None)
+    try:
+        conn.delete(f"ctxcache:entry:{slot}")
+    except redis.RedisError:
+        pass
+
+def for_key(conn, payload, key, model_name):
+    # Returns (payload to send with this key, slot of the cache entry it references or None).
+    marker = payload.get(PREFIX_FIELD)
+    if marker is None:
+        return payload, None
+    send = strip_prefix(payload)
+    slot = f"{key['id']}:{model_name}:{marker['hash']}"
+    now = time.time()
+    try:
+        name, expires = _lookup(conn, slot, now)
+        if name is None or expires - now < EXPIRY_SAFETY:
+            CONTEXT_CACHE.labels("miss").inc()
+            _consider_creating(conn, slot, send, marker, key, model_name)
+            return send, None
+        if expires - now < CONTEXT_CACHE_REFRESH_MARGIN and conn.set(f"ctxcache:lock:{slot}", 1, nx=True, ex=60):
+            _spawn(_refresh(conn, slot, name, key))
+    except redis.RedisError as e:
+        logging.warning(f"Context cache unavailable, sending the full prompt: {e}")
+        return send, None
+    CONTEXT_CACHE.labels("hit").inc()
+    # Gemini refuses a systemInstruction next to cachedContent; the cache holds it.
+    send = {k: v for k, v in send.items() if k != "systemInstruction"}
+    return {**send, "contents": send["contents"][marker["length"]:], "cachedContent": name}, slot
+
+def _consider_creating(conn, slot, send, marker, key, model_name):
+    pipe = conn.pipeline()
+    pipe.set(f"ctxcache:uses:{marker['hash']}", 0, nx=True, ex=CONTEXT_CACHE_TTL)
+    pipe.incr(f"ctxcache:uses:{marker['hash']}")
+    pipe.exists(f"ctxcache:failed:{slot}")
+    _, uses, failed = pipe.execute()
+    if uses < CONTEXT_CACHE_MIN_USES or failed:
+        return
+    if conn.set(f"ctxcache:lock:{slot}", 1, nx=True, ex=60):
+        _spawn(_create(conn, slot, send.get("systemInstruction"), send["contents"][:marker["length"]], key, model_name))
+
+async def _create(conn, slot, system_instruction, contents, key, model_name):
+    body = {"model": f"models/{model_name}", "contents": contents, "ttl": f"{CONTEXT_CACHE_TTL}s"}
+    if system_instruction is not None:
+        body["systemInstruction"] = system_instruction
+    try:
+        data, status = await create_cached_content(body, key["api_key"])
+        if status != 200 or "name" not in data:
+            # Typically a prefix below the model's minimum size or a model without caching.
+            CONTEXT_CACHE.labels("create_failed").inc()
+            conn.set(f"ctxcache:failed:{slot}", status, ex=CONTEXT_CACHE_FAILURE_TTL)
+            logging.warning(f"Context cache not created for {model_name} on key {key.get('name')}: "
+                            f"{data.get('error', {}).get('message', status)}")
+            return
+        CONTEXT_CACHE.labels("created").inc()
+        _remember(conn, slot, data["name"], time.time() + CONTEXT_CACHE_TTL)
+    except Exception as e:
+        logging.warning(f"Context cache creation failed: {e}")
+    finally:
+        conn.delete(f"ctxcache:lock:{slot}")
+
+async def _refresh(conn, slot, name, key):
+    try:
+        data, status = await update_cached_content_ttl(name, CONTEXT_CACHE_TTL, key["api_key"])
+        if status == 200:
+            CONTEXT_CACHE.labels("refreshed").inc()
+            _remember(conn, slot, name, time.time() + CONTEXT_CACHE_TTL)
+        elif status in (403, 404):
+            forget(conn, slot)
+    except Exception as e:
+        logging.warning(f"Context cache refresh failed: {e}")
+    finally:
+        conn.delete(f"ctxcache:lock:{slot}")
+
+def cache_rejected(status_code, gemini_data):
+    # True when a call failed because the cachedContent it referenced is gone.
+    message = str((gemini_data or {}).get("error", {}).get("message", "")).lower()
+    return status_code in (400, 403, 404) and "cache" in message
@@ -0,0 +1,110 @@
+import json
+import logging
+import os
+
+import redis
+
+from backend.tokens import count_tokens, MESSAGE_OVERHEAD_TOKENS
+from supabase_client import owner_scope
+
+# Server-side conversation memory. A request carrying "X-Conversation-Id: <id>" sends its
+# fixed prefix (e.g. a bot's base prompt, resent unchanged every turn) followed by only the
+# new user message. The history stored for (user API key, id) is inserted between the two,
+# and the new message and the reply are appended once the answer is in, so the client's
+# payload stays the same size however long the chat gets. History is bounded to
+# CONVERSATION_MAX_TURNS messages and CONVERSATION_TOKEN_BUDGET tokens. The oldest turns
+# are dropped first, and with CONVERSATION_SUMMARIZE they are folded into a running summary
+# by a background Gemini call. The prefix always comes first and byte-identical, so Gemini
+# can serve it from its context cache instead of re-processing it.
+
+CONVERSATION_HEADER = "x-conversation-id"
+CONVERSATION_TTL = int(os.getenv("CONVERSATION_TTL", 7 * 86400))
+CONVERSATION_MAX_TURNS = int(os.getenv("CONVERSATION_MAX_TURNS", 50))
+CONVERSATION_TOKEN_BUDGET = int(os.getenv("CONVERSATION_TOKEN_BUDGET", 3000))
+CONVERSATION_SUMMARIZE = os.getenv("CONVERSATION_SUMMARIZE", "false").lower() == "true"
+CONVERSATION_ID_MAX_LENGTH = 128
+SUMMARY_WORDS = 200
+
+def conversation_requested(headers):
+    # The conversation id, or None for a stateless request.
+    return headers.get(CONVERSATION_HEADER) or None
+
+def turn(role, content):
+    return {"role": role, "content": content, "tokens": count_tokens(content) + MESSAGE_OVERHEAD_TOKENS}
+
+class Conversation:
+    def __init__(self, conn, user_api_key, conversation_id):
+        if len(conversation_id) > CONVERSATION_ID_MAX_LENGTH:
+            raise ValueError(f"X-Conversation-Id must be at most {CONVERSATION_ID_MAX_LENGTH} characters")
+        owner = owner_scope(user_api_key)
+        self.conn = conn
+        self.id = conversation_id
+        self.key = f"conv:{owner}:{conversation_id}"
+        self.summary_key = f"{self.key}:summary"
+        self.turns = []
+        self.summary = None
+
+    def load(self):
+        try:
+            pipe = self.conn.pipeline()
+            pipe.lrange(self.key, 0, -1)
+            pipe.get(self.summary_key)
+            raw_turns, summary = pipe.execute()
+        except redis.RedisError as e:
+            # Answer without memory rather than not at all.
+            logging.warning(f"Conversation {self.id} could not be loaded: {e}")
+            return
+        self.turns = [json.loads(t) for t in raw_turns]
+        self.summary = summary.decode() if summary else None
+
+    def messages(self, request_messages):
+        # Full message list for the model: prefix, summary, history, new message.
+        last = request_messages[-1] if isinstance(request_messages, list) and request_messages else None
+        if not isinstance(last, dict) or last.get("role") != "user" or not isinstance(last.get("content"), str):
+            raise ValueError("With X-Conversation-Id, the last message must be the new user message")
+        history = [{"role": t["role"], "content": t["content"]} for t in self.turns]
+        if self.summary:
+            history.insert(0, {"role": "user", "content": f"Summary of our conversation so far: {self.summary}"})
+        return request_messages[:-1] + history + request_messages[-1:]
+
+    def append(self, user_message, reply):
+        # Records one exchange and trims the history to its bounds. Returns the dropped
+        # turns, oldest first. Concurrent requests on one conversation may interleave
+        # their exchanges; clients (like the bots) send one turn at a time per chat.
+        turns = self.turns + [turn("user", user_message), turn("assistant", reply)]
+        total = sum(t["tokens"] for t in turns)
+        drop = 0
+        while drop < len(turns) - 2 and (total > CONVERSATION_TOKEN_BUDGET or len(turns) - drop > CONVERSATION_MAX_TURNS):
+            total -= turns[drop]["tokens"]
+            drop += 1
+        while drop < len(turns) - 2 and turns[drop]["role"] != "user":
+            drop += 1  # history starts with a user turn
+        try:
+            pipe = self.conn.pipeline()
+            pipe.rpush(self.key, *(json.dumps(t) for t in turns[-2:]))
+            if drop:
+                pipe.ltrim(self.key, drop, -1)
+            pipe.expire(self.key, CONVERSATION_TTL)
+            pipe.expire(self.summary_key, CONVERSATION_TTL)
+            pipe.execute()
+        except redis.RedisError as e:
+            logging.warning(f"Conversation {self.id} could not be saved: {e}")
+            return []
+        self.turns = turns[drop:]
+        return turns[:drop]
+
+    def summary_request(self, dropped):
+        # Messages asking the model to fold the dropped turns into the running summary.
+        transcript = "\n".join(f"{t['role']}: {t['content']}" for t in dropped)
+        previous = f"Summary so far:\n{self.summary}\n\n" if self.summary else ""
+        return [{"role": "user", "content": (
+            f"{previous}More of the conversation:\n{transcript}\n\n"
+            f"Write an updated summary of the whole conversation in at most {SUMMARY_WORDS} words. "
+            "Keep names, facts, decisions and open questions. Reply with the summary only.")}]
+
+    def store_summary(self, summary):
+        self.conn.set(self.summary_key, summary, ex=CONVERSATION_TTL)
+        self.summary = summary
+
+    def clear(self):
+        self.conn.delete(self.key, self.summary_key)
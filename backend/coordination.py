@@ -0,0 +1,40 @@
+import asyncio
+
+# Redis building blocks shared by request coalescing, async jobs and batches: releasing a
+# lock only while still holding it, and waiting for a result another process publishes.
+
+# Only the holder (whose token is stored under the key) may release it.
+_RELEASE_LUA = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+  return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+def release_lock(conn, key, token):
+    # Works on sync and async clients alike; await the result with an async one.
+    return conn.eval(_RELEASE_LUA, 1, key, token)
+
+async def wait_published(conn, channel, timeout, ready, parse):
+    # ready() -> the result if it is already there, else None. Subscribed first, so a result
+    # published between that check and the wait is still seen. Returns ready()'s result,
+    # parse(data) of the first message on channel, or None after timeout seconds.
+    pubsub = conn.pubsub()
+    try:
+        await pubsub.subscribe(channel)
+        result = await ready()
+        if result is not None:
+            return result
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while loop.time() < deadline:
+            message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=min(1.0, deadline - loop.time()))
+            if message is not None and message["type"] == "message":
+                return parse(message["data"])
+        return None
+    finally:
+        try:
+            await pubsub.unsubscribe(channel)
+            await pubsub.aclose()
+        except Exception:
+            pass
@@ -0,0 +1,86 @@
+import json
+import os
+
+import aiohttp
+
+GEMINI_API_BASE = os.getenv("GEMINI_API_BASE", "https://generativelanguage.googleapis.com/v1").rstrip("/")
+# Context caching (cachedContents) only exists in v1beta; calls that reference a cache go there.
+GEMINI_BETA_API_BASE = os.getenv("GEMINI_BETA_API_BASE", GEMINI_API_BASE.rsplit("/", 1)[0] + "/v1beta").rstrip("/")
+
+# Connection pool tuning. One pool is shared by every request handled by this worker process.
+GEMINI_MAX_CONNECTIONS = int(os.getenv("GEMINI_MAX_CONNECTIONS", 500))
+GEMINI_MAX_CONNECTIONS_PER_HOST = int(os.getenv("GEMINI_MAX_CONNECTIONS_PER_HOST", 200))
+GEMINI_KEEPALIVE_TIMEOUT = float(os.getenv("GEMINI_KEEPALIVE_TIMEOUT", 30))
+GEMINI_DNS_CACHE_TTL = int(os.getenv("GEMINI_DNS_CACHE_TTL", 300))
+GEMINI_CONNECT_TIMEOUT = float(os.getenv("GEMINI_CONNECT_TIMEOUT", 5))
+GEMINI_READ_TIMEOUT = float(os.getenv("GEMINI_READ_TIMEOUT", 60))
+
+_session = None
+
+def get_session():
+    # Created lazily so the session binds to the event loop of the worker that uses it.
+    global _session
+    if _session is None or _session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=GEMINI_MAX_CONNECTIONS,
+            limit_per_host=GEMINI_MAX_CONNECTIONS_PER_HOST,
+            keepalive_timeout=GEMINI_KEEPALIVE_TIMEOUT,
+            ttl_dns_cache=GEMINI_DNS_CACHE_TTL,
+        )
+        timeout = aiohttp.ClientTimeout(
+            total=None,
+            sock_connect=GEMINI_CONNECT_TIMEOUT,
+            sock_read=GEMINI_READ_TIMEOUT,
+        )
+        _session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+    return _session
+
+async def close_session():
+    global _session
+    if _session is not None:
+        await _session.close()
+        _session = None
+
+def model_url(model_name, method, payload=None):
+    base = GEMINI_BETA_API_BASE if payload and "cachedContent" in payload else GEMINI_API_BASE
+    return f"{base}/models/{model_name}:{method}"
+
+async def _json_request(method, url, api_key, body, params=None):
+    async with get_session().request(method, url, params={"key": api_key, **(params or {})}, json=body) as resp:
+        try:
+            return await resp.json(content_type=None), resp.status
+        except Exception as e:
+            return {"error": {"message": str(e)}}, 500
+
+async def generate_content(payload, api_key, model_name):
+    return await _json_request("POST", model_url(model_name, "generateContent", payload), api_key, payload)
+
+async def create_cached_content(body, api_key):
+    return await _json_request("POST", f"{GEMINI_BETA_API_BASE}/cachedContents", api_key, body)
+
+async def update_cached_content_ttl(name, ttl_seconds, api_key):
+    return await _json_request("PATCH", f"{GEMINI_BETA_API_BASE}/{name}", api_key, {"ttl": f"{ttl_seconds}s"},
+                               params={"updateMask": "ttl"})
+
+async def open_stream(payload, api_key, model_name):
+    # Returns the raw response once headers arrive; the caller must release() it.
+    url = model_url(model_name, "streamGenerateContent", payload)
+    return await get_session().post(url, params={"key": api_key, "alt": "sse"}, json=payload)
+
+async def read_error(resp):
+    try:
+        return await resp.json(content_type=None)
+    except Exception as e:
+        return {"error": {"message": str(e)}}
+    finally:
+        resp.release()
+
+async def iter_sse_events(resp):
+    # Gemini sends one JSON GenerateContentResponse per "data:" line.
+    async for raw_line in resp.content:
+        line = raw_line.strip()
+        if not line.startswith(b"data:"):
+            continue
+        data = line[5:].strip()
+        if data:
+            yield json.loads(data)
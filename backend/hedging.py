@@ -0,0 +1,88 @@
+import asyncio
+import os
+import time
+from collections import deque
+
+# Optional hedged requests: if the primary key has not answered within the recent
+# HEDGE_PERCENTILE latency, the same payload goes to a key in another region and the first
+# successful answer wins. The hedge only fires if that region still has budget, and the
+# outcome counters in Redis (hedge:stats) show whether the delay is paying off.
+
+HEDGE_ENABLED = os.getenv("HEDGE_ENABLED", "false").lower() == "true"
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", 95))
+HEDGE_MIN_DELAY = float(os.getenv("HEDGE_MIN_DELAY", 0.5))
+HEDGE_DEFAULT_DELAY = float(os.getenv("HEDGE_DEFAULT_DELAY", 3.0))  # used until enough samples exist
+HEDGE_MIN_SAMPLES = 20
+HEDGE_STATS_KEY = "hedge:stats"
+
+_latencies = deque(maxlen=int(os.getenv("HEDGE_SAMPLE_SIZE", 500)))
+
+def hedge_delay():
+    if len(_latencies) < HEDGE_MIN_SAMPLES:
+        return HEDGE_DEFAULT_DELAY
+    ordered = sorted(_latencies)
+    idx = min(int(len(ordered) * HEDGE_PERCENTILE / 100), len(ordered) - 1)
+    return max(HEDGE_MIN_DELAY, ordered[idx])
+
+def pick_hedge_key(keys, primary, registry):
+    # The best-ranked key in another region; registry is key_registry's view.
+    if len(registry["by_region"]) < 2:
+        return None  # a single region has nowhere to hedge to, so the ranking isn't scanned
+    return next((k for k in keys if k["region"] != primary["region"]), None)
+
+def _count(conn, field):
+    try:
+        conn.hincrby(HEDGE_STATS_KEY, field, 1)
+    except Exception:
+        pass
+
+def hedge_stats(conn):
+    stats = {k.decode(): int(v) for k, v in conn.hgetall(HEDGE_STATS_KEY).items()}
+    fired = stats.get("fired", 0)
+    stats["hedge_win_rate"] = stats.get("hedge_won", 0) / fired if fired else 0.0
+    stats["delay"] = hedge_delay()
+    return stats
+
+def _retrieve(task):
+    # Losing tasks may finish with an error nobody awaits; read it so asyncio doesn't warn.
+    if not task.cancelled():
+        task.exception()
+
+async def hedged_call(conn, primary_key, hedge_key, call, hedge_allowed):
+    # call(key) -> (data, status); hedge_allowed() consumes the hedge key's region budget.
+    # Returns (key, data, status, hedge_used) for the first 200, else the primary's outcome.
+    _count(conn, "requests")
+    start = time.time()
+    primary = asyncio.ensure_future(call(primary_key))
+    done, _ = await asyncio.wait({primary}, timeout=hedge_delay())
+    if not done:
+        if not hedge_allowed():
+            _count(conn, "skipped_budget")
+            await asyncio.wait({primary})
+        else:
+            _count(conn, "fired")
+            hedge = asyncio.ensure_future(call(hedge_key))
+            pending = {primary, hedge}
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None and task.result()[1] == 200:
+                        for loser in pending:
+                            loser.add_done_callback(_retrieve)
+                            loser.cancel()
+                        # Sampled either way: the primary took at least this long even when the
+                        # hedge won, and leaving those out would pull the delay down to HEDGE_MIN_DELAY.
+                        _latencies.append(time.time() - start)
+                        if task is primary:
+                            _count(conn, "primary_won")
+                            return (primary_key, *task.result(), True)
+                        _count(conn, "hedge_won")
+                        return (hedge_key, *task.result(), True)
+            _count(conn, "both_failed")
+            hedge.add_done_callback(_retrieve)
+            data, status = primary.result()
+            return primary_key, data, status, True
+    data, status = primary.result()
+    if status == 200:
+        _latencies.append(time.time() - start)
+    return primary_key, data, status, False
@@ -0,0 +1,245 @@
+import asyncio
+import hashlib
+import hmac
+import ipaddress
+import json
+import logging
+import os
+import socket
+import time
+import traceback
+from urllib.parse import urlsplit
+
+import aiohttp
+from aiohttp.resolver import ThreadedResolver
+from rq import Queue
+from rq.exceptions import DequeueTimeout, NoSuchJobError
+from rq.job import Job, JobStatus
+from rq.results import Result
+
+from backend.coordination import wait_published
+from supabase_client import get_async_redis, owner_scope
+
+# Admission queue for Gemini calls. Completions that find every key over budget are queued
+# in RQ instead of being sent anyway; they are drained only as fast as the shared rate
+# limiter admits them, so quota exhaustion turns into queuing instead of 429 storms. The
+# HTTP caller waits up to OVERFLOW_WAIT for its queued completion. The same queues back
+# the async job API (/v1/jobs), where callers submit and then poll or get a webhook.
+# A queued completion spends nearly all of its time waiting for quota or for Gemini, so the
+# queues are drained by consume_queues in one event loop per process, with up to
+# OVERFLOW_CONCURRENCY jobs in flight, rather than by RQ workers that hold one job each.
+# Webhooks go only to https URLs on public addresses, checked when the job is submitted and
+# again on every connection, so a client can't aim the server at internal services.
+
+OVERFLOW_ENABLED = os.getenv("OVERFLOW_ENABLED", "true").lower() == "true"
+OVERFLOW_WAIT = float(os.getenv("OVERFLOW_WAIT", 30))  # seconds an HTTP caller waits for a queued completion
+JOB_TTL = int(os.getenv("JOB_TTL", 24 * 3600))  # seconds an async job may wait for quota
+JOB_RESULT_TTL = int(os.getenv("JOB_RESULT_TTL", 24 * 3600))
+JOB_WEBHOOK_SECRET = os.getenv("JOB_WEBHOOK_SECRET")
+JOB_CALL_TIMEOUT = 300  # upper bound for the Gemini call itself, on top of the queue deadline
+OVERFLOW_CONCURRENCY = int(os.getenv("OVERFLOW_CONCURRENCY", 64))  # jobs in flight per consumer process
+OVERFLOW_POLL_TIMEOUT = 1  # seconds a dequeue blocks, so a stop request is noticed quickly
+
+# Workers listen to these in order, so "high" always drains first.
+QUEUE_NAMES = {"high": "gemini_requests_high", "normal": "gemini_requests", "low": "gemini_requests_low"}
+JOB_PRIORITIES = ("normal", "low")  # "high" is kept for interactive overflow
+JOB_WEBHOOK_TIMEOUT = 10
+JOB_FUNCTION = "backend.main.run_queued_completion"
+
+_queues = {}
+
+def get_queue(conn, priority):
+    queue = _queues.get(priority)
+    if queue is None:
+        queue = Queue(QUEUE_NAMES[priority], connection=conn)
+        _queues[priority] = queue
+    return queue
+
+def job_channel(job_id):
+    return f"jobs:done:{job_id}"
+
+def enqueue_completion(conn, request, owner, priority="normal", ttl=JOB_TTL, result_ttl=JOB_RESULT_TTL,
+                       webhook_url=None):
+    # request: the JSON-safe arguments of run_queued_completion. The deadline travels with
+    # it so a worker never spends quota on a request nobody is waiting for any more.
+    request = {**request, "deadline": time.time() + ttl}
+    return get_queue(conn, priority).enqueue(
+        JOB_FUNCTION, request,
+        ttl=int(ttl), result_ttl=result_ttl, failure_ttl=result_ttl,
+        job_timeout=int(ttl) + JOB_CALL_TIMEOUT,
+        meta={"owner": owner, "priority": priority, "webhook_url": webhook_url}
+    )
+
+def fetch_job(conn, job_id, user_api_key):
+    # Jobs are only visible to the API key that submitted them.
+    try:
+        job = Job.fetch(job_id, connection=conn)
+    except NoSuchJobError:
+        return None
+    if job.meta.get("owner") != owner_scope(user_api_key):
+        return None
+    return job
+
+def job_view(job):
+    status = job.get_status()
+    view = {
+        "id": job.id,
+        "object": "chat.completion.job",
+        "status": status.value if status is not None else "expired",
+        "priority": job.meta.get("priority"),
+        "created_at": int(job.created_at.timestamp()) if job.created_at else None,
+        "result": None,
+        "error": None
+    }
+    if status == JobStatus.FINISHED:
+        result = job.return_value()
+        if result["status"] == 200:
+            view["result"] = result["body"]
+        else:
+            view["status"] = "failed"
+            view["error"] = result["body"].get("error")
+    elif status == JobStatus.FAILED:
+        view["error"] = {"message": "Job failed in the worker", "type": "server_error", "param": None, "code": "server_error"}
+    return view
+
+def store_result(conn, job, result=None, error=None):
+    # Records the outcome the way an RQ worker would, so fetch_job/job_view and
+    # wait_for_result read it unchanged.
+    pipe = conn.pipeline()
+    if error is None:
+        ttl = job.get_result_ttl(JOB_RESULT_TTL)
+        job.set_status(JobStatus.FINISHED, pipeline=pipe)
+        Result.create(job, Result.Type.SUCCESSFUL, ttl, return_value=result, pipeline=pipe)
+    else:
+        ttl = job.failure_ttl or JOB_RESULT_TTL
+        job.set_status(JobStatus.FAILED, pipeline=pipe)
+        Result.create_failure(job, ttl, error, pipeline=pipe)
+    job.cleanup(ttl, pipeline=pipe, remove_from_queue=False)
+    pipe.execute()
+
+async def announce_result(conn, job, result):
+    # Wakes the HTTP caller waiting in wait_for_result and posts the webhook, if any.
+    publish_result(conn, job.id, result)
+    if job.meta.get("webhook_url"):
+        await post_webhook(job.meta["webhook_url"], {
+            "id": job.id, "object": "chat.completion.job",
+            "status": "finished" if result["status"] == 200 else "failed",
+            "result": result["body"] if result["status"] == 200 else None,
+            "error": result["body"].get("error")
+        })
+
+async def _run_job(conn, job, queue, complete, worker_name):
+    pipe = conn.pipeline()
+    job.prepare_for_execution(worker_name, pipe)
+    pipe.execute()
+    try:
+        result = await complete(job.args[0])
+    except asyncio.CancelledError:
+        # Stopped before it finished: back to the front of its queue for the next consumer.
+        queue.enqueue_job(job, at_front=True)
+        raise
+    except Exception as e:
+        logging.error(f"Queued completion {job.id} failed: {e}")
+        store_result(conn, job, error=traceback.format_exc())
+        return
+    store_result(conn, job, result)
+    await announce_result(conn, job, result)
+
+async def consume_queues(conn, complete, stop, concurrency=OVERFLOW_CONCURRENCY):
+    # complete(request) -> {"status", "body"}, as run_queued_completion returns it. Takes jobs,
+    # "high" first, while fewer than concurrency are running, until stop is set. Jobs still
+    # running then get OVERFLOW_WAIT seconds to finish and are requeued after that.
+    queues = [get_queue(conn, priority) for priority in ("high", "normal", "low")]
+    worker_name = f"overflow-{socket.gethostname()}-{os.getpid()}"
+    slots = asyncio.Semaphore(concurrency)
+    running = set()
+    while not stop.is_set():
+        await slots.acquire()
+        try:
+            popped = await asyncio.to_thread(Queue.dequeue_any, queues, OVERFLOW_POLL_TIMEOUT, connection=conn)
+        except DequeueTimeout:
+            popped = None
+        except Exception as e:
+            logging.error(f"Overflow queue read failed: {e}")
+            popped = None
+            await asyncio.sleep(OVERFLOW_POLL_TIMEOUT)
+        if popped is None:
+            slots.release()
+            continue
+        job, queue = popped
+        task = asyncio.create_task(_run_job(conn, job, queue, complete, worker_name))
+        running.add(task)
+        task.add_done_callback(running.discard)
+        task.add_done_callback(lambda _: slots.release())
+    if running:
+        _, unfinished = await asyncio.wait(running, timeout=OVERFLOW_WAIT)
+        for task in unfinished:
+            task.cancel()
+        await asyncio.gather(*unfinished, return_exceptions=True)
+
+def publish_result(conn, job_id, result):
+    try:
+        conn.publish(job_channel(job_id), json.dumps(result))
+    except Exception as e:
+        logging.warning(f"Job result publish failed for {job_id}: {e}")
+
+async def wait_for_result(conn, job, timeout):
+    # Returns the job's {"status", "body"} result, or None if it isn't done within timeout.
+    async def finished():
+        return job.return_value() if job.get_status(refresh=True) == JobStatus.FINISHED else None
+    return await wait_published(get_async_redis(), job_channel(job.id), timeout, finished, json.loads)
+
+def cancel_job(conn, job):
+    # Queued jobs are dropped; a job already talking to Gemini runs to completion.
+    if job.get_status() in (JobStatus.QUEUED, JobStatus.DEFERRED, JobStatus.SCHEDULED):
+        job.cancel()
+        return True
+    return False
+
+def _is_public(address):
+    ip = ipaddress.ip_address(address.split("%")[0])
+    return ip.is_global and not ip.is_multicast
+
+class PublicResolver(ThreadedResolver):
+    # Refuses non-public addresses at connect time too, so a host that passed
+    # webhook_url_error can't be re-pointed at an internal one afterwards (DNS rebinding).
+    async def resolve(self, host, port=0, family=socket.AF_INET):
+        hosts = [h for h in await super().resolve(host, port, family) if _is_public(h["host"])]
+        if not hosts:
+            raise OSError(f"{host} does not resolve to a public address")
+        return hosts
+
+async def webhook_url_error(url):
+    # None if url may receive job results, else the reason it may not.
+    try:
+        parsed = urlsplit(url)
+        port = parsed.port or 443
+    except (TypeError, ValueError, AttributeError):
+        return "webhook_url must be an https URL"
+    if parsed.scheme != "https" or not parsed.hostname:
+        return "webhook_url must be an https URL"
+    try:
+        infos = await asyncio.get_running_loop().getaddrinfo(parsed.hostname, port, type=socket.SOCK_STREAM)
+    except (OSError, UnicodeError):
+        return "webhook_url host does not resolve"
+    if not infos or not all(_is_public(info[4][0]) for info in infos):
+        return "webhook_url must resolve to public addresses only"
+    return None
+
+async def post_webhook(url, payload):
+    body = json.dumps(payload)
+    headers = {"Content-Type": "application/json"}
+    if JOB_WEBHOOK_SECRET:
+        signature = hmac.new(JOB_WEBHOOK_SECRET.encode(), body.encode(), hashlib.sha256).hexdigest()
+        headers["X-Signature-SHA256"] = signature
+    try:
+        # aiohttp skips the resolver for IP literals, so those are checked here.
+        if await webhook_url_error(url) is not None:
+            raise ValueError("not a public https URL")
+        connector = aiohttp.TCPConnector(resolver=PublicResolver())
+        async with aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=JOB_WEBHOOK_TIMEOUT)) as session:
+            async with session.post(url, data=body, headers=headers, allow_redirects=False) as resp:
+                if resp.status >= 400:
+                    logging.warning(f"Job webhook {url} answered {resp.status}")
+    except Exception as e:
+        logging.warning(f"Job webhook {url} failed: {e}")
@@ -0,0 +1,79 @@
+import asyncio
+import logging
+import os
+import time
+
+from supabase_client import get_redis, list_keys, renew_snapshot, on_snapshot_change
+from backend.alerts import send_admin_alert
+from backend.metrics import KEY_REGISTRY_FAILURES, mark_registry_refreshed
+
+# Precomputed view of the Gemini keys for the request path, in the shape the scheduler
+# ranks: the active keys, also grouped by region (breakers and hedging work per region) and
+# by model (model-wide rate limits). In the API a background task renews the shared
+# snapshot well before it expires and the view is rebuilt whenever the snapshot changes
+# (immediately on pub/sub), so requests only ever read the last good view and never wait on
+# Supabase. If Supabase is unreachable the last view keeps being served and the admin is
+# alerted.
+
+KEY_REGISTRY_REFRESH_INTERVAL = int(os.getenv("KEY_REGISTRY_REFRESH_INTERVAL", 30))
+KEY_REGISTRY_RENEW_MARGIN = int(os.getenv("KEY_REGISTRY_RENEW_MARGIN", 120))  # seconds of snapshot life left
+
+_registry = {"active": [], "by_region": {}, "by_model": {}, "source": None, "built_at": 0}
+_stale_since = None
+_refresher = None
+
+def build_registry(keys):
+    active = [k for k in keys if k.get("active")]
+    by_region = {}
+    by_model = {}
+    for key in active:
+        by_region.setdefault(key["region"], []).append(key)
+        by_model.setdefault(key.get("model_name"), []).append(key)
+    return {"active": active, "by_region": by_region, "by_model": by_model, "source": keys, "built_at": time.time()}
+
+def _update(keys):
+    # Every new snapshot copy holds data freshly read from Supabase.
+    global _registry, _stale_since
+    if keys is _registry["source"]:
+        return
+    _registry = build_registry(keys)
+    mark_registry_refreshed()
+    if _stale_since is not None:
+        logging.warning(f"Gemini key registry refreshed again after {int(time.time() - _stale_since)}s")
+        _stale_since = None
+
+def get_registry():
+    if _refresher is None:
+        # Outside the API (RQ workers, scripts) nothing refreshes in the background.
+        _update(list_keys())
+    return _registry
+
+def registry_age():
+    return time.time() - _registry["built_at"] if _registry["built_at"] else None
+
+def refresh_registry():
+    global _stale_since
+    try:
+        renew_snapshot("keys", KEY_REGISTRY_RENEW_MARGIN)
+        _update(list_keys())
+    except Exception as e:
+        KEY_REGISTRY_FAILURES.inc()
+        if _stale_since is None:
+            _stale_since = time.time()
+        send_admin_alert(get_redis(), "key_registry_stale",
+                         f"Gemini key registry refresh failed, serving keys from {int(registry_age() or 0)}s ago: {e}")
+
+async def _refresh_loop():
+    while True:
+        await asyncio.sleep(KEY_REGISTRY_REFRESH_INTERVAL)
+        await asyncio.to_thread(refresh_registry)
+
+async def start_key_registry():
+    global _refresher
+    on_snapshot_change(lambda name, data: _update(data) if name == "keys" else None)
+    await asyncio.to_thread(refresh_registry)
+    _refresher = asyncio.create_task(_refresh_loop())
+
+def stop_key_registry():
+    if _refresher is not None:
+        _refresher.cancel()
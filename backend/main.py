@@ -1,182 +1,907 @@
 import uvicorn
-from fastapi import FastAPI, Request, Header
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, Request, Header, UploadFile, File, Form
+from fastapi.responses import JSONResponse, StreamingResponse, FileResponse, Response
+from starlette.concurrency import run_in_threadpool
 import uuid
 import datetime
+import json
 import os
-import requests
-from supabase_client import is_valid_user_api_key, list_keys
+from supabase_client import (is_valid_user_api_key, peek_user_api_key, cached_user_api_key_id, owner_scope,
+                             start_invalidation_listener)
+from backend.gemini_client import generate_content, open_stream, read_error, iter_sse_events, close_session
+from backend.rate_limit import acquire, record, region_limits, key_limits, model_limits, user_limits
+from backend.scheduler import KEY_COOLDOWN_BASE, rank_keys, report_result
+from backend.key_registry import get_registry, start_key_registry, stop_key_registry
+from backend.hedging import HEDGE_ENABLED, hedged_call, pick_hedge_key, hedge_stats
+from backend.usage import record_usage, flush_usage, start_usage_flusher, stop_usage_flusher
+from backend.tokens import count_tokens, count_message_tokens, usage_from_metadata
+from backend.response_cache import cache_requested, cache_key, get_cached, store as store_cached
+from backend.singleflight import flight_key, coalesce, coalesce_stream
+from backend.batches import (BATCH_QUEUE, BATCH_QUOTA_SHARE, BATCH_COMPLETION_WINDOWS, BATCH_ENDPOINT, save_upload, get_file,
+                             file_view, file_path, create_batch, get_batch, list_batches, batch_view, cancel_batch,
+                             process_batch, start_batch_recovery, stop_batch_recovery)
+from backend.jobs import (OVERFLOW_ENABLED, OVERFLOW_WAIT, QUEUE_NAMES, JOB_PRIORITIES, enqueue_completion,
+                          fetch_job, job_view, wait_for_result, cancel_job, announce_result, consume_queues,
+                          webhook_url_error)
+from backend.metrics import (COMPLETIONS_IN_FLIGHT, UPSTREAM_IN_FLIGHT, CIRCUIT_BREAKER_TRIPS, RedisStateCollector,
+                             register_state_collector, render_metrics, observe_upstream, observe_completion, track_stream)
+from backend.context_cache import (mark_prefix, for_key as cached_prefix_for_key, forget as forget_cached_prefix,
+                                   strip_prefix, cache_rejected)
+from backend.translation import translate_request, translate_messages
+from backend.conversations import CONVERSATION_SUMMARIZE, Conversation, conversation_requested
+from backend.upstream_errors import (RetryBudget, classify, retry_delay, upstream_failure, exception_failure,
+                                     report_auth_failure)
+from backend.circuit_breaker import admit as breaker_admits, release as release_breaker, record as record_breaker
+from backend.tracing import (setup_tracing, shutdown_tracing, server_span, stage, upstream_span, record_status,
+                             record_failure, annotate, add_event)
 import redis
-from rq import Queue
+from rq import get_current_job
+import asyncio
+import math
+import random
 import time
 import logging
 
 REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
 redis_conn = redis.from_url(REDIS_URL)
-queue = Queue("gemini_requests", connection=redis_conn)
+register_state_collector(RedisStateCollector(redis_conn, [*QUEUE_NAMES.values(), BATCH_QUEUE], hedge_stats))
 
-def log_usage(user_api_key, gemini_key_id, prompt_tokens, completion_tokens, total_tokens):
-    pass  # TODO: Implement usage logging
+def caller(user_api_key):
+    # Who a completion is billed and rate limited as. Queued jobs and batches carry this
+    # instead of the API key, since RQ workers never authenticate and must not hold it.
+    return {"id": cached_user_api_key_id(user_api_key), "scope": owner_scope(user_api_key)}
 
-def count_tokens(text):
-    return len(text.split())
+def log_usage(user, gemini_key_id, prompt_tokens, completion_tokens, total_tokens):
+    # Buffered; written to Supabase in batches by the usage flusher.
+    record_usage(user["id"], gemini_key_id, prompt_tokens, completion_tokens, total_tokens)
 
-def openai_error(message, code="invalid_request_error", status=400):
-    return JSONResponse(status_code=status, content={
+def error_body(message, code="invalid_request_error"):
+    return {
         "error": {
             "message": message,
             "type": code,
             "param": None,
             "code": code
         }
-    })
+    }
+
+def openai_error(message, code="invalid_request_error", status=400, headers=None):
+    return JSONResponse(status_code=status, headers=headers, content=error_body(message, code))
 
 app = FastAPI()
 
-RATE_LIMIT_PER_REGION = int(os.getenv("RATE_LIMIT_PER_REGION", 60))
+@app.on_event("startup")
+async def start_tracing():
+    setup_tracing("ggpt-backend")
 
-def current_minute():
-    return int(time.time() // 60)
+@app.on_event("startup")
+async def start_shared_state_listener():
+    start_invalidation_listener()
 
-def region_key(region):
-    return f"gemini_rate:{region}:{current_minute()}"
+@app.on_event("startup")
+async def start_key_refresher():
+    await start_key_registry()
 
-def can_send_request(region):
-    key = region_key(region)
-    count = redis_conn.get(key)
-    if count is None:
-        redis_conn.set(key, 1, ex=60)
-        return True
-    elif int(count) < RATE_LIMIT_PER_REGION:
-        redis_conn.incr(key)
-        return True
-    else:
-        return False
+@app.on_event("startup")
+async def start_usage_logging():
+    start_usage_flusher()
+
+@app.on_event("startup")
+async def start_batch_recovery_loop():
+    start_batch_recovery(redis_conn)
+
+@app.on_event("shutdown")
+async def stop_key_refresher():
+    stop_key_registry()
+
+@app.on_event("shutdown")
+async def stop_batch_recovery_loop():
+    stop_batch_recovery()
+
+@app.on_event("shutdown")
+async def shutdown_gemini_session():
+    await close_session()
+
+@app.on_event("shutdown")
+async def flush_usage_logging():
+    await stop_usage_flusher()
+
+@app.on_event("shutdown")
+async def flush_traces():
+    shutdown_tracing()
+
+def try_acquire(region, key=None, model_name=None, tokens=0, share=1.0):
+    # One atomic check-and-consume across the region, Gemini key and model budgets.
+    # share < 1 admits the call only while the windows are below that fraction of their limits.
+    # Returns (allowed, seconds until the blocking window frees up).
+    limits = region_limits(region, tokens)
+    if key is not None:
+        limits += key_limits(key, tokens)
+    if model_name is not None:
+        limits += model_limits(model_name, tokens)
+    if share < 1:
+        limits = [(name, max(1, int(limit * share)) if limit else limit, cost) for name, limit, cost in limits]
+    with stage("rate_limit"):
+        allowed, _, retry_after = acquire(redis_conn, limits)
+    return allowed, retry_after
+
+def can_send_request(region, key=None, model_name=None, tokens=0):
+    return try_acquire(region, key, model_name, tokens)[0]
+
+def record_completion_tokens(key, model_name, user, tokens):
+    # Completion tokens (and any prompt undercount) are only known afterwards, so they are
+    # added to the TPM windows unchecked.
+    record(redis_conn, region_limits(key["region"], tokens) + key_limits(key, tokens)
+           + model_limits(model_name, tokens) + user_limits(user["scope"], tokens))
+
+def completion_response(model, texts, prompt_tokens, completion_tokens, timing, finish_reasons=None):
+    return {
+        "id": f"chatcmpl-{uuid.uuid4().hex[:16]}",
+        "object": "chat.completion",
+        "created": int(datetime.datetime.now().timestamp()),
+        "model": model,
+        "choices": [
+            {
+                "index": i,
+                "message": {"role": "assistant", "content": text},
+                "finish_reason": finish_reasons[i] if finish_reasons else "stop"
+            }
+            for i, text in enumerate(texts)
+        ],
+        "usage": {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens
+        },
+        "timing": timing
+    }
 
-def gemini_worker(payload, region, api_key, model_name):
-    url = f"https://generativelanguage.googleapis.com/v1/models/{model_name}:generateContent?key={api_key}"
-    # logging.warning(f"[DEBUG] Gemini API call: url={url}")
+async def gemini_worker(payload, region, api_key, model_name):
     # logging.warning(f"[DEBUG] Payload: {payload}")
     # logging.warning(f"[DEBUG] Model: {model_name}")
     # logging.warning(f"[DEBUG] API key: {api_key[:6]}{'*' * (len(api_key)-6)}")
-    resp = requests.post(url, json=payload, timeout=60)
-    # logging.warning(f"[DEBUG] Raw Gemini API response: {resp.text}")
+    return await generate_content(payload, api_key, model_name)
+
+def report_upstream(key, model_name, status_code, duration, gemini_data=None):
+    kind = classify(status_code, gemini_data) if status_code != 200 else None
+    report_result(redis_conn, key, status_code, duration, kind == "client",
+                  retry_delay(gemini_data) if status_code == 429 else None)
+    try:
+        for scope in record_breaker(redis_conn, key, kind == "transient", duration):
+            CIRCUIT_BREAKER_TRIPS.labels(scope).inc()
+            logging.warning(f"Circuit breaker for {scope} opened")
+    except redis.RedisError as e:
+        logging.warning(f"Circuit breaker state could not be updated: {e}")
+    observe_upstream(key, model_name, status_code, duration)
+
+async def timed_gemini_call(payload, key, model, timeout=None):
+    model_name = key.get("model_name", model)
+    send, cache_slot = cached_prefix_for_key(redis_conn, payload, key, model_name)
+    gemini_data, status_code = await send_gemini_call(send, key, model_name, timeout)
+    if cache_slot is not None and cache_rejected(status_code, gemini_data):
+        # The cached prefix vanished upstream; resend in full on the same key.
+        forget_cached_prefix(redis_conn, cache_slot)
+        gemini_data, status_code = await send_gemini_call(strip_prefix(payload), key, model_name, timeout)
+    return gemini_data, status_code
+
+async def send_gemini_call(payload, key, model_name, timeout=None):
+    with upstream_span("gemini.generate_content", key, model_name) as span:
+        api_start = time.time()
+        try:
+            with UPSTREAM_IN_FLIGHT.track_inprogress():
+                gemini_data, status_code = await asyncio.wait_for(
+                    gemini_worker(payload, key["region"], key["api_key"], model_name), timeout)
+        except Exception:
+            report_upstream(key, model_name, None, time.time() - api_start)
+            raise
+        report_upstream(key, model_name, status_code, time.time() - api_start, gemini_data)
+        record_status(span, status_code)
+    return gemini_data, status_code
+
+# --- Streaming (stream: true) ---
+FINISH_REASONS = {"STOP": "stop", "MAX_TOKENS": "length", "SAFETY": "content_filter", "RECITATION": "content_filter"}
+
+def sse_event(data):
+    return f"data: {json.dumps(data)}\n\n"
+
+async def open_gemini_stream(gemini_keys, payload, model, prompt_tokens, budget):
+    # Same key walk as the non-streaming path, but only until response headers arrive.
+    # Returns (resp, key, failure, retry_after); retry_after is None unless a key was over budget.
+    failure = None
+    retry_after = None
+    for key in gemini_keys:
+        if not budget.allows():
+            add_event("retry_budget_exhausted", failure=str(failure))
+            break
+        region = key["region"]
+        model_name = key.get("model_name", model)
+        if not breaker_admits(redis_conn, key):
+            add_event("key_skipped", key=key["name"], region=region, reason="circuit_open")
+            continue
+        allowed, wait = try_acquire(region, key, model_name, prompt_tokens)
+        if not allowed:
+            release_breaker(redis_conn, key)
+            add_event("key_skipped", key=key["name"], region=region, reason="over_budget", retry_after=wait)
+            retry_after = wait if retry_after is None else min(retry_after, wait)
+            continue
+        if failure is not None and failure.kind == "transient":
+            await budget.backoff()
+        budget.spend()
+        send, cache_slot = cached_prefix_for_key(redis_conn, payload, key, model_name)
+        while True:
+            resp, gemini_data, error = await send_gemini_stream(send, key, model_name, budget.remaining())
+            if error is not None:
+                failure = exception_failure(error)
+                break
+            if resp.status == 200:
+                return resp, key, None, None
+            failure = upstream_failure(resp.status, gemini_data)
+            if cache_slot is None or not cache_rejected(resp.status, gemini_data):
+                break
+            # The cached prefix vanished upstream; resend in full on the same key.
+            forget_cached_prefix(redis_conn, cache_slot)
+            send, cache_slot = strip_prefix(payload), None
+        if not upstream_failed(key, failure):
+            break
+    return None, None, failure, retry_after
+
+def upstream_failed(key, failure):
+    # Returns whether another key may still succeed.
+    attributes = {"key": key["name"], "kind": failure.kind}
+    if failure.status is not None:
+        attributes["status"] = failure.status
+    else:
+        # OpenTelemetry drops None values; name the timeout or connection error instead.
+        attributes["error.type"] = failure.error_type or "_OTHER"
+    add_event("upstream_failed", **attributes)
+    if failure.kind == "auth":
+        report_auth_failure(redis_conn, key, failure)
+    return failure.kind != "client"
+
+def upstream_error(failure):
+    # Returns (message, code, status, headers) for the last failure of a key walk. Only a
+    # request Gemini rejected is the client's error, and it keeps Gemini's status.
+    if failure is None:
+        return "No Gemini API key could take the request", "server_error", 503, None
+    if failure.kind == "client":
+        return f"Gemini rejected the request: {failure}", "invalid_request_error", failure.status, None
+    if failure.kind == "quota":
+        return ("All Gemini API keys are rate limited upstream", "rate_limit_exceeded", 429,
+                {"Retry-After": str(max(1, math.ceil(failure.retry_after or KEY_COOLDOWN_BASE)))})
+    if failure.kind == "transient":
+        return f"Gemini API error: {failure}", "server_error", 502, None
+    return f"No Gemini API key could take the request: {failure}", "server_error", 503, None
+
+async def send_gemini_stream(payload, key, model_name, timeout):
+    # Returns (resp, None, None) once headers arrive, (resp, error_body, None) for an error
+    # status (resp already released), or (None, None, exception).
+    with upstream_span("gemini.stream_generate_content", key, model_name) as span:
+        api_start = time.time()
+        try:
+            with UPSTREAM_IN_FLIGHT.track_inprogress():
+                resp = await asyncio.wait_for(open_stream(payload, key["api_key"], model_name), timeout)
+        except Exception as e:
+            report_upstream(key, model_name, None, time.time() - api_start)
+            record_failure(span, e)
+            return None, None, e
+        # The error body says whether and how long to cool the key down.
+        gemini_data = await read_error(resp) if resp.status != 200 else None
+        report_upstream(key, model_name, resp.status, time.time() - api_start, gemini_data)
+        record_status(span, resp.status)
+    return resp, gemini_data, None
+
+async def stream_chunks(resp, key, model, user, prompt_tokens, on_reply=None):
+    completion_id = f"chatcmpl-{uuid.uuid4().hex[:16]}"
+    created = int(datetime.datetime.now().timestamp())
+
+    def chunk(delta, finish_reason=None):
+        return sse_event({
+            "id": completion_id,
+            "object": "chat.completion.chunk",
+            "created": created,
+            "model": model,
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]
+        })
+
+    completion_tokens = 0
+    usage_metadata = None
+    finish_reason = "stop"
+    reply = [] if on_reply is not None else None  # only kept when a conversation stores it
     try:
-        return resp.json(), resp.status_code
+        try:
+            yield chunk({"role": "assistant", "content": ""})
+            async for event in iter_sse_events(resp):
+                candidate = (event.get("candidates") or [{}])[0]
+                for part in candidate.get("content", {}).get("parts", []):
+                    text = part.get("text")
+                    if text:
+                        completion_tokens += count_tokens(text)
+                        if reply is not None:
+                            reply.append(text)
+                        yield chunk({"content": text})
+                if candidate.get("finishReason"):
+                    finish_reason = FINISH_REASONS.get(candidate["finishReason"], "stop")
+                # Cumulative counts; the final event carries the totals.
+                usage_metadata = event.get("usageMetadata") or usage_metadata
+        except Exception as e:
+            # Headers are already sent, so a mid-stream failure can only be reported in-band.
+            yield sse_event({"error": {"message": f"Gemini API error: {e}", "type": "server_error", "param": None, "code": "server_error"}})
+            finish_reason = None
+        finally:
+            resp.release()
+        if finish_reason is not None:
+            yield chunk({}, finish_reason)
+    finally:
+        # Also runs when the client disconnects: what was streamed so far is billed and
+        # counts against TPM.
+        prompt_estimate = prompt_tokens
+        prompt_tokens, completion_tokens = usage_from_metadata(usage_metadata, prompt_estimate, completion_tokens)
+        record_completion_tokens(key, key.get("model_name", model), user,
+                                 completion_tokens + max(0, prompt_tokens - prompt_estimate))
+        log_usage(user, key["id"], prompt_tokens, completion_tokens, prompt_tokens + completion_tokens)
+    if on_reply is not None and finish_reason is not None:
+        on_reply("".join(reply))
+    yield "data: [DONE]\n\n"
+
+STREAM_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+async def admit_and_rank(user, prompt_tokens):
+    # Returns (ranked_keys, retry_after, None), or (None, None, error_response) when the request
+    # can't go upstream. With overflow on, every key cooling down is handled like every key
+    # being over budget: ranked_keys is empty and retry_after is when the first one is back.
+    with stage("rate_limit", scope="user"):
+        allowed, _, retry_after = acquire(redis_conn, user_limits(user["scope"], prompt_tokens))
+    if not allowed:
+        return None, None, openai_error("Rate limit exceeded for this API key", "rate_limit_exceeded", 429,
+                                        headers={"Retry-After": str(max(1, int(retry_after)))})
+    registry = get_registry()
+    keys = registry["active"]
+    if not keys:
+        return None, None, openai_error("No active Gemini API keys configured", status=500)
+    with stage("key_selection", active_keys=len(keys)):
+        gemini_keys, retry_after = rank_keys(redis_conn, registry)
+        # Keys left out are cooling down after a 429 or behind an open circuit breaker.
+        add_event("keys_ranked", available=len(gemini_keys), cooling_down=len(keys) - len(gemini_keys))
+    if not gemini_keys and not OVERFLOW_ENABLED:
+        return None, None, openai_error("All Gemini API keys are cooling down after rate limiting or errors",
+                                        "rate_limit_exceeded", 429,
+                                        headers={"Retry-After": str(max(1, math.ceil(retry_after)))})
+    return gemini_keys, retry_after or None, None
+
+async def start_completion_stream(gemini_payload, model, user, prompt_tokens, on_reply=None):
+    # Returns (error_response, None) or (None, sse_chunk_iterator). Streams can't go through
+    # the job queue, so while every key is over budget they wait here, up to OVERFLOW_WAIT.
+    gemini_keys, retry_after, error = await admit_and_rank(user, prompt_tokens)
+    if error is not None:
+        return error, None
+    deadline = time.time() + OVERFLOW_WAIT
+    budget = RetryBudget()
+    failure = None
+    while True:
+        if gemini_keys:
+            resp, key, failure, retry_after = await open_gemini_stream(gemini_keys, gemini_payload, model,
+                                                                       prompt_tokens, budget)
+            if resp is not None:
+                return None, stream_chunks(resp, key, model, user, prompt_tokens, on_reply)
+        if retry_after is None or not OVERFLOW_ENABLED or not budget.allows() or (failure and failure.kind == "client"):
+            break
+        if time.time() + retry_after > deadline:
+            return quota_exhausted_error(retry_after), None
+        await asyncio.sleep(retry_after)
+        gemini_keys, retry_after = rank_keys(redis_conn, get_registry())
+    return openai_error(*upstream_error(failure)), None
+
+def quota_exhausted_error(retry_after):
+    return openai_error("All Gemini API keys are over their rate limits", "rate_limit_exceeded", 429,
+                        headers={"Retry-After": str(max(1, math.ceil(retry_after)))})
+
+async def call_gemini_keys(gemini_keys, gemini_payload, model, prompt_tokens, share=1.0, budget=None):
+    # Tries each key that has budget, best first, until one answers, the request itself is
+    # rejected, or the retry budget runs out.
+    # Returns (gemini_data, used_key, api_duration, failure, retry_after); failure is the
+    # last UpstreamFailure, retry_after is None unless at least one key was skipped for
+    # being over budget.
+    budget = budget or RetryBudget()
+    failure = None
+    api_duration = None
+    retry_after = None
+    hedged_key_ids = set()
+
+    for key in gemini_keys:
+        if not budget.allows():
+            add_event("retry_budget_exhausted", failure=str(failure))
+            break
+        if key["id"] in hedged_key_ids:
+            add_event("key_skipped", key=key["name"], region=key["region"], reason="already_tried_as_hedge")
+            continue
+        region = key["region"]
+        model_name = key.get("model_name", model)
+        # The breaker goes first, so a key it keeps out doesn't use up a rate-limit slot.
+        if not breaker_admits(redis_conn, key):
+            add_event("key_skipped", key=key["name"], region=region, reason="circuit_open")
+            continue
+        allowed, wait = try_acquire(region, key, model_name, prompt_tokens, share)
+        if not allowed:
+            release_breaker(redis_conn, key)
+            add_event("key_skipped", key=key["name"], region=region, reason="over_budget", retry_after=wait)
+            retry_after = wait if retry_after is None else min(retry_after, wait)
+            continue
+        if failure is not None and failure.kind == "transient":
+            await budget.backoff()
+        try:
+            api_start = time.time()
+            budget.spend()
+            # Background work (share < 1) is about throughput, so it never hedges.
+            hedge_key = pick_hedge_key(gemini_keys, key, get_registry()) if HEDGE_ENABLED and share == 1 and key is gemini_keys[0] else None
+            if hedge_key is not None:
+                key, gemini_data, status_code, hedge_used = await hedged_call(
+                    redis_conn, key, hedge_key,
+                    lambda k: timed_gemini_call(gemini_payload, k, model, budget.remaining()),
+                    lambda: can_send_request(hedge_key["region"], hedge_key, hedge_key.get("model_name", model), prompt_tokens)
+                )
+                if hedge_used:
+                    hedged_key_ids.add(hedge_key["id"])
+                    budget.spend()
+            else:
+                gemini_data, status_code = await timed_gemini_call(gemini_payload, key, model, budget.remaining())
+            api_duration = time.time() - api_start
+            if status_code == 200:
+                return gemini_data, key, api_duration, None, None
+            failure = upstream_failure(status_code, gemini_data)
+        except Exception as e:
+            failure = exception_failure(e)
+        if not upstream_failed(key, failure):
+            break
+    return None, None, api_duration, failure, retry_after
+
+def candidate_text(candidate):
+    return "".join(part.get("text", "") for part in candidate.get("content", {}).get("parts", []))
+
+def finish_completion(gemini_data, used_key, model, user, prompt_tokens, response_cache_key, timing):
+    # A blocked prompt comes back without candidates.
+    candidates = gemini_data.get("candidates") or [{"finishReason": "SAFETY"}]
+    texts = [candidate_text(c) for c in candidates]
+    finish_reasons = [FINISH_REASONS.get(c.get("finishReason"), "stop") for c in candidates]
+    prompt_estimate = prompt_tokens
+    prompt_tokens, completion_tokens = usage_from_metadata(gemini_data.get("usageMetadata"), prompt_estimate,
+                                                           sum(count_tokens(text) for text in texts))
+    total_tokens = prompt_tokens + completion_tokens
+
+    record_completion_tokens(used_key, used_key.get("model_name", model), user,
+                             completion_tokens + max(0, prompt_tokens - prompt_estimate))
+    log_usage(user, used_key["id"], prompt_tokens, completion_tokens, total_tokens)
+
+    # Blocked, empty or cut-off answers are not kept: a replay would present them as complete.
+    if response_cache_key is not None and finish_reasons[0] == "stop" and texts[0]:
+        store_cached(redis_conn, response_cache_key, {
+            "content": texts[0],
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens
+        })
+    return completion_response(model, texts, prompt_tokens, completion_tokens, timing, finish_reasons)
+
+def queued_request(gemini_payload, model, user, prompt_tokens, response_cache_key):
+    return {
+        "payload": gemini_payload,
+        "model": model,
+        "user": user,
+        "prompt_tokens": prompt_tokens,
+        "response_cache_key": response_cache_key
+    }
+
+async def run_completion(gemini_payload, model, user, prompt_tokens, response_cache_key, start_time, on_reply=None):
+    gemini_keys, retry_after, error = await admit_and_rank(user, prompt_tokens)
+    if error is not None:
+        return error
+
+    budget = RetryBudget()
+    gemini_data, used_key, api_duration, failure = None, None, None, None
+    if gemini_keys:
+        gemini_data, used_key, api_duration, failure, retry_after = await call_gemini_keys(
+            gemini_keys, gemini_payload, model, prompt_tokens, budget=budget)
+    rejected = failure is not None and failure.kind == "client"
+
+    if used_key is None and retry_after is not None and OVERFLOW_ENABLED and budget.allows() and not rejected:
+        # Every key with capacity failed or none had any: wait in the admission queue.
+        job = enqueue_completion(redis_conn, queued_request(gemini_payload, model, user, prompt_tokens,
+                                                            response_cache_key),
+                                 user["scope"], priority="high", ttl=OVERFLOW_WAIT, result_ttl=int(OVERFLOW_WAIT))
+        result = await wait_for_result(redis_conn, job, OVERFLOW_WAIT)
+        if result is None:
+            cancel_job(redis_conn, job)
+            return quota_exhausted_error(retry_after)
+        if on_reply is not None and result["status"] == 200:
+            on_reply(result["body"]["choices"][0]["message"]["content"])
+        return JSONResponse(status_code=result["status"], content=result["body"])
+
+    total_duration = time.time() - start_time
+
+    if used_key is None:
+        if retry_after is not None and not rejected:
+            return quota_exhausted_error(retry_after)
+        return openai_error(*upstream_error(failure))
+
+    completion = finish_completion(gemini_data, used_key, model, user, prompt_tokens, response_cache_key, {
+        "total": round(total_duration, 2),
+        "api": round(api_duration, 2) if api_duration is not None else None
+    })
+    if on_reply is not None:
+        on_reply(completion["choices"][0]["message"]["content"])
+    with stage("serialization"):
+        return JSONResponse(completion)
+
+# --- Queued completions (drained by backend/overflow_worker.py) ---
+
+async def consume_queued_completions(stop):
+    # Runs for as long as the service, so keys and usage are kept up to date as in the API.
+    await start_key_registry()
+    start_usage_flusher()
+    try:
+        await consume_queues(redis_conn, complete_when_admitted, stop)
+    finally:
+        stop_key_registry()
+        await stop_usage_flusher()
+        await close_session()
+
+def run_queued_completion(request):
+    # The RQ job function, so a plain `rq worker` can still drain the queues one job at a time.
+    return asyncio.run(drain_queued_completion(request))
+
+async def drain_queued_completion(request):
+    job = get_current_job()
+    try:
+        result = await complete_when_admitted(request)
+        if job is not None:
+            await announce_result(redis_conn, job, result)
+        return result
+    finally:
+        await flush_usage()
+        await close_session()
+
+async def complete_when_admitted(request):
+    # Waits for budget exactly as the shared limiter allows, then calls Gemini once.
+    # Returns {"status": http_status, "body": completion_or_error}.
+    start_time = time.time()
+    # One retry budget for the whole wait: waiting for quota spends none of it.
+    budget = RetryBudget(deadline=request["deadline"] - start_time)
+    while True:
+        remaining = request["deadline"] - time.time()
+        if remaining <= 0:
+            return {"status": 429, "body": error_body("Queued request expired before Gemini quota was available",
+                                                      "rate_limit_exceeded")}
+        registry = get_registry()
+        if not registry["active"]:
+            return {"status": 500, "body": error_body("No active Gemini API keys configured")}
+        gemini_keys, retry_after = rank_keys(redis_conn, registry)
+        if gemini_keys:
+            gemini_data, used_key, api_duration, failure, retry_after = await call_gemini_keys(
+                gemini_keys, request["payload"], request["model"], request["prompt_tokens"], request.get("share", 1.0),
+                budget)
+            if used_key is not None:
+                return {"status": 200, "body": finish_completion(
+                    gemini_data, used_key, request["model"], request["user"], request["prompt_tokens"],
+                    request["response_cache_key"],
+                    {"total": round(time.time() - start_time, 2), "api": round(api_duration, 2), "queued": True})}
+            if retry_after is None or not budget.allows() or (failure and failure.kind == "client"):
+                message, code, status, _ = upstream_error(failure)
+                return {"status": status, "body": error_body(message, code)}
+        # Small jitter so workers blocked on the same window don't all wake at once.
+        await asyncio.sleep(min(max(retry_after, 0.05) * random.uniform(1, 1.1), remaining))
+
+# --- Batches (runner inside an RQ worker) ---
+
+def run_batch(batch_id):
+    return asyncio.run(drain_batch(batch_id))
+
+async def drain_batch(batch_id):
+    # A batch runs for hours, so usage is flushed as it goes, as in the API workers: a
+    # worker that dies mid-batch loses at most one flush window of it.
+    start_usage_flusher()
+    try:
+        return await process_batch(redis_conn, batch_id, complete_batch_request)
+    finally:
+        await stop_usage_flusher()
+        await close_session()
+
+async def complete_batch_request(body, user, deadline):
+    try:
+        gemini_payload, _ = translate_request(body)
+    except ValueError as e:
+        return {"status": 400, "body": error_body(str(e))}
+    model = body.get("model", "gemini-1.5-pro")
+    request = queued_request(gemini_payload, model, user, count_message_tokens(body["messages"]), None)
+    return await complete_when_admitted({**request, "deadline": deadline, "share": BATCH_QUOTA_SHARE})
+
+# --- Conversations (X-Conversation-Id) ---
+_summary_tasks = set()
+
+def remember_reply(conversation, user_message, user, model):
+    # on_reply callback: stores the exchange, summarizing what falls out of the history.
+    def on_reply(reply):
+        dropped = conversation.append(user_message, reply)
+        if dropped and CONVERSATION_SUMMARIZE:
+            task = asyncio.ensure_future(summarize_conversation(conversation, dropped, user, model))
+            _summary_tasks.add(task)
+            task.add_done_callback(_summary_tasks.discard)
+    return on_reply
+
+async def summarize_conversation(conversation, dropped, user, model):
+    # Background work: runs on the batch quota share and is billed to the conversation's key.
+    messages = conversation.summary_request(dropped)
+    prompt_tokens = count_message_tokens(messages)
+    try:
+        gemini_keys, _ = rank_keys(redis_conn, get_registry())
+        gemini_data, used_key, _, failure, _ = await call_gemini_keys(
+            gemini_keys, translate_messages(messages)[0], model, prompt_tokens, BATCH_QUOTA_SHARE)
+        if used_key is None:
+            logging.warning(f"Conversation {conversation.id} not summarized: {failure or 'no quota'}")
+            return
+        completion = finish_completion(gemini_data, used_key, model, user, prompt_tokens, None, {})
+        conversation.store_summary(completion["choices"][0]["message"]["content"])
     except Exception as e:
-        return {"error": {"message": str(e)}}, 500
+        logging.warning(f"Conversation {conversation.id} not summarized: {e}")
+
+async def authenticate(authorization):
+    # Returns (user_api_key, None) or (None, error_response).
+    if not authorization or not authorization.startswith("Bearer "):
+        return None, openai_error("Missing or invalid Authorization header", "invalid_api_key", 401)
+    user_api_key = authorization.split(" ", 1)[1]
+    valid = peek_user_api_key(user_api_key)
+    if valid is None:
+        # Cache miss: keep the Supabase round trip off the event loop.
+        valid = await run_in_threadpool(is_valid_user_api_key, user_api_key)
+    if not valid:
+        return None, openai_error("Invalid API key", "invalid_api_key", 401)
+    return user_api_key, None
 
 @app.post("/v1/chat/completions")
 async def chat_completions(request: Request, authorization: str = Header(None)):
     start_time = time.time()
-    # logging.warning(f"[TIMING] chat_completions start: {start_time}")
-    if not authorization or not authorization.startswith("Bearer "):
-        return openai_error("Missing or invalid Authorization header", "invalid_api_key", 401)
-    user_api_key = authorization.split(" ", 1)[1]
-    if not is_valid_user_api_key(user_api_key):
-        return openai_error("Invalid API key", "invalid_api_key", 401)
+    with server_span("chat.completions", request.headers) as span, COMPLETIONS_IN_FLIGHT.track_inprogress():
+        response = await handle_chat_completion(request, authorization, start_time)
+        record_status(span, getattr(response, "status_code", 200))
+    observe_completion(response, time.time() - start_time)
+    return response
+
+async def handle_chat_completion(request, authorization, start_time):
+    with stage("auth"):
+        user_api_key, error = await authenticate(authorization)
+    if error is not None:
+        return error
 
     try:
         body = await request.json()
         messages = body["messages"]
         model = body.get("model", "gemini-1.5-pro")
-        temperature = body.get("temperature", 0.7)
-        max_tokens = body.get("max_tokens", 1024)
+        stream = bool(body.get("stream", False))
     except Exception:
         return openai_error("Malformed request body", status=400)
+    annotate(**{"gen_ai.request.model": model, "stream": stream})
+    user = caller(user_api_key)
 
-    gemini_keys = [k for k in list_keys() if k["active"]]
-    if not gemini_keys:
-        return openai_error("No active Gemini API keys configured", status=500)
+    # Everything before the new message is the client's fixed prefix (e.g. a bot's base prompt).
+    prefix_count = len(messages) - 1 if isinstance(messages, list) else 0
 
-    gemini_payload = {
-        "contents": [
-            {
-                "role": m["role"],
-                "parts": [{"text": m["content"]}]
-            }
-            for m in messages if "content" in m
-        ]
-    }
+    # Stateful requests are never cached or coalesced: each one extends its history.
+    on_reply = None
+    conversation_id = conversation_requested(request.headers)
+    if conversation_id is not None:
+        try:
+            conversation = Conversation(redis_conn, user_api_key, conversation_id)
+            conversation.load()
+            full_messages = conversation.messages(messages)
+        except ValueError as e:
+            return openai_error(str(e), status=400)
+        on_reply = remember_reply(conversation, messages[-1]["content"], user, model)
+        messages = full_messages
 
-    gemini_text = None
-    used_key_id = None
-    last_error = None
-    api_duration = None
+    # Rejected here rather than by Gemini, before any quota is spent.
+    try:
+        gemini_payload, prefix_length = translate_request(body, messages, prefix_count)
+    except ValueError as e:
+        return openai_error(str(e), status=400)
+    generation_config = gemini_payload.get("generationConfig", {})
 
-    for key in gemini_keys:
-        region = key["region"]
-        model_name = key.get("model_name", model)
-        # logging.warning(f"[DEBUG] Using model: {model_name} for region: {region}")
-        if can_send_request(region):
-            try:
-                api_start = time.time()
-                gemini_data, status_code = gemini_worker(gemini_payload, region, key["api_key"], model_name)
-                api_end = time.time()
-                api_duration = api_end - api_start
-                # logging.warning(f"[TIMING] Gemini API call took {api_end - api_start:.2f} seconds")
-                if status_code == 200:
-                    gemini_text = gemini_data["candidates"][0]["content"]["parts"][0]["text"]
-                    used_key_id = key["id"]
-                    break
-                elif status_code in (429, 403):
-                    last_error = gemini_data.get("error", {}).get("message", "Gemini API error")
-                    continue
-                else:
-                    last_error = gemini_data.get("error", {}).get("message", "Gemini API error")
-            except Exception as e:
-                last_error = str(e)
-                continue
-        else:
-            api_start = time.time()
-            # logging.warning(f"[DEBUG] Skipping queue fallback; making direct Gemini API call for {region}")
-            gemini_data, status_code = gemini_worker(gemini_payload, region, key["api_key"], model_name)
-            api_end = time.time()
-            api_duration = api_end - api_start
-            # logging.warning(f"[TIMING] Gemini API call (fallback) took {api_end - api_start:.2f} seconds")
-            if status_code == 200:
-                gemini_text = gemini_data["candidates"][0]["content"]["parts"][0]["text"]
-                used_key_id = key["id"]
-                break
-            else:
-                last_error = gemini_data.get("error", {}).get("message", "Gemini API error")
-    end_time = time.time()
-    total_duration = end_time - start_time
-    # logging.warning(f"[TIMING] chat_completions total time: {end_time - start_time:.2f} seconds")
+    response_cache_key = None
+    if on_reply is None and generation_config.get("candidateCount", 1) == 1 \
+            and cache_requested(request.headers, stream, generation_config.get("temperature")):
+        with stage("cache_lookup"):
+            response_cache_key = cache_key(user_api_key, messages, model, generation_config)
+            cached = get_cached(redis_conn, response_cache_key)
+        if cached is not None:
+            # Served without touching Gemini or any quota.
+            return JSONResponse(completion_response(model, [cached["content"]], cached["prompt_tokens"],
+                                                    cached["completion_tokens"],
+                                                    {"total": round(time.time() - start_time, 4), "api": None, "cached": True}))
 
-    if gemini_text is None:
-        return openai_error(f"Gemini API error: {last_error}", status=500)
+    # Local estimate for admission; replaced by Gemini's usageMetadata once the answer is in.
+    prompt_tokens = count_message_tokens(messages)
 
-    prompt_text = " ".join([m["content"] for m in messages if "content" in m])
-    prompt_tokens = count_tokens(prompt_text)
-    completion_tokens = count_tokens(gemini_text)
-    total_tokens = prompt_tokens + completion_tokens
+    mark_prefix(gemini_payload, prefix_length, count_message_tokens(messages[:prefix_count], prefix_count))
 
-    log_usage(user_api_key, used_key_id, prompt_tokens, completion_tokens, total_tokens)
+    # Identical requests already in flight share one upstream call (and one quota unit).
+    shared_key = None
+    if on_reply is None:
+        shared_key = flight_key(request.headers, user_api_key, messages, model, generation_config, stream)
 
-    openai_response = {
-        "id": f"chatcmpl-{uuid.uuid4().hex[:16]}",
-        "object": "chat.completion",
-        "created": int(datetime.datetime.now().timestamp()),
-        "model": model,
-        "choices": [
-            {
-                "index": 0,
-                "message": {"role": "assistant", "content": gemini_text},
-                "finish_reason": "stop"
-            }
-        ],
-        "usage": {
-            "prompt_tokens": prompt_tokens,
-            "completion_tokens": completion_tokens,
-            "total_tokens": total_tokens
-        },
-        "timing": {
-            "total": round(total_duration, 2),
-            "api": round(api_duration, 2) if api_duration is not None else None
-        }
+    if stream:
+        open_fn = lambda: start_completion_stream(gemini_payload, model, user, prompt_tokens, on_reply)
+        error, chunks = await (coalesce_stream(shared_key, open_fn) if shared_key else open_fn())
+        if error is not None:
+            return error
+        # X-Accel-Buffering stops nginx from holding chunks back until the response ends.
+        return StreamingResponse(track_stream(chunks), media_type="text/event-stream", headers=STREAM_HEADERS)
+
+    run_fn = lambda: run_completion(gemini_payload, model, user, prompt_tokens, response_cache_key, start_time,
+                                    on_reply)
+    return await (coalesce(shared_key, run_fn) if shared_key else run_fn())
+
+@app.delete("/v1/conversations/{conversation_id}")
+async def delete_conversation(conversation_id: str, authorization: str = Header(None)):
+    user_api_key, error = await authenticate(authorization)
+    if error is not None:
+        return error
+    try:
+        Conversation(redis_conn, user_api_key, conversation_id).clear()
+    except ValueError as e:
+        return openai_error(str(e), status=400)
+    return {"id": conversation_id, "object": "conversation.deleted", "deleted": True}
+
+# --- Async jobs: submit a chat completion, then poll or receive a webhook ---
+@app.post("/v1/jobs")
+async def submit_job(request: Request, authorization: str = Header(None)):
+    user_api_key, error = await authenticate(authorization)
+    if error is not None:
+        return error
+    try:
+        body = await request.json()
+        messages = body["messages"]
+        model = body.get("model", "gemini-1.5-pro")
+        priority = body.get("priority", "normal")
+        webhook_url = body.get("webhook_url")
+    except Exception:
+        return openai_error("Malformed request body", status=400)
+    if priority not in JOB_PRIORITIES:
+        return openai_error(f"priority must be one of {', '.join(JOB_PRIORITIES)}", status=400)
+    if body.get("stream"):
+        return openai_error("Jobs cannot be streamed", status=400)
+    if webhook_url is not None:
+        error = await webhook_url_error(webhook_url)
+        if error is not None:
+            return openai_error(error, status=400)
+    try:
+        gemini_payload, _ = translate_request(body)
+    except ValueError as e:
+        return openai_error(str(e), status=400)
+
+    prompt_tokens = count_message_tokens(messages)
+    user = caller(user_api_key)
+    allowed, _, retry_after = acquire(redis_conn, user_limits(user["scope"], prompt_tokens))
+    if not allowed:
+        return openai_error("Rate limit exceeded for this API key", "rate_limit_exceeded", 429,
+                            headers={"Retry-After": str(max(1, int(retry_after)))})
+    job = enqueue_completion(redis_conn, queued_request(gemini_payload, model, user, prompt_tokens, None),
+                             user["scope"], priority=priority, webhook_url=webhook_url)
+    return JSONResponse(status_code=202, content=job_view(job))
+
+@app.get("/v1/jobs/{job_id}")
+async def get_job(job_id: str, authorization: str = Header(None)):
+    user_api_key, error = await authenticate(authorization)
+    if error is not None:
+        return error
+    job = fetch_job(redis_conn, job_id, user_api_key)
+    if job is None:
+        return openai_error("No such job", "not_found", 404)
+    return job_view(job)
+
+@app.delete("/v1/jobs/{job_id}")
+async def delete_job(job_id: str, authorization: str = Header(None)):
+    user_api_key, error = await authenticate(authorization)
+    if error is not None:
+        return error
+    job = fetch_job(redis_conn, job_id, user_api_key)
+    if job is None:
+        return openai_error("No such job", "not_found", 404)
+    if not cancel_job(redis_conn, job):
+        return openai_error("Job has already started and can no longer be cancelled", status=409)
+    return job_view(job)
+
+# --- Batch API: upload a JSONL of chat requests, run it, download the results ---
+@app.post("/v1/files")
+async def upload_file(file: UploadFile = File(...), purpose: str = Form(...), authorization: str = Header(None)):
+    user_api_key, error = await authenticate(authorization)
+    if error is not None:
+        return error
+    if purpose != "batch":
+        return openai_error("Only purpose=batch is supported", status=400)
+    meta, error = await save_upload(redis_conn, user_api_key, file, purpose)
+    if error is not None:
+        return openai_error(error, status=413)
+    return file_view(meta)
+
+@app.get("/v1/files/{file_id}")
+async def retrieve_file(file_id: str, authorization: str = Header(None)):
+    user_api_key, error = await authenticate(authorization)
+    if error is not None:
+        return error
+    meta = get_file(redis_conn, file_id, user_api_key)
+    if meta is None:
+        return openai_error("No such file", "not_found", 404)
+    return file_view(meta)
+
+@app.get("/v1/files/{file_id}/content")
+async def retrieve_file_content(file_id: str, authorization: str = Header(None)):
+    user_api_key, error = await authenticate(authorization)
+    if error is not None:
+        return error
+    meta = get_file(redis_conn, file_id, user_api_key)
+    if meta is None:
+        return openai_error("No such file", "not_found", 404)
+    # Batch output is appended as requests finish, so this can be read while the batch runs.
+    return FileResponse(file_path(file_id), media_type="application/jsonl")
+
+@app.post("/v1/batches")
+async def create_batch_endpoint(request: Request, authorization: str = Header(None)):
+    user_api_key, error = await authenticate(authorization)
+    if error is not None:
+        return error
+    try:
+        body = await request.json()
+        input_file_id = body["input_file_id"]
+        endpoint = body.get("endpoint", BATCH_ENDPOINT)
+        completion_window = body.get("completion_window", "24h")
+        metadata = body.get("metadata")
+    except Exception:
+        return openai_error("Malformed request body", status=400)
+    if endpoint != BATCH_ENDPOINT:
+        return openai_error(f"Only {BATCH_ENDPOINT} is supported", status=400)
+    if completion_window not in BATCH_COMPLETION_WINDOWS:
+        return openai_error(f"completion_window must be one of {', '.join(BATCH_COMPLETION_WINDOWS)}", status=400)
+    if get_file(redis_conn, input_file_id, user_api_key) is None:
+        return openai_error("No such file", "not_found", 404)
+    return batch_view(create_batch(redis_conn, caller(user_api_key), input_file_id, completion_window, metadata))
+
+@app.get("/v1/batches")
+async def list_batches_endpoint(limit: int = 20, after: str = None, authorization: str = Header(None)):
+    user_api_key, error = await authenticate(authorization)
+    if error is not None:
+        return error
+    batches, has_more = list_batches(redis_conn, user_api_key, max(1, min(limit, 100)), after)
+    data = [batch_view(b) for b in batches]
+    return {
+        "object": "list",
+        "data": data,
+        "first_id": data[0]["id"] if data else None,
+        "last_id": data[-1]["id"] if data else None,
+        "has_more": has_more
     }
-    return openai_response
+
+@app.get("/v1/batches/{batch_id}")
+async def retrieve_batch(batch_id: str, authorization: str = Header(None)):
+    user_api_key, error = await authenticate(authorization)
+    if error is not None:
+        return error
+    batch = get_batch(redis_conn, batch_id, user_api_key)
+    if batch is None:
+        return openai_error("No such batch", "not_found", 404)
+    return batch_view(batch)
+
+@app.post("/v1/batches/{batch_id}/cancel")
+async def cancel_batch_endpoint(batch_id: str, authorization: str = Header(None)):
+    user_api_key, error = await authenticate(authorization)
+    if error is not None:
+        return error
+    batch = get_batch(redis_conn, batch_id, user_api_key)
+    if batch is None:
+        return openai_error("No such batch", "not_found", 404)
+    cancel_batch(redis_conn, batch)
+    return batch_view(get_batch(redis_conn, batch_id, user_api_key))
+
+# --- Prometheus metrics (blocked by nginx; scrape 127.0.0.1:8000 directly) ---
+@app.get("/metrics")
+def metrics():
+    body, content_type = render_metrics()
+    return Response(body, media_type=content_type)
 
 if __name__ == "__main__":
     uvicorn.run(app, host="0.0.0.0", port=8000)
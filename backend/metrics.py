@@ -0,0 +1,111 @@
+import logging
+import os
+import time
+
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram, REGISTRY, generate_latest, CONTENT_TYPE_LATEST
+from prometheus_client import multiprocess
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+from rq import Queue
+
+# Prometheus metrics for the API. Under gunicorn every worker writes its samples to
+# PROMETHEUS_MULTIPROC_DIR (set up in gunicorn.conf.py) and /metrics merges them, so a
+# scrape sees the whole host whichever worker answers it. Shared state that lives in
+# Redis (queue depths, hedge outcomes) is read once per scrape instead of being counted.
+
+MULTIPROCESS = bool(os.getenv("PROMETHEUS_MULTIPROC_DIR"))
+
+# Most stages take well under a millisecond; upstream calls take seconds.
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+STAGES = ("auth", "cache_lookup", "rate_limit", "key_selection", "upstream", "serialization")
+
+STAGE_SECONDS = Histogram("ggpt_stage_duration_seconds", "Time spent in each stage of a chat completion",
+                          ["stage"], buckets=LATENCY_BUCKETS)
+REQUEST_SECONDS = Histogram("ggpt_request_duration_seconds", "Chat completion time until the response starts",
+                            buckets=LATENCY_BUCKETS)
+COMPLETIONS = Counter("ggpt_completions_total", "Chat completions answered, by HTTP status", ["status"])
+UPSTREAM_REQUESTS = Counter("ggpt_upstream_requests_total", "Gemini calls by key, region, model and status",
+                            ["key", "region", "model", "status"])
+COMPLETIONS_IN_FLIGHT = Gauge("ggpt_completions_in_flight", "Chat completions being handled",
+                              multiprocess_mode="livesum")
+UPSTREAM_IN_FLIGHT = Gauge("ggpt_upstream_in_flight", "Gemini calls awaiting response headers",
+                           multiprocess_mode="livesum")
+STREAMS_OPEN = Gauge("ggpt_streams_open", "Streamed completions still sending", multiprocess_mode="livesum")
+RESPONSE_CACHE = Counter("ggpt_response_cache_total", "Response cache lookups and stores", ["result"])
+SINGLEFLIGHT = Counter("ggpt_singleflight_total", "Coalesced request outcomes", ["role"])
+CONTEXT_CACHE = Counter("ggpt_context_cache_total", "Gemini context cache uses, creations and refreshes", ["result"])
+CIRCUIT_BREAKER_TRIPS = Counter("ggpt_circuit_breaker_trips_total", "Circuit breakers tripped open, by key or region",
+                                ["scope"])
+KEY_REGISTRY_REFRESHED = Gauge("ggpt_key_registry_refreshed_timestamp_seconds",
+                               "When the oldest worker last rebuilt its Gemini key registry", multiprocess_mode="min")
+KEY_REGISTRY_FAILURES = Counter("ggpt_key_registry_refresh_failures_total", "Failed key registry refreshes")
+
+_stage_children = {stage: STAGE_SECONDS.labels(stage) for stage in STAGES}
+
+def stage_timer(stage):
+    # with stage_timer("auth"): ...
+    return _stage_children[stage].time()
+
+def observe_stage(stage, seconds):
+    _stage_children[stage].observe(seconds)
+
+def observe_upstream(key, model_name, status, seconds):
+    observe_stage("upstream", seconds)
+    UPSTREAM_REQUESTS.labels(key.get("name") or str(key["id"]), key["region"], model_name,
+                             str(status) if status is not None else "error").inc()
+
+def observe_completion(response, seconds):
+    REQUEST_SECONDS.observe(seconds)
+    COMPLETIONS.labels(str(getattr(response, "status_code", 200))).inc()
+
+async def track_stream(chunks):
+    STREAMS_OPEN.inc()
+    try:
+        async for chunk in chunks:
+            yield chunk
+    finally:
+        STREAMS_OPEN.dec()
+
+class RedisStateCollector:
+    # Read at scrape time, so every worker reports the same cluster-wide values.
+    def __init__(self, conn, queue_names, hedge_stats):
+        self.conn = conn
+        self.queue_names = queue_names
+        self.hedge_stats = hedge_stats
+
+    def collect(self):
+        try:
+            depths = {name: Queue(name, connection=self.conn).count for name in self.queue_names}
+            hedges = self.hedge_stats(self.conn)
+        except Exception as e:
+            logging.warning(f"Metrics could not read Redis state: {e}")
+            return
+        depth = GaugeMetricFamily("ggpt_queue_depth", "Jobs waiting in each RQ queue", labels=["queue"])
+        for name, count in depths.items():
+            depth.add_metric([name], count)
+        yield depth
+        outcomes = CounterMetricFamily("ggpt_hedge", "Hedged request outcomes", labels=["outcome"])
+        for outcome, value in hedges.items():
+            if outcome not in ("hedge_win_rate", "delay"):
+                outcomes.add_metric([outcome], value)
+        yield outcomes
+
+_state_collector = None
+
+def register_state_collector(collector):
+    global _state_collector
+    _state_collector = collector
+    if not MULTIPROCESS:
+        REGISTRY.register(collector)
+
+def render_metrics():
+    # Returns (body, content_type) for the /metrics endpoint.
+    registry = REGISTRY
+    if MULTIPROCESS:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        if _state_collector is not None:
+            registry.register(_state_collector)
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+def mark_registry_refreshed():
+    KEY_REGISTRY_REFRESHED.set(time.time())
@@ -0,0 +1,26 @@
+import asyncio
+import logging
+import signal
+
+from backend.main import consume_queued_completions
+from backend.tracing import setup_tracing, shutdown_tracing
+
+# Drains the Gemini admission queues (overflow completions and /v1/jobs): one event loop
+# keeps up to OVERFLOW_CONCURRENCY queued completions in flight. More processes can run
+# side by side; they share the queues and the rate limiter.
+#   python3 -m backend.overflow_worker
+
+async def main():
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+    await consume_queued_completions(stop)
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    setup_tracing("ggpt-overflow-worker")
+    try:
+        asyncio.run(main())
+    finally:
+        shutdown_tracing()
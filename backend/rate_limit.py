@@ -0,0 +1,144 @@
+import os
+
+# Sliding-window limits enforced by a single Lua script, so the check and the increment for
+# every dimension of a request happen atomically in one Redis round trip. Each limit is a
+# (base_key, limit, cost) tuple; a limit of 0 means unlimited and is never sent to Redis.
+
+RATE_LIMIT_WINDOW_MS = 60_000
+
+def _parse_overrides(value):
+    # "us-central1=120,europe-west3=30" -> {"us-central1": 120, "europe-west3": 30}
+    overrides = {}
+    for item in (value or "").split(","):
+        if "=" in item:
+            name, limit = item.split("=", 1)
+            overrides[name.strip()] = int(limit)
+    return overrides
+
+RATE_LIMIT_PER_REGION = int(os.getenv("RATE_LIMIT_PER_REGION", 60))
+RATE_LIMIT_TPM_PER_REGION = int(os.getenv("RATE_LIMIT_TPM_PER_REGION", 0))
+RATE_LIMIT_REGION_OVERRIDES = _parse_overrides(os.getenv("RATE_LIMIT_REGION_OVERRIDES"))
+RATE_LIMIT_TPM_REGION_OVERRIDES = _parse_overrides(os.getenv("RATE_LIMIT_TPM_REGION_OVERRIDES"))
+# Per Gemini key defaults; projects.rpm_limit / projects.tpm_limit override them per row.
+RATE_LIMIT_PER_KEY = int(os.getenv("RATE_LIMIT_PER_KEY", 0))
+RATE_LIMIT_TPM_PER_KEY = int(os.getenv("RATE_LIMIT_TPM_PER_KEY", 0))
+RATE_LIMIT_MODEL_OVERRIDES = _parse_overrides(os.getenv("RATE_LIMIT_MODEL_OVERRIDES"))
+RATE_LIMIT_TPM_MODEL_OVERRIDES = _parse_overrides(os.getenv("RATE_LIMIT_TPM_MODEL_OVERRIDES"))
+RATE_LIMIT_PER_USER = int(os.getenv("RATE_LIMIT_PER_USER", 0))
+RATE_LIMIT_TPM_PER_USER = int(os.getenv("RATE_LIMIT_TPM_PER_USER", 0))
+
+# Sliding window counter: the previous window's count is weighted by how much of it still
+# overlaps the last 60 s. Redis TIME is used so workers on different hosts agree on windows.
+# A request larger than the whole limit is let through on an idle window instead of
+# being rejected forever.
+_ACQUIRE_LUA = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+local window = tonumber(ARGV[1])
+local idx = math.floor(now / window)
+local elapsed = (now % window) / window
+for i, base in ipairs(KEYS) do
+  local limit = tonumber(ARGV[2 * i])
+  local cost = tonumber(ARGV[2 * i + 1])
+  local curr = tonumber(redis.call('GET', base .. ':' .. idx) or '0')
+  local prev = tonumber(redis.call('GET', base .. ':' .. (idx - 1)) or '0')
+  local used = prev * (1 - elapsed) + curr
+  if used > 0 and used + cost > limit then
+    return {0, i, math.ceil(window * (1 - elapsed))}
+  end
+end
+for i, base in ipairs(KEYS) do
+  local cost = tonumber(ARGV[2 * i + 1])
+  if cost > 0 then
+    local k = base .. ':' .. idx
+    redis.call('INCRBY', k, cost)
+    redis.call('PEXPIRE', k, window * 2)
+  end
+end
+return {1, 0, 0}
+"""
+
+# Adds usage that is only known after the fact (completion tokens) without a check.
+_RECORD_LUA = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+local window = tonumber(ARGV[1])
+local idx = math.floor(now / window)
+for i, base in ipairs(KEYS) do
+  local cost = tonumber(ARGV[i + 1])
+  if cost > 0 then
+    local k = base .. ':' .. idx
+    redis.call('INCRBY', k, cost)
+    redis.call('PEXPIRE', k, window * 2)
+  end
+end
+return 1
+"""
+
+_scripts = {}
+
+def _script(conn, name, source):
+    script = _scripts.get((id(conn), name))
+    if script is None:
+        script = conn.register_script(source)
+        _scripts[(id(conn), name)] = script
+    return script
+
+def region_limits(region, tokens=0):
+    rpm = RATE_LIMIT_REGION_OVERRIDES.get(region, RATE_LIMIT_PER_REGION)
+    tpm = RATE_LIMIT_TPM_REGION_OVERRIDES.get(region, RATE_LIMIT_TPM_PER_REGION)
+    return [
+        (f"rate:region:{region}:rpm", rpm, 1),
+        (f"rate:region:{region}:tpm", tpm, tokens),
+    ]
+
+def key_limits(key, tokens=0):
+    rpm = key.get("rpm_limit") or RATE_LIMIT_PER_KEY
+    tpm = key.get("tpm_limit") or RATE_LIMIT_TPM_PER_KEY
+    return [
+        (f"rate:key:{key['id']}:rpm", rpm, 1),
+        (f"rate:key:{key['id']}:tpm", tpm, tokens),
+    ]
+
+def model_limits(model_name, tokens=0):
+    return [
+        (f"rate:model:{model_name}:rpm", RATE_LIMIT_MODEL_OVERRIDES.get(model_name, 0), 1),
+        (f"rate:model:{model_name}:tpm", RATE_LIMIT_TPM_MODEL_OVERRIDES.get(model_name, 0), tokens),
+    ]
+
+def user_limits(user_scope, tokens=0):
+    # user_scope is the hashed API key (supabase_client.owner_scope), so limits never see the key itself.
+    return [
+        (f"rate:user:{user_scope}:rpm", RATE_LIMIT_PER_USER, 1),
+        (f"rate:user:{user_scope}:tpm", RATE_LIMIT_TPM_PER_USER, tokens),
+    ]
+
+def acquire(conn, limits):
+    # Returns (allowed, failed_key, retry_after_seconds). Nothing is consumed unless every
+    # limit has room.
+    limits = [l for l in limits if l[1] > 0]
+    if not limits:
+        return True, None, 0
+    args = [RATE_LIMIT_WINDOW_MS]
+    for _, limit, cost in limits:
+        args += [limit, cost]
+    allowed, failed, retry_ms = _script(conn, "acquire", _ACQUIRE_LUA)(keys=[l[0] for l in limits], args=args)
+    if allowed:
+        return True, None, 0
+    return False, limits[failed - 1][0], retry_ms / 1000
+
+def record(conn, limits):
+    # Only token windows take after-the-fact usage; request windows were charged by acquire().
+    limits = [l for l in limits if l[0].endswith(":tpm") and l[1] > 0 and l[2] > 0]
+    if not limits:
+        return
+    _script(conn, "record", _RECORD_LUA)(keys=[l[0] for l in limits], args=[RATE_LIMIT_WINDOW_MS] + [l[2] for l in limits])
+
+def window_names(base_key, now_ms):
+    # Current and previous window keys, for read-only views of a limit (e.g. key ranking).
+    idx = int(now_ms // RATE_LIMIT_WINDOW_MS)
+    return [f"{base_key}:{idx}", f"{base_key}:{idx - 1}"]
+
+def weighted_usage(curr, prev, now_ms):
+    elapsed = (now_ms % RATE_LIMIT_WINDOW_MS) / RATE_LIMIT_WINDOW_MS
+    return int(prev or 0) * (1 - elapsed) + int(curr or 0)
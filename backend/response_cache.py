@@ -0,0 +1,117 @@
+import hashlib
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+
+from backend.metrics import RESPONSE_CACHE
+from backend.translation import message_text
+from supabase_client import owner_scope
+
+# Opt-in cache for deterministic completions: used when temperature == 0 or the client sends
+# "X-Response-Cache: on". Entries are scoped to the calling user API key and keyed by a hash
+# of the normalized messages, model and generation parameters. Only complete answers
+# (finish_reason "stop") are stored. A per-worker LRU sits in front of Redis; Redis keeps
+# at most RESPONSE_CACHE_MAX_ENTRIES, evicting the oldest.
+
+RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE_ENABLED", "true").lower() == "true"
+RESPONSE_CACHE_TTL = int(os.getenv("RESPONSE_CACHE_TTL", 3600))
+RESPONSE_CACHE_LOCAL_MAX = int(os.getenv("RESPONSE_CACHE_LOCAL_MAX", 1000))
+RESPONSE_CACHE_LOCAL_TTL = int(os.getenv("RESPONSE_CACHE_LOCAL_TTL", 60))
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", 100000))
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv("RESPONSE_CACHE_MAX_BYTES", 64 * 1024))  # per entry
+RESPONSE_CACHE_HEADER = "x-response-cache"
+RESPONSE_CACHE_INDEX = "respcache:index"
+
+_local = OrderedDict()  # cache key -> (value, expires_at)
+
+def _count(field):
+    RESPONSE_CACHE.labels(field).inc()
+
+# SET plus an age index so the total number of entries stays bounded.
+_STORE_LUA = """
+redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2])
+redis.call('ZADD', KEYS[2], ARGV[3], KEYS[1])
+local excess = redis.call('ZCARD', KEYS[2]) - tonumber(ARGV[4])
+if excess > 0 then
+  local old = redis.call('ZPOPMIN', KEYS[2], excess)
+  for i = 1, #old, 2 do
+    redis.call('DEL', old[i])
+  end
+end
+return 1
+"""
+
+_store_script = None
+
+def cache_requested(headers, stream, temperature):
+    if not RESPONSE_CACHE_ENABLED or stream:
+        return False
+    mode = headers.get(RESPONSE_CACHE_HEADER, "").lower()
+    if mode == "off":
+        return False
+    return mode == "on" or temperature == 0
+
+def normalize_messages(messages):
+    # Messages are already validated by the translation layer.
+    return [
+        {"role": str(m.get("role", "")).strip().lower(),
+         "content": message_text(m.get("content"), i).replace("\r\n", "\n").strip()}
+        for i, m in enumerate(messages)
+    ]
+
+def request_fingerprint(user_api_key, messages, model, generation_config):
+    # "<user scope>:<request hash>"; shared with request coalescing.
+    scope = owner_scope(user_api_key)
+    body = json.dumps({
+        "messages": normalize_messages(messages),
+        "model": model,
+        "generation_config": generation_config
+    }, sort_keys=True, separators=(",", ":"))
+    return f"{scope}:{hashlib.sha256(body.encode()).hexdigest()}"
+
+def cache_key(user_api_key, messages, model, generation_config):
+    return f"respcache:{request_fingerprint(user_api_key, messages, model, generation_config)}"
+
+def _remember(key, value):
+    _local[key] = (value, time.monotonic() + RESPONSE_CACHE_LOCAL_TTL)
+    _local.move_to_end(key)
+    while len(_local) > RESPONSE_CACHE_LOCAL_MAX:
+        _local.popitem(last=False)
+
+def get_cached(conn, key):
+    entry = _local.get(key)
+    if entry is not None:
+        if entry[1] > time.monotonic():
+            _local.move_to_end(key)
+            _count("local_hits")
+            return entry[0]
+        del _local[key]
+    try:
+        raw = conn.get(key)
+    except Exception as e:
+        logging.warning(f"Response cache read failed: {e}")
+        raw = None
+    if raw is None:
+        _count("misses")
+        return None
+    value = json.loads(raw)
+    _remember(key, value)
+    _count("redis_hits")
+    return value
+
+def store(conn, key, value):
+    global _store_script
+    raw = json.dumps(value)
+    if len(raw) > RESPONSE_CACHE_MAX_BYTES:
+        return
+    if _store_script is None:
+        _store_script = conn.register_script(_STORE_LUA)
+    try:
+        _store_script(keys=[key, RESPONSE_CACHE_INDEX],
+                      args=[raw, RESPONSE_CACHE_TTL, time.time(), RESPONSE_CACHE_MAX_ENTRIES])
+    except Exception as e:
+        logging.warning(f"Response cache write failed: {e}")
+    _remember(key, value)
+    _count("stores")
@@ -0,0 +1,135 @@
+import os
+import random
+import time
+
+from backend.rate_limit import key_limits, model_limits, window_names, weighted_usage
+from backend.circuit_breaker import BREAKER_ENABLED, queue_reads, remember, scopes, region_scope, scope_blocked_until
+
+# Orders Gemini keys by remaining headroom instead of database order. Each key gets a score
+# from its live RPM window, its token quota (projects.token_limit / tokens_used), and this
+# worker's view of its latency and error rate. A key that answered 429 with a retry delay
+# sits it out; one that answered 429/403 KEY_COOLDOWN_AFTER times in a row sits out an
+# exponential cooldown. Both are shared through Redis, so no worker spends a round trip on it.
+# Keys whose circuit breaker (or whose region's) is open are left out the same way. The
+# key registry's groupings keep the per-request work small: a region behind an open breaker
+# is skipped whole, and a model's shared RPM budget (RATE_LIMIT_MODEL_OVERRIDES) is read
+# once and scales the score of all of its keys.
+
+SCHEDULER_KEY_RPM_HINT = int(os.getenv("SCHEDULER_KEY_RPM_HINT", 60))  # assumed RPM for keys without rpm_limit
+SCHEDULER_LATENCY_REF = float(os.getenv("SCHEDULER_LATENCY_REF", 2.0))  # seconds
+SCHEDULER_EWMA_ALPHA = float(os.getenv("SCHEDULER_EWMA_ALPHA", 0.2))
+KEY_COOLDOWN_BASE = float(os.getenv("KEY_COOLDOWN_BASE", 5))
+KEY_COOLDOWN_MAX = float(os.getenv("KEY_COOLDOWN_MAX", 300))
+KEY_COOLDOWN_AFTER = int(os.getenv("KEY_COOLDOWN_AFTER", 2))  # 429/403 answers in a row without a retry delay
+COOLDOWN_STATUSES = (429, 403)
+
+_stats = {}  # key id -> {"latency": ewma seconds, "errors": ewma 0..1, "backoff": level}
+
+def _key_stats(key_id):
+    stats = _stats.get(key_id)
+    if stats is None:
+        stats = {"latency": None, "errors": 0.0, "backoff": 0}
+        _stats[key_id] = stats
+    return stats
+
+def cooldown_key(key_id):
+    return f"cooldown:key:{key_id}"
+
+def backoff_key(key_id):
+    return f"cooldown_level:key:{key_id}"
+
+def score_key(key, rpm_used):
+    stats = _key_stats(key["id"])
+    _, rpm_limit, _ = key_limits(key)[0]
+    headroom = max(0.0, 1 - rpm_used / (rpm_limit or SCHEDULER_KEY_RPM_HINT))
+    token_limit = key.get("token_limit")
+    quota = max(0.0, 1 - (key.get("tokens_used") or 0) / token_limit) if token_limit else 1.0
+    health = 1 - stats["errors"]
+    speed = 1 / (1 + (stats["latency"] or 0) / SCHEDULER_LATENCY_REF)
+    return headroom * quota * health * speed
+
+def rank_keys(conn, registry):
+    # registry: key_registry's view. Returns (ordered_keys, retry_after_seconds); retry_after
+    # is set only when every key is cooling down or behind an open circuit, and is the time
+    # until the first of them is back.
+    keys = registry["active"]
+    if not keys:
+        return [], 0
+    now = time.time()
+    now_ms = now * 1000
+    model_rpm = [(model, *model_limits(model)[0][:2]) for model in registry["by_model"]]
+    model_rpm = [(model, name, limit) for model, name, limit in model_rpm if limit]
+    pipe = conn.pipeline(transaction=False)
+    for key in keys:
+        pipe.mget(window_names(key_limits(key)[0][0], now_ms))
+    pipe.mget([cooldown_key(k["id"]) for k in keys])
+    for _, name, _ in model_rpm:
+        pipe.mget(window_names(name, now_ms))
+    breakers = queue_reads(pipe, keys) if BREAKER_ENABLED else []
+    results = pipe.execute()
+    windows, cooldowns = results[:len(keys)], results[len(keys)]
+    model_windows = results[len(keys) + 1:len(keys) + 1 + len(model_rpm)]
+    states = remember(breakers, results[len(keys) + 1 + len(model_rpm):])
+    live = {key["id"]: (window, until) for key, window, until in zip(keys, windows, cooldowns)}
+    model_headroom = {model: max(0.0, 1 - weighted_usage(curr, prev, now_ms) / limit)
+                      for (model, _, limit), (curr, prev) in zip(model_rpm, model_windows)}
+
+    ranked = []
+    soonest = None
+    for region, region_keys in registry["by_region"].items():
+        until = scope_blocked_until(region_scope(region), states, now)
+        if until is not None:
+            soonest = until if soonest is None else min(soonest, until)
+            continue
+        for key in region_keys:
+            (curr, prev), until = live[key["id"]]
+            until = float(until) if until is not None and float(until) > now else \
+                scope_blocked_until(scopes(key)[0], states, now)
+            if until is not None:
+                soonest = until if soonest is None else min(soonest, until)
+                continue
+            score = score_key(key, weighted_usage(curr, prev, now_ms)) * model_headroom.get(key.get("model_name"), 1.0)
+            # Weighted random order: better keys usually go first, but load still spreads
+            # across keys with similar headroom instead of herding onto one.
+            ranked.append((random.random() ** (1 / score) if score > 0 else -1.0, key))
+    if not ranked:
+        return [], max(0.05, soonest - now)
+    ranked.sort(key=lambda item: item[0], reverse=True)
+    return [key for _, key in ranked], 0
+
+def report_result(conn, key, status_code, latency, client_error=False, retry_after=None):
+    # status_code is None when the call raised before a response arrived. A client error is
+    # the request's fault (e.g. a malformed payload), not the key's, so it isn't held against it.
+    # retry_after is the delay Gemini asked for with a 429, if it gave one.
+    stats = _key_stats(key["id"])
+    alpha = SCHEDULER_EWMA_ALPHA
+    failed = status_code != 200 and not client_error
+    stats["errors"] = (1 - alpha) * stats["errors"] + alpha * (1.0 if failed else 0.0)
+    if status_code == 200:
+        stats["latency"] = latency if stats["latency"] is None else (1 - alpha) * stats["latency"] + alpha * latency
+        if stats["backoff"]:
+            stats["backoff"] = 0
+            conn.delete(backoff_key(key["id"]))
+    elif status_code in COOLDOWN_STATUSES:
+        start_cooldown(conn, key, retry_after)
+
+def start_cooldown(conn, key, retry_after=None):
+    # Returns the cooldown in seconds, 0 when the key stays in rotation. A single 429 is
+    # often a burst the rate limiter already absorbs, so without a retry delay only
+    # repeated ones bench the key.
+    pipe = conn.pipeline(transaction=False)
+    pipe.incr(backoff_key(key["id"]))
+    pipe.expire(backoff_key(key["id"]), int(KEY_COOLDOWN_MAX * 4))
+    level, _ = pipe.execute()
+    _key_stats(key["id"])["backoff"] = level
+    if retry_after is not None:
+        delay = min(retry_after, KEY_COOLDOWN_MAX) * random.uniform(1, 1.1)
+    elif level < KEY_COOLDOWN_AFTER:
+        return 0
+    else:
+        delay = min(KEY_COOLDOWN_BASE * 2 ** (level - KEY_COOLDOWN_AFTER), KEY_COOLDOWN_MAX)
+        delay *= random.uniform(0.8, 1.2)
+    if delay <= 0:
+        return 0
+    conn.set(cooldown_key(key["id"]), time.time() + delay, px=max(1, int(delay * 1000)))
+    return delay
@@ -0,0 +1,218 @@
+import asyncio
+import json
+import logging
+import os
+import uuid
+
+from fastapi.responses import Response
+
+from backend.coordination import release_lock, wait_published
+from backend.metrics import SINGLEFLIGHT
+from backend.response_cache import request_fingerprint
+from supabase_client import get_async_redis
+
+# Request coalescing. Identical in-flight completions from the same user API key (same
+# normalized key as the response cache) attach to one pending upstream call and all get
+# its answer, so N copies of a question cost one quota unit. Within a worker, followers
+# await the leader's task. Streams are fanned out chunk by chunk to the requests that joined
+# before the first chunk was produced; later ones start their own call. A chunk is dropped
+# once every subscriber has sent it, and Gemini is not read further while the slowest one is
+# SINGLEFLIGHT_STREAM_BUFFER chunks behind, so a slow client never makes the worker hold the
+# whole answer in memory.
+# With SINGLEFLIGHT_REDIS, non-streaming requests also coalesce
+# across workers: the leader holds a Redis lock and publishes its response on a channel.
+
+SINGLEFLIGHT_ENABLED = os.getenv("SINGLEFLIGHT_ENABLED", "true").lower() == "true"
+SINGLEFLIGHT_REDIS = os.getenv("SINGLEFLIGHT_REDIS", "false").lower() == "true"
+SINGLEFLIGHT_WAIT = float(os.getenv("SINGLEFLIGHT_WAIT", 60))  # max seconds a follower waits on another worker
+SINGLEFLIGHT_RESULT_TTL = int(os.getenv("SINGLEFLIGHT_RESULT_TTL", 5))  # seconds a published result stays readable
+SINGLEFLIGHT_STREAM_BUFFER = int(os.getenv("SINGLEFLIGHT_STREAM_BUFFER", 64))  # unsent chunks held per stream
+SINGLEFLIGHT_HEADER = "x-coalesce"
+
+_inflight = {}  # flight key -> asyncio.Task resolving to the leader's Response
+_streams = {}   # flight key -> StreamFlight
+_worker_id = uuid.uuid4().hex
+
+def _count(field):
+    SINGLEFLIGHT.labels(field).inc()
+
+def flight_key(headers, user_api_key, messages, model, generation_config, stream):
+    # None when coalescing is off for this request.
+    if not SINGLEFLIGHT_ENABLED or headers.get(SINGLEFLIGHT_HEADER, "").lower() == "off":
+        return None
+    kind = "stream" if stream else "completion"
+    return f"sf:{kind}:{request_fingerprint(user_api_key, messages, model, generation_config)}"
+
+def _forget(table, key, value):
+    if table.get(key) is value:
+        del table[key]
+
+# --- Non-streaming ---
+
+async def coalesce(key, run):
+    # run() -> Response. Every caller with the same key gets the same Response.
+    task = _inflight.get(key)
+    if task is None:
+        _count("leaders")
+        # A task of its own, so a leader whose client goes away doesn't cancel the followers.
+        task = asyncio.ensure_future(_lead(key, run))
+        _inflight[key] = task
+        task.add_done_callback(lambda t: _forget(_inflight, key, t))
+    else:
+        _count("coalesced")
+    return await asyncio.shield(task)
+
+def _serialize(response):
+    headers = {k: v for k, v in response.headers.items() if k not in ("content-length", "content-type")}
+    return json.dumps({"status": response.status_code, "body": response.body.decode(), "headers": headers})
+
+def _deserialize(raw):
+    data = json.loads(raw)
+    return Response(content=data["body"], status_code=data["status"], headers=data["headers"],
+                    media_type="application/json")
+
+async def _lead(key, run):
+    if not SINGLEFLIGHT_REDIS:
+        return await run()
+    conn = get_async_redis()
+    lock_key, result_key = f"{key}:lock", f"{key}:result"
+    try:
+        leader = await conn.set(lock_key, _worker_id, nx=True, px=int(SINGLEFLIGHT_WAIT * 1000))
+    except Exception as e:
+        logging.warning(f"Single-flight lock failed, running locally: {e}")
+        return await run()
+    if not leader:
+        _count("remote_waits")
+        response = await _await_remote(conn, result_key)
+        if response is not None:
+            _count("remote_hits")
+            return response
+        # The other worker died or is too slow; answer this request ourselves.
+        return await run()
+    try:
+        response = await run()
+        try:
+            raw = _serialize(response)
+            pipe = conn.pipeline(transaction=False)
+            pipe.set(result_key, raw, ex=SINGLEFLIGHT_RESULT_TTL)
+            pipe.publish(result_key, raw)
+            await pipe.execute()
+        except Exception as e:
+            logging.warning(f"Single-flight publish failed: {e}")
+        return response
+    finally:
+        try:
+            await release_lock(conn, lock_key, _worker_id)
+        except Exception:
+            pass
+
+async def _await_remote(conn, result_key):
+    async def published():
+        raw = await conn.get(result_key)
+        return _deserialize(raw) if raw is not None else None
+    try:
+        return await wait_published(conn, result_key, SINGLEFLIGHT_WAIT, published, _deserialize)
+    except Exception as e:
+        logging.warning(f"Single-flight wait failed, running locally: {e}")
+        return None
+
+# --- Streaming (within a worker) ---
+
+class StreamFlight:
+    def __init__(self, key):
+        self.key = key
+        loop = asyncio.get_running_loop()
+        self.opened = loop.create_future()  # resolves to the error Response, or None once streaming
+        self.chunks = []  # chunks some subscriber has not sent yet
+        self.base = 0  # position of chunks[0] in the stream
+        self.positions = {}  # subscriber -> position of its next chunk
+        self.done = False
+        self.changed = loop.create_future()  # replaced after every new chunk
+        self.room = None  # what the producer waits on while the buffer is full
+        self.producer = None
+
+    def _notify(self):
+        changed, self.changed = self.changed, asyncio.get_running_loop().create_future()
+        changed.set_result(None)
+
+    def _trim(self):
+        sent = min(self.positions.values(), default=self.base + len(self.chunks))
+        if sent > self.base:
+            del self.chunks[:sent - self.base]
+            self.base = sent
+        if self.room is not None and len(self.chunks) < SINGLEFLIGHT_STREAM_BUFFER:
+            if not self.room.done():
+                self.room.set_result(None)
+            self.room = None
+
+async def coalesce_stream(key, open_stream):
+    # open_stream() -> (error_response, chunk_iterator). Returns the same shape, with the
+    # iterator replaced by a per-subscriber replay of the shared stream.
+    flight = _streams.get(key)
+    if flight is None:
+        _count("leaders")
+        flight = StreamFlight(key)
+        _streams[key] = flight
+        flight.producer = asyncio.ensure_future(_produce(key, flight, open_stream))
+    else:
+        _count("coalesced")
+    subscriber = object()
+    flight.positions[subscriber] = 0
+    try:
+        error = await asyncio.shield(flight.opened)
+    except BaseException:
+        _unsubscribe(flight, subscriber)
+        raise
+    if error is not None:
+        _unsubscribe(flight, subscriber)
+        return error, None
+    return None, _subscribe(flight, subscriber)
+
+async def _produce(key, flight, open_stream):
+    try:
+        error, chunks = await open_stream()
+        flight.opened.set_result(error)
+        if error is None:
+            async for chunk in chunks:
+                # Requests arriving from now on would have missed this chunk.
+                _forget(_streams, key, flight)
+                flight.chunks.append(chunk)
+                flight._notify()
+                if len(flight.chunks) >= SINGLEFLIGHT_STREAM_BUFFER:
+                    flight.room = asyncio.get_running_loop().create_future()
+                    await flight.room
+    except asyncio.CancelledError:
+        if not flight.opened.done():
+            flight.opened.cancel()
+        raise
+    except Exception as e:
+        if not flight.opened.done():
+            flight.opened.set_exception(e)
+        else:
+            logging.warning(f"Shared stream failed: {e}")
+    finally:
+        flight.done = True
+        flight._notify()
+        _forget(_streams, key, flight)
+
+def _unsubscribe(flight, subscriber):
+    del flight.positions[subscriber]
+    flight._trim()
+    if not flight.positions and not flight.done:
+        # Everyone disconnected: stop reading from Gemini.
+        _forget(_streams, flight.key, flight)
+        flight.producer.cancel()
+
+async def _subscribe(flight, subscriber):
+    try:
+        while True:
+            while flight.positions[subscriber] < flight.base + len(flight.chunks):
+                chunk = flight.chunks[flight.positions[subscriber] - flight.base]
+                flight.positions[subscriber] += 1
+                flight._trim()
+                yield chunk
+            if flight.done:
+                return
+            await flight.changed
+    finally:
+        _unsubscribe(flight, subscriber)
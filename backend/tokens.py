@@ -0,0 +1,67 @@
+import hashlib
+import math
+import os
+import re
+from collections import OrderedDict
+
+# Token accounting. Gemini's usageMetadata is authoritative whenever a response carries it;
+# the local estimate is only for admission (TPM checks before the call) and for responses
+# without metadata. Only the counts of prefix messages (the system prompt and earlier turns,
+# which clients resend on every call) are memoized, keyed by a digest of the text so an
+# entry costs the same whatever the message length; the new turn and stream chunks are
+# counted directly and never evict them.
+
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", 4096))  # prefix messages whose counts are kept
+MESSAGE_OVERHEAD_TOKENS = 4  # role marker and turn separators
+
+# Word runs, single CJK/kana/hangul characters, or single symbols.
+_TOKEN_RE = re.compile(r"[぀-ヿ㐀-䶿一-鿿가-힯豈-﫿]|[^\W\d_]+|\d+|[^\w\s]", re.UNICODE)
+_ASCII_WORD_RE = re.compile(r"[A-Za-z]+")
+
+def _piece_tokens(piece):
+    if len(piece) == 1:
+        return 1
+    if piece.isdigit():
+        return math.ceil(len(piece) / 3)
+    if _ASCII_WORD_RE.fullmatch(piece):
+        # SentencePiece keeps common English words whole and splits long ones.
+        return 1 if len(piece) <= 6 else math.ceil(len(piece) / 4)
+    # Non-Latin alphabets (Cyrillic, Arabic, Devanagari...) split much finer.
+    return math.ceil(len(piece) / 2)
+
+_prefix_counts = OrderedDict()  # blake2b digest of a message -> its token count
+
+def count_tokens(text):
+    if not text:
+        return 0
+    return sum(_piece_tokens(piece) for piece in _TOKEN_RE.findall(text))
+
+def _count_prefix_tokens(text):
+    digest = hashlib.blake2b(text.encode(), digest_size=16).digest()
+    tokens = _prefix_counts.get(digest)
+    if tokens is not None:
+        _prefix_counts.move_to_end(digest)
+        return tokens
+    tokens = _prefix_counts[digest] = count_tokens(text)
+    if len(_prefix_counts) > TOKEN_CACHE_SIZE:
+        _prefix_counts.popitem(last=False)
+    return tokens
+
+def count_message_tokens(messages, prefix_count=None):
+    # The first prefix_count messages (default: all but the last) are memoized.
+    if prefix_count is None:
+        prefix_count = len(messages) - 1
+    total = 0
+    for i, m in enumerate(messages):
+        if isinstance(m.get("content"), str):
+            count = _count_prefix_tokens if i < prefix_count else count_tokens
+            total += count(m["content"]) + MESSAGE_OVERHEAD_TOKENS
+    return total
+
+def usage_from_metadata(metadata, prompt_estimate, completion_estimate):
+    # Returns (prompt_tokens, completion_tokens), preferring Gemini's own counts.
+    if not metadata:
+        return prompt_estimate, completion_estimate
+    prompt_tokens = metadata.get("promptTokenCount", prompt_estimate)
+    completion_tokens = metadata.get("candidatesTokenCount", completion_estimate)
+    return prompt_tokens, completion_tokens
@@ -0,0 +1,97 @@
+import os
+from contextlib import contextmanager, nullcontext
+
+from opentelemetry import trace, propagate
+from opentelemetry.trace import SpanKind, Status, StatusCode
+
+from backend.metrics import stage_timer
+
+# Distributed tracing (OpenTelemetry, W3C traceparent). Bots start the trace and pass
+# its context in the traceparent header; the backend continues it with a span per stage
+# and per Gemini attempt. Off unless TRACING_ENABLED: the API's no-op tracer then makes
+# spans nearly free. When on, a trace is kept if the caller sampled it, otherwise for
+# TRACE_SAMPLE_RATIO of new traces, so the full-load cost is set by that ratio. Spans are
+# exported in batches off the request path, to an OTLP/HTTP collector
+# (TRACE_EXPORTER=otlp, OTEL_EXPORTER_OTLP_ENDPOINT) or as JSON lines to TRACE_FILE.
+
+TRACING_ENABLED = os.getenv("TRACING_ENABLED", "false").lower() == "true"
+TRACE_SAMPLE_RATIO = float(os.getenv("TRACE_SAMPLE_RATIO", 0.01))
+TRACE_EXPORTER = os.getenv("TRACE_EXPORTER", "file")  # file or otlp
+TRACE_FILE = os.getenv("TRACE_FILE", "traces.jsonl")
+
+tracer = trace.get_tracer("ggpt.backend")
+_provider = None
+
+def setup_tracing(service_name):
+    global _provider
+    if not TRACING_ENABLED or _provider is not None:
+        return
+    from opentelemetry.sdk.resources import Resource
+    from opentelemetry.sdk.trace import TracerProvider
+    from opentelemetry.sdk.trace.export import BatchSpanProcessor, ConsoleSpanExporter
+    from opentelemetry.sdk.trace.sampling import ParentBased, TraceIdRatioBased
+    if TRACE_EXPORTER == "otlp":
+        from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+        exporter = OTLPSpanExporter()
+    else:
+        # Line buffered, so each span is one append and workers don't interleave.
+        exporter = ConsoleSpanExporter(out=open(TRACE_FILE, "a", buffering=1),
+                                       formatter=lambda span: span.to_json(indent=None) + "\n")
+    _provider = TracerProvider(resource=Resource.create({"service.name": service_name}),
+                               sampler=ParentBased(TraceIdRatioBased(TRACE_SAMPLE_RATIO)))
+    _provider.add_span_processor(BatchSpanProcessor(exporter))
+    trace.set_tracer_provider(_provider)
+
+def shutdown_tracing():
+    if _provider is not None:
+        _provider.shutdown()
+
+def server_span(name, headers, **attributes):
+    # Continues the caller's trace when it sent a traceparent header. Recent FastAPI
+    # versions already open a server span from it; nest under that one instead.
+    if not TRACING_ENABLED:
+        return nullcontext(trace.INVALID_SPAN)
+    if trace.get_current_span().get_span_context().is_valid:
+        return tracer.start_as_current_span(name, attributes=attributes)
+    return tracer.start_as_current_span(name, context=propagate.extract(headers), kind=SpanKind.SERVER,
+                                        attributes=attributes)
+
+def _recording():
+    # False when tracing is off or this trace wasn't sampled: child spans are skipped
+    # entirely, since even no-op spans cost microseconds each.
+    return trace.get_current_span().is_recording()
+
+@contextmanager
+def _traced_stage(name, attributes):
+    with tracer.start_as_current_span(name, attributes=attributes), stage_timer(name):
+        yield
+
+def stage(name, **attributes):
+    # One latency histogram sample per request stage, plus a span when traced.
+    if not _recording():
+        return stage_timer(name)
+    return _traced_stage(name, attributes)
+
+def upstream_span(name, key, model_name):
+    if not _recording():
+        return nullcontext(trace.INVALID_SPAN)
+    return tracer.start_as_current_span(name, kind=SpanKind.CLIENT, attributes={
+        "gemini.key": key.get("name") or str(key["id"]),
+        "gemini.region": key["region"],
+        "gemini.model": model_name,
+    })
+
+def record_status(span, status_code):
+    span.set_attribute("http.response.status_code", status_code)
+    if status_code >= 400:
+        span.set_status(Status(StatusCode.ERROR))
+
+def record_failure(span, error):
+    span.record_exception(error)
+    span.set_status(Status(StatusCode.ERROR, str(error)))
+
+def annotate(**attributes):
+    trace.get_current_span().set_attributes(attributes)
+
+def add_event(name, **attributes):
+    trace.get_current_span().add_event(name, attributes)
@@ -0,0 +1,119 @@
+import numbers
+
+# OpenAI chat request -> Gemini generateContent payload. System (and developer) messages
+# become systemInstruction, assistant turns become "model" turns, and consecutive turns of
+# the same role are merged into one turn with several parts. Sampling parameters map to
+# generationConfig. Everything is checked here, so a request Gemini would reject gets a
+# 400 before it costs a rate-limit slot or an upstream call.
+
+ROLES = {"user": "user", "assistant": "model", "system": None, "developer": None}  # None: systemInstruction
+MAX_STOP_SEQUENCES = 5
+MAX_CANDIDATES = 8
+
+def message_text(content, index):
+    # Plain string, or OpenAI content parts of type "text".
+    if isinstance(content, str):
+        return content
+    if content is None:
+        return ""
+    if isinstance(content, list):
+        texts = []
+        for part in content:
+            if not isinstance(part, dict) or part.get("type") != "text" or not isinstance(part.get("text"), str):
+                raise ValueError(f"messages[{index}].content: only text parts are supported")
+            texts.append(part["text"])
+        return "\n".join(texts)
+    raise ValueError(f"messages[{index}].content must be a string or a list of text parts")
+
+def translate_messages(messages, prefix_count=0):
+    # Returns (payload, prefix_length). The first prefix_count messages are the client's fixed
+    # prefix; prefix_length is how many leading Gemini contents come from it alone (for
+    # context caching), or None when a system message outside the prefix makes the
+    # systemInstruction vary between requests.
+    if not isinstance(messages, list) or not messages:
+        raise ValueError("messages must be a non-empty list")
+    system = []
+    contents = []
+    prefix_length = 0
+    for i, m in enumerate(messages):
+        if not isinstance(m, dict):
+            raise ValueError(f"messages[{i}] must be an object")
+        role = m.get("role")
+        if role not in ROLES:
+            raise ValueError(f"messages[{i}].role must be one of {', '.join(ROLES)}")
+        text = message_text(m.get("content"), i)
+        if not text:
+            continue  # Gemini rejects empty parts
+        if ROLES[role] is None:
+            system.append(text)
+            if i >= prefix_count:
+                prefix_length = None
+            continue
+        if contents and contents[-1]["role"] == ROLES[role]:
+            contents[-1]["parts"].append({"text": text})
+            if i >= prefix_count and prefix_length == len(contents):
+                prefix_length -= 1  # the last prefix turn absorbed a new message
+        else:
+            contents.append({"role": ROLES[role], "parts": [{"text": text}]})
+            if i < prefix_count and prefix_length is not None:
+                prefix_length = len(contents)
+    if not contents:
+        raise ValueError("messages must include at least one non-empty user or assistant message")
+    payload = {"contents": contents}
+    if system:
+        payload["systemInstruction"] = {"parts": [{"text": "\n\n".join(system)}]}
+    return payload, prefix_length
+
+def _number(body, name, low, high):
+    value = body.get(name)
+    if value is None:
+        return None
+    if isinstance(value, bool) or not isinstance(value, numbers.Real) or not low <= value <= high:
+        raise ValueError(f"{name} must be a number between {low} and {high}")
+    return value
+
+def _integer(body, name, low, high=None):
+    value = body.get(name)
+    if value is None:
+        return None
+    if isinstance(value, bool) or not isinstance(value, int) or value < low or (high is not None and value > high):
+        raise ValueError(f"{name} must be an integer {f'between {low} and {high}' if high else f'of at least {low}'}")
+    return value
+
+def generation_config(body):
+    config = {}
+    for name, field, low, high in (("temperature", "temperature", 0, 2), ("top_p", "topP", 0, 1),
+                                   ("presence_penalty", "presencePenalty", -2, 2),
+                                   ("frequency_penalty", "frequencyPenalty", -2, 2)):
+        value = _number(body, name, low, high)
+        if value is not None:
+            config[field] = value
+    max_tokens = _integer(body, "max_completion_tokens", 1)
+    if max_tokens is None:
+        max_tokens = _integer(body, "max_tokens", 1)
+    if max_tokens is not None:
+        config["maxOutputTokens"] = max_tokens
+    n = _integer(body, "n", 1, MAX_CANDIDATES)
+    if n is not None and n > 1:
+        config["candidateCount"] = n
+    seed = _integer(body, "seed", -2**31, 2**31 - 1)
+    if seed is not None:
+        config["seed"] = seed
+    stop = body.get("stop")
+    if stop is not None:
+        stop = [stop] if isinstance(stop, str) else stop
+        if not isinstance(stop, list) or not all(isinstance(s, str) and s for s in stop) or len(stop) > MAX_STOP_SEQUENCES:
+            raise ValueError(f"stop must be a string or a list of up to {MAX_STOP_SEQUENCES} non-empty strings")
+        config["stopSequences"] = stop
+    return config
+
+def translate_request(body, messages=None, prefix_count=0):
+    # body is the OpenAI request; messages overrides body["messages"] (e.g. with stored
+    # history added). Returns (payload, prefix_length); raises ValueError for a bad request.
+    payload, prefix_length = translate_messages(body["messages"] if messages is None else messages, prefix_count)
+    config = generation_config(body)
+    if config.get("candidateCount", 1) > 1 and body.get("stream"):
+        raise ValueError("n > 1 is not supported with stream")
+    if config:
+        payload["generationConfig"] = config
+    return payload, prefix_length
@@ -0,0 +1,111 @@
+import asyncio
+import logging
+import os
+import random
+import time
+
+from backend.alerts import send_admin_alert
+from supabase_client import deactivate_key
+
+# Failed Gemini calls are classified so the key loop reacts to each kind differently:
+#   client     the request itself is wrong (400, 413): answered at once, no other key tries it
+#   quota      429: the next key may still have budget, tried right away
+#   transient  5xx, timeouts, dropped connections: retried on the next key after a jittered backoff
+#   auth       the key is invalid, expired, leaked or suspended: skipped, and deactivated in
+#              projects after KEY_REVOKE_THRESHOLD such answers within KEY_REVOKE_WINDOW
+#   key        something else about this key's project (model or API not enabled, location): skipped
+# Every request has a budget of UPSTREAM_MAX_ATTEMPTS calls and UPSTREAM_DEADLINE seconds.
+
+UPSTREAM_MAX_ATTEMPTS = int(os.getenv("UPSTREAM_MAX_ATTEMPTS", 3))
+UPSTREAM_DEADLINE = float(os.getenv("UPSTREAM_DEADLINE", 60))
+UPSTREAM_BACKOFF_BASE = float(os.getenv("UPSTREAM_BACKOFF_BASE", 0.25))
+UPSTREAM_BACKOFF_MAX = float(os.getenv("UPSTREAM_BACKOFF_MAX", 2))
+KEY_REVOKE_THRESHOLD = int(os.getenv("KEY_REVOKE_THRESHOLD", 2))
+KEY_REVOKE_WINDOW = int(os.getenv("KEY_REVOKE_WINDOW", 600))
+
+AUTH_REASONS = {"API_KEY_INVALID", "API_KEY_EXPIRED", "CONSUMER_SUSPENDED"}
+AUTH_MESSAGES = ("api key not valid", "api key expired", "has been suspended", "reported as leaked")
+
+class UpstreamFailure:
+    def __init__(self, kind, message, status=None, error_type=None, retry_after=None):
+        self.kind = kind
+        self.message = message
+        self.status = status
+        self.error_type = error_type  # exception class when no HTTP answer came back
+        self.retry_after = retry_after  # seconds Gemini asked to wait, for a 429
+
+    def __str__(self):
+        return self.message
+
+def classify(status_code, gemini_data):
+    if status_code is None or status_code >= 500 or status_code in (408, 499):
+        return "transient"
+    if status_code == 429:
+        return "quota"
+    error = (gemini_data or {}).get("error") or {}
+    reasons = {d.get("reason") for d in error.get("details") or [] if isinstance(d, dict)}
+    message = str(error.get("message", "")).lower()
+    if status_code in (400, 401, 403) and (reasons & AUTH_REASONS or any(m in message for m in AUTH_MESSAGES)):
+        return "auth"
+    if status_code in (401, 403, 404) or error.get("status") == "FAILED_PRECONDITION":
+        return "key"
+    return "client"
+
+def retry_delay(gemini_data):
+    # A 429 from Gemini carries a google.rpc.RetryInfo detail such as {"retryDelay": "37s"}.
+    for detail in ((gemini_data or {}).get("error") or {}).get("details") or []:
+        if isinstance(detail, dict) and str(detail.get("@type", "")).endswith("RetryInfo"):
+            try:
+                return float(str(detail.get("retryDelay", "")).rstrip("s"))
+            except ValueError:
+                return None
+    return None
+
+def upstream_failure(status_code, gemini_data):
+    message = ((gemini_data or {}).get("error") or {}).get("message") or f"Gemini API error {status_code}"
+    return UpstreamFailure(classify(status_code, gemini_data), message, status_code,
+                           retry_after=retry_delay(gemini_data) if status_code == 429 else None)
+
+def exception_failure(e):
+    return UpstreamFailure("transient", str(e) or type(e).__name__, error_type=type(e).__name__)
+
+class RetryBudget:
+    # Upstream calls and time left for one request.
+    def __init__(self, attempts=UPSTREAM_MAX_ATTEMPTS, deadline=UPSTREAM_DEADLINE):
+        self.attempts = attempts
+        self.deadline = time.time() + deadline
+        self.backoffs = 0
+
+    def remaining(self):
+        return self.deadline - time.time()
+
+    def allows(self):
+        return self.attempts > 0 and self.remaining() > 0
+
+    def spend(self, calls=1):
+        self.attempts -= calls
+
+    async def backoff(self):
+        # Full jitter, so requests that failed together don't retry together.
+        delay = random.uniform(0, min(UPSTREAM_BACKOFF_MAX, UPSTREAM_BACKOFF_BASE * 2 ** self.backoffs))
+        self.backoffs += 1
+        await asyncio.sleep(max(0.0, min(delay, self.remaining())))
+
+def _deactivate(conn, key, failure):
+    try:
+        deactivate_key(key["id"])
+    except Exception as e:
+        logging.error(f"Gemini key {key.get('name')} looks revoked but could not be deactivated: {e}")
+        return
+    send_admin_alert(conn, f"key_revoked:{key['id']}",
+                     f"Gemini key {key.get('name')} ({key.get('region')}) was deactivated: {failure}")
+
+def report_auth_failure(conn, key, failure):
+    # One odd answer is not enough to take a key out of rotation.
+    counter = f"authfail:key:{key['id']}"
+    pipe = conn.pipeline()
+    pipe.incr(counter)
+    pipe.expire(counter, KEY_REVOKE_WINDOW)
+    count, _ = pipe.execute()
+    if count == KEY_REVOKE_THRESHOLD:
+        asyncio.get_running_loop().run_in_executor(None, _deactivate, conn, key, failure)
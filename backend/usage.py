@@ -0,0 +1,160 @@
+import asyncio
+import json
+import logging
+import os
+from datetime import datetime
+
+from supabase_client import get_redis, insert_usage_logs, increment_project_usage
+
+# Usage records are appended to an in-process buffer on the request path (no I/O) and
+# written to Supabase by a background task: one bulk insert into usage_logs plus one
+# aggregated tokens_used/last_used_at increment per project, every USAGE_FLUSH_MAX_RECORDS
+# records or USAGE_FLUSH_INTERVAL_MS, whichever comes first. Rows Supabase doesn't take are
+# parked in Redis lists and retried from there by the next flush of any process, so a crash
+# still loses at most the rows of the current window. Only while Redis is unreachable too do
+# they wait in this process's memory (up to USAGE_BUFFER_MAX), and are lost if it dies.
+# Rows Postgres refuses outright (a constraint or a bad value, e.g. their key was deleted
+# meanwhile) would fail forever, so they are singled out and dropped with an error log.
+
+USAGE_FLUSH_MAX_RECORDS = int(os.getenv("USAGE_FLUSH_MAX_RECORDS", 500))
+USAGE_FLUSH_INTERVAL_MS = int(os.getenv("USAGE_FLUSH_INTERVAL_MS", 2000))
+USAGE_BUFFER_MAX = int(os.getenv("USAGE_BUFFER_MAX", 50000))  # cap per list while Supabase is unreachable
+USAGE_UNWRITTEN_KEY = "usage:unwritten"  # usage_logs rows not inserted yet
+USAGE_UNCOUNTED_KEY = "usage:uncounted"  # inserted rows whose project increment failed
+
+_buffer = []
+_pending_increments = []  # project increments whose usage_logs rows are already written
+_flush_wakeup = None
+_flusher = None
+_stopping = False
+
+def record_usage(user_api_key_id, project_id, prompt_tokens, completion_tokens, total_tokens):
+    _buffer.append({
+        "project_id": project_id,
+        "user_api_key_id": user_api_key_id,
+        "prompt_tokens": prompt_tokens,
+        "response_tokens": completion_tokens,
+        "total_tokens": total_tokens,
+        "timestamp": datetime.utcnow().isoformat()
+    })
+    if len(_buffer) >= USAGE_FLUSH_MAX_RECORDS and _flush_wakeup is not None:
+        _flush_wakeup.set()
+
+def aggregate_project_usage(rows):
+    totals = {}
+    for row in rows:
+        if row["project_id"] is None:
+            continue
+        entry = totals.setdefault(row["project_id"], {"project_id": row["project_id"], "tokens": 0, "last_used_at": row["timestamp"]})
+        entry["tokens"] += row["total_tokens"] or 0
+        entry["last_used_at"] = max(entry["last_used_at"], row["timestamp"])
+    return list(totals.values())
+
+def _park(name, rows):
+    pipe = get_redis().pipeline()
+    pipe.rpush(name, *[json.dumps(row) for row in rows])
+    pipe.ltrim(name, -USAGE_BUFFER_MAX, -1)
+    pipe.execute()
+
+def _unpark(name):
+    # Takes up to one flush worth of parked rows; the transaction keeps two flushes from
+    # taking the same ones.
+    pipe = get_redis().pipeline()
+    pipe.lrange(name, 0, USAGE_FLUSH_MAX_RECORDS - 1)
+    pipe.ltrim(name, USAGE_FLUSH_MAX_RECORDS, -1)
+    rows, _ = pipe.execute()
+    return [json.loads(row) for row in rows]
+
+async def _set_aside(name, rows):
+    # Returns the rows that could not be parked in Redis and have to stay in memory.
+    try:
+        await asyncio.to_thread(_park, name, rows)
+        return []
+    except Exception as e:
+        logging.warning(f"Could not park {len(rows)} usage rows in Redis, keeping them in memory: {e}")
+        return rows
+
+async def _take_parked(name):
+    try:
+        return await asyncio.to_thread(_unpark, name)
+    except Exception as e:
+        logging.warning(f"Could not read parked usage rows from Redis: {e}")
+        return []
+
+def _refused(e):
+    # Postgres integrity (23xxx) and data (22xxx) errors: the rows themselves are the problem.
+    code = str(getattr(e, "code", None) or "")
+    return code.startswith("23") or code.startswith("22")
+
+def _insert_rows(rows):
+    # Returns (written, to retry). A bulk insert is all or nothing, so a refused one is split
+    # in halves until the refused rows are found.
+    try:
+        insert_usage_logs(rows)
+        return rows, []
+    except Exception as e:
+        if not _refused(e):
+            logging.warning(f"Usage flush of {len(rows)} records failed, will retry: {e}")
+            return [], rows
+        if len(rows) == 1:
+            logging.error(f"Dropping usage record Supabase refuses: {rows[0]} ({e})")
+            return [], []
+    half = len(rows) // 2
+    written, retry = _insert_rows(rows[:half])
+    if retry:
+        return written, retry + rows[half:]
+    more, retry = _insert_rows(rows[half:])
+    return written + more, retry
+
+async def flush_usage():
+    global _buffer, _pending_increments
+    batch, _buffer = _buffer, []
+    batch = await _take_parked(USAGE_UNWRITTEN_KEY) + batch
+    if batch:
+        written, retry = await asyncio.to_thread(_insert_rows, batch)
+        _pending_increments += written
+        if retry:
+            # Kept in front of anything recorded meanwhile, oldest dropped first.
+            kept = await _set_aside(USAGE_UNWRITTEN_KEY, retry)
+            _buffer = (kept + _buffer)[-USAGE_BUFFER_MAX:]
+            return
+    pending = await _take_parked(USAGE_UNCOUNTED_KEY) + _pending_increments
+    _pending_increments = []
+    if pending:
+        # Kept apart from the insert so a failed increment never re-inserts log rows.
+        updates = aggregate_project_usage(pending)
+        try:
+            if updates:
+                await asyncio.to_thread(increment_project_usage, updates)
+        except Exception as e:
+            if _refused(e):
+                logging.error(f"Dropping project usage increments Supabase refuses: {updates} ({e})")
+                return
+            logging.warning(f"Project usage increment failed, will retry: {e}")
+            kept = await _set_aside(USAGE_UNCOUNTED_KEY, pending)
+            _pending_increments = (kept + _pending_increments)[-USAGE_BUFFER_MAX:]
+
+async def _flush_loop():
+    while not _stopping:
+        try:
+            await asyncio.wait_for(_flush_wakeup.wait(), USAGE_FLUSH_INTERVAL_MS / 1000)
+        except asyncio.TimeoutError:
+            pass
+        _flush_wakeup.clear()
+        await flush_usage()
+
+def start_usage_flusher():
+    global _flush_wakeup, _flusher, _stopping
+    _stopping = False
+    _flush_wakeup = asyncio.Event()
+    _flusher = asyncio.create_task(_flush_loop())
+
+async def stop_usage_flusher():
+    # Not cancelled: a flush cut off between taking rows and writing or parking them loses them.
+    global _flusher, _stopping
+    if _flusher is not None:
+        _stopping = True
+        _flush_wakeup.set()
+        await _flusher
+        _flusher = None
+    await flush_usage()
@@ -0,0 +1,7 @@
+from bench.fake_services import install
+
+# backend.main:app wired to the in-memory Supabase/Redis, for load tests:
+#   GEMINI_API_BASE=http://127.0.0.1:8765/v1 gunicorn -c gunicorn.conf.py bench.fake_app:app
+install()
+
+from backend.main import app  # noqa: E402
@@ -0,0 +1,145 @@
+import asyncio
+import json
+import os
+import random
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+# Local stand-in for generativelanguage.googleapis.com used by the benchmarks.
+# Latency is FAKE_GEMINI_LATENCY_MS with FAKE_GEMINI_LATENCY_DIST "uniform" (+/- JITTER_MS)
+# or "lognormal" (median LATENCY_MS, spread SIGMA, for a realistic long tail). The
+# *_RATE settings answer that fraction of calls with the given Gemini error instead.
+# v1beta cachedContents are kept in memory and expanded into calls that reference them.
+FAKE_GEMINI_LATENCY_MS = float(os.getenv("FAKE_GEMINI_LATENCY_MS", 500))
+FAKE_GEMINI_LATENCY_DIST = os.getenv("FAKE_GEMINI_LATENCY_DIST", "uniform")
+FAKE_GEMINI_JITTER_MS = float(os.getenv("FAKE_GEMINI_JITTER_MS", 0))
+FAKE_GEMINI_SIGMA = float(os.getenv("FAKE_GEMINI_SIGMA", 0.5))
+FAKE_GEMINI_CHUNK_MS = float(os.getenv("FAKE_GEMINI_CHUNK_MS", 20))
+FAKE_GEMINI_ERRORS = {
+    429: ("RESOURCE_EXHAUSTED", "Resource has been exhausted (e.g. check quota).",
+          float(os.getenv("FAKE_GEMINI_429_RATE", 0))),
+    403: ("PERMISSION_DENIED", "API key not valid. Please pass a valid API key.",
+          float(os.getenv("FAKE_GEMINI_403_RATE", 0))),
+    500: ("INTERNAL", "An internal error has occurred.", float(os.getenv("FAKE_GEMINI_500_RATE", 0))),
+}
+
+app = FastAPI()
+calls = {}  # "generate:200", "stream:429", ... -> count
+cached_contents = {}  # "cachedContents/<id>" -> contents
+
+def count_call(kind, status):
+    name = f"{kind}:{status}"
+    calls[name] = calls.get(name, 0) + 1
+
+def fake_reply(body):
+    contents = body.get("contents", [])
+    last = contents[-1]["parts"][0]["text"] if contents else ""
+    return f"echo: {last}"
+
+def fake_usage(body, reply):
+    # Roughly one token per word; good enough to exercise the usageMetadata path.
+    prompt = sum(len(p.get("text", "").split()) for c in body.get("contents", []) for p in c.get("parts", []))
+    completion = len(reply.split())
+    return {"promptTokenCount": prompt, "candidatesTokenCount": completion, "totalTokenCount": prompt + completion}
+
+async def inject_latency():
+    if FAKE_GEMINI_LATENCY_DIST == "lognormal":
+        delay = random.lognormvariate(0, FAKE_GEMINI_SIGMA) * FAKE_GEMINI_LATENCY_MS
+    else:
+        delay = FAKE_GEMINI_LATENCY_MS + random.uniform(-FAKE_GEMINI_JITTER_MS, FAKE_GEMINI_JITTER_MS)
+    await asyncio.sleep(max(delay, 0) / 1000)
+
+def injected_error():
+    roll = random.random()
+    for code, (status, message, rate) in FAKE_GEMINI_ERRORS.items():
+        if roll < rate:
+            return JSONResponse(status_code=code, content={"error": {"code": code, "message": message, "status": status}})
+        roll -= rate
+    return None
+
+@app.get("/stats")
+async def stats():
+    return calls
+
+@app.post("/stats/reset")
+async def reset_stats():
+    calls.clear()
+    return calls
+
+def expand_cached_content(body):
+    # Returns an error response when the referenced cache is unknown.
+    name = body.pop("cachedContent", None)
+    if name is None:
+        return None
+    if name not in cached_contents:
+        return JSONResponse(status_code=403, content={"error": {
+            "code": 403, "status": "PERMISSION_DENIED", "message": "CachedContent not found (or permission denied)"}})
+    body["contents"] = cached_contents[name] + body.get("contents", [])
+    return None
+
+@app.post("/v1beta/cachedContents")
+async def create_cached_content(request: Request):
+    body = await request.json()
+    name = f"cachedContents/{len(cached_contents) + 1}"
+    cached_contents[name] = body.get("contents", [])
+    count_call("cache_create", 200)
+    return {"name": name, "model": body.get("model"), "ttl": body.get("ttl")}
+
+@app.patch("/v1beta/cachedContents/{cache_id}")
+async def update_cached_content(cache_id: str, request: Request):
+    count_call("cache_update", 200)
+    return {"name": f"cachedContents/{cache_id}"}
+
+@app.post("/v1/models/{model}:generateContent")
+@app.post("/v1beta/models/{model}:generateContent")
+async def generate_content(model: str, request: Request):
+    body = await request.json()
+    await inject_latency()
+    error = expand_cached_content(body) or injected_error()
+    if error is not None:
+        count_call("generate", error.status_code)
+        return error
+    count_call("generate", 200)
+    reply = fake_reply(body)
+    return {
+        "candidates": [
+            {
+                "content": {"role": "model", "parts": [{"text": reply}]},
+                "finishReason": "STOP"
+            }
+        ] * body.get("generationConfig", {}).get("candidateCount", 1),
+        "usageMetadata": fake_usage(body, reply)
+    }
+
+@app.post("/v1/models/{model}:streamGenerateContent")
+@app.post("/v1beta/models/{model}:streamGenerateContent")
+async def stream_generate_content(model: str, request: Request):
+    body = await request.json()
+    error = expand_cached_content(body) or injected_error()
+    if error is not None:
+        await inject_latency()
+        count_call("stream", error.status_code)
+        return error
+    count_call("stream", 200)
+    words = fake_reply(body).split(" ")
+
+    async def events():
+        # Time to first token is the injected latency; the rest trickles out per chunk.
+        await inject_latency()
+        for i, word in enumerate(words):
+            last = i == len(words) - 1
+            candidate = {"content": {"role": "model", "parts": [{"text": word if i == 0 else " " + word}]}}
+            event = {"candidates": [candidate]}
+            if last:
+                candidate["finishReason"] = "STOP"
+                event["usageMetadata"] = fake_usage(body, " ".join(words))
+            yield f"data: {json.dumps(event)}\r\n\r\n"
+            if not last:
+                await asyncio.sleep(FAKE_GEMINI_CHUNK_MS / 1000)
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+if __name__ == "__main__":
+    uvicorn.run(app, host="127.0.0.1", port=int(os.getenv("FAKE_GEMINI_PORT", 8765)), log_level="warning")
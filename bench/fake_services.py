@@ -0,0 +1,127 @@
+import os
+import uuid
+
+# In-memory stand-ins for Supabase and Redis so the backend can be load tested on one
+# machine. install() must run before anything imports supabase_client or backend.main.
+# Redis is faked (fakeredis with Lua) unless REDIS_URL is set; with several gunicorn
+# workers use a real Redis, or every worker gets its own limits, caches and snapshots.
+
+BENCH_USER_KEY = os.getenv("BENCH_USER_KEY", "bench-user-key")
+BENCH_GEMINI_KEYS = int(os.getenv("BENCH_GEMINI_KEYS", 4))
+BENCH_REGIONS = os.getenv("BENCH_REGIONS", "us-central1,europe-west1,asia-northeast1").split(",")
+BENCH_MODEL = os.getenv("BENCH_MODEL", "gemini-1.5-pro")
+
+class FakeResult:
+    def __init__(self, data):
+        self.data = data
+
+class FakeQuery:
+    # Just enough of the supabase-py query builder for supabase_client.py.
+    def __init__(self, db, table):
+        self.db = db
+        self.table = table
+        self.filters = []
+        self.op = "select"
+        self.values = None
+        self.single_row = False
+
+    def select(self, *columns, **options):
+        return self
+
+    def eq(self, column, value):
+        self.filters.append((column, value))
+        return self
+
+    def in_(self, column, values):
+        return self
+
+    def gte(self, column, value):
+        return self
+
+    def lt(self, column, value):
+        return self
+
+    def order(self, *args, **kwargs):
+        return self
+
+    def limit(self, count):
+        return self
+
+    def single(self):
+        self.single_row = True
+        return self
+
+    def insert(self, rows):
+        self.op, self.values = "insert", rows
+        return self
+
+    def upsert(self, rows):
+        self.op, self.values = "insert", rows
+        return self
+
+    def update(self, values):
+        self.op, self.values = "update", values
+        return self
+
+    def delete(self):
+        self.op = "delete"
+        return self
+
+    def execute(self):
+        rows = self.db.setdefault(self.table, [])
+        if self.op == "insert":
+            new_rows = [{"id": str(uuid.uuid4()), **row} for row in
+                        (self.values if isinstance(self.values, list) else [self.values])]
+            rows.extend(new_rows)
+            return FakeResult(new_rows)
+        matched = [row for row in rows if all(row.get(c) == v for c, v in self.filters)]
+        if self.op == "update":
+            for row in matched:
+                row.update(self.values)
+        elif self.op == "delete":
+            self.db[self.table] = [row for row in rows if row not in matched]
+        if self.single_row:
+            return FakeResult(matched[0] if matched else None)
+        return FakeResult(matched)
+
+class FakeSupabase:
+    def __init__(self, db):
+        self.db = db
+
+    def table(self, name):
+        return FakeQuery(self.db, name)
+
+    def rpc(self, name, params=None):
+        return FakeQuery(self.db, f"rpc:{name}")
+
+def seed():
+    projects = [{
+        "id": f"bench-{i}",
+        "name": f"bench-{i}",
+        "region": BENCH_REGIONS[i % len(BENCH_REGIONS)],
+        "api_key": f"bench-gemini-key-{i}",
+        "model_name": BENCH_MODEL,
+        "active": True,
+        "token_limit": None,
+        "tokens_used": 0,
+        "rpm_limit": None,
+        "tpm_limit": None,
+    } for i in range(BENCH_GEMINI_KEYS)]
+    user_keys = [{"id": "bench-user", "user_label": "bench", "key": BENCH_USER_KEY, "active": True,
+                  "created_at": "2024-01-01T00:00:00Z"}]
+    return {"projects": projects, "user_api_keys": user_keys}
+
+def install():
+    import supabase
+    db = seed()
+    supabase.create_client = lambda *args, **kwargs: FakeSupabase(db)
+    if not os.getenv("REDIS_URL"):
+        import fakeredis
+        import redis
+        import redis.asyncio
+        server = fakeredis.FakeServer()
+        sync_conn = fakeredis.FakeStrictRedis(server=server)
+        async_conn = fakeredis.FakeAsyncRedis(server=server)
+        redis.from_url = lambda *args, **kwargs: sync_conn
+        redis.asyncio.from_url = lambda *args, **kwargs: async_conn
+    return db
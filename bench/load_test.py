@@ -0,0 +1,198 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+import aiohttp
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+# Drives backend.main:app under gunicorn (fake Supabase/Redis, fake Gemini upstream) with
+# a mix of request types and reports throughput, latency percentiles and upstream calls
+# per completion for each concurrency level. Request types:
+#   completion  unique prompt            stream     unique prompt, stream: true
+#   cached      temperature 0, 20 prompts (response cache)
+#   duplicate   one shared prompt in flight many times (request coalescing)
+# Usage: python bench/load_test.py --workers 2 --levels 10,100 --mix completion=70,stream=20,cached=10
+# --max-p99-ms / --max-upstream-ratio exit non-zero when exceeded, for catching regressions.
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+REQUEST_TYPES = ("completion", "stream", "cached", "duplicate")
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(","):
+        name, weight = part.split("=")
+        if name not in REQUEST_TYPES:
+            raise SystemExit(f"unknown request type {name!r}, expected one of {', '.join(REQUEST_TYPES)}")
+        mix[name] = float(weight)
+    return mix
+
+def request_body(kind):
+    if kind == "cached":
+        return {"messages": [{"role": "user", "content": f"cached question {random.randrange(20)}"}], "temperature": 0}
+    if kind == "duplicate":
+        return {"messages": [{"role": "user", "content": "the same question"}]}
+    body = {"messages": [{"role": "user", "content": f"question {uuid.uuid4().hex}"}]}
+    if kind == "stream":
+        body["stream"] = True
+    return body
+
+def start_process(args, env):
+    return subprocess.Popen(args, cwd=ROOT, env={**os.environ, **env})
+
+async def wait_until_up(session, url, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            async with session.get(url) as resp:
+                if resp.status < 500:
+                    return
+        except aiohttp.ClientError:
+            pass
+        await asyncio.sleep(0.2)
+    raise SystemExit(f"{url} did not come up within {timeout}s")
+
+async def one_request(session, url, headers, kind):
+    start = time.perf_counter()
+    async with session.post(url, json=request_body(kind), headers=headers) as resp:
+        if kind == "stream" and resp.status == 200:
+            async for line in resp.content:
+                if line.startswith(b"data: [DONE]"):
+                    break
+        else:
+            await resp.read()
+        return kind, resp.status, time.perf_counter() - start
+
+async def run_level(session, args, concurrency, total):
+    url = f"{args.url}/v1/chat/completions"
+    headers = {"Authorization": f"Bearer {args.user_key}"}
+    kinds, weights = zip(*args.mix.items())
+    plan = random.choices(kinds, weights, k=total)
+    sem = asyncio.Semaphore(concurrency)
+    results = []
+
+    async def worker(kind):
+        async with sem:
+            try:
+                results.append(await one_request(session, url, headers, kind))
+            except Exception as e:
+                results.append((kind, type(e).__name__, 0.0))
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker(kind) for kind in plan))
+    return results, time.perf_counter() - start
+
+def percentile(ordered, pct):
+    if not ordered:
+        return 0.0
+    return ordered[min(int(len(ordered) * pct / 100), len(ordered) - 1)]
+
+async def upstream_calls(session, args, reset=False):
+    if args.gemini_url is None:
+        return None
+    async with session.request("POST" if reset else "GET",
+                               f"{args.gemini_url}/stats{'/reset' if reset else ''}") as resp:
+        # Completion calls only, not cachedContents management.
+        return sum(n for name, n in (await resp.json()).items() if name.split(":")[0] in ("generate", "stream"))
+
+async def main(args):
+    failures = []
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0),
+                                     timeout=aiohttp.ClientTimeout(total=120)) as session:
+        await wait_until_up(session, f"{args.url}/metrics")
+        print(f"mix: {', '.join(f'{k}={v:g}' for k, v in args.mix.items())}  workers: {args.workers or 'external'}")
+        print(f"{'concurrency':>11} {'requests':>8} {'req/s':>8} {'p50_ms':>8} {'p95_ms':>8} {'p99_ms':>8} "
+              f"{'upstream/ok':>11}  statuses")
+        for level in args.levels:
+            await upstream_calls(session, args, reset=True)
+            results, elapsed = await run_level(session, args, level, args.requests)
+            calls = await upstream_calls(session, args)
+            ok = [r for r in results if r[1] == 200]
+            ordered = sorted(r[2] for r in ok)
+            statuses = {}
+            for _, status, _ in results:
+                statuses[status] = statuses.get(status, 0) + 1
+            ratio = calls / len(ok) if calls is not None and ok else float("nan")
+            p99 = percentile(ordered, 99) * 1000
+            print(f"{level:>11} {len(results):>8} {len(results) / elapsed:>8.1f} {percentile(ordered, 50) * 1000:>8.0f} "
+                  f"{percentile(ordered, 95) * 1000:>8.0f} {p99:>8.0f} {ratio:>11.2f}  {json.dumps(statuses)}")
+            if args.max_p99_ms and p99 > args.max_p99_ms:
+                failures.append(f"concurrency {level}: p99 {p99:.0f} ms > {args.max_p99_ms:.0f} ms")
+            if args.max_upstream_ratio and ratio > args.max_upstream_ratio:
+                failures.append(f"concurrency {level}: {ratio:.2f} upstream calls per completion > {args.max_upstream_ratio}")
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    return 1 if failures else 0
+
+def launch(args):
+    # Returns the started processes; sets args.url and args.gemini_url.
+    processes = []
+    if args.url is None:
+        gemini_port = args.gemini_port
+        processes.append(start_process(
+            [sys.executable, "-m", "uvicorn", "bench.fake_gemini:app", "--port", str(gemini_port), "--log-level", "warning"],
+            {"FAKE_GEMINI_LATENCY_MS": str(args.latency_ms), "FAKE_GEMINI_LATENCY_DIST": args.latency_dist,
+             "FAKE_GEMINI_JITTER_MS": str(args.jitter_ms), "FAKE_GEMINI_SIGMA": str(args.sigma),
+             "FAKE_GEMINI_429_RATE": str(args.rate_429), "FAKE_GEMINI_403_RATE": str(args.rate_403),
+             "FAKE_GEMINI_500_RATE": str(args.rate_500)}))
+        args.gemini_url = f"http://127.0.0.1:{gemini_port}"
+        if args.workers > 1 and not os.getenv("REDIS_URL"):
+            print("note: no REDIS_URL, so each worker has its own in-memory Redis (limits and caches per worker)")
+        env = {
+            "WEB_CONCURRENCY": str(args.workers),
+            "BIND": f"127.0.0.1:{args.port}",
+            "GEMINI_API_BASE": f"{args.gemini_url}/v1",
+            "PROMETHEUS_MULTIPROC_DIR": tempfile.mkdtemp(prefix="ggpt-bench-metrics-"),
+            "BENCH_GEMINI_KEYS": str(args.keys),
+            "BENCH_USER_KEY": args.user_key,
+            # No RQ worker runs here, and limits are off unless asked for via --env.
+            "OVERFLOW_ENABLED": "false",
+            "RATE_LIMIT_PER_REGION": "0",
+        }
+        env.update(item.split("=", 1) for item in args.env)
+        processes.append(start_process([sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py",
+                                        "--log-level", "warning", "bench.fake_app:app"], env))
+        args.url = f"http://127.0.0.1:{args.port}"
+    return processes
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", help="benchmark an already running backend instead of starting one")
+    parser.add_argument("--gemini-url", help="fake Gemini to read upstream call counts from (with --url)")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--levels", default="10,50,100")
+    parser.add_argument("--requests", type=int, default=500, help="requests per concurrency level")
+    parser.add_argument("--mix", default="completion=70,stream=20,cached=5,duplicate=5")
+    parser.add_argument("--keys", type=int, default=4, help="fake Gemini keys, spread over regions")
+    parser.add_argument("--user-key", default="bench-user-key")
+    parser.add_argument("--latency-ms", type=float, default=200)
+    parser.add_argument("--latency-dist", choices=("uniform", "lognormal"), default="lognormal")
+    parser.add_argument("--jitter-ms", type=float, default=0)
+    parser.add_argument("--sigma", type=float, default=0.5)
+    parser.add_argument("--rate-429", type=float, default=0)
+    parser.add_argument("--rate-403", type=float, default=0)
+    parser.add_argument("--rate-500", type=float, default=0)
+    parser.add_argument("--env", action="append", default=[], help="extra backend setting, e.g. HEDGE_ENABLED=true")
+    parser.add_argument("--port", type=int, default=8800)
+    parser.add_argument("--gemini-port", type=int, default=8765)
+    parser.add_argument("--max-p99-ms", type=float)
+    parser.add_argument("--max-upstream-ratio", type=float)
+    args = parser.parse_args()
+    args.levels = [int(x) for x in args.levels.split(",")]
+    args.mix = parse_mix(args.mix)
+    processes = launch(args)
+    try:
+        status = asyncio.run(main(args))
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+    sys.exit(status)
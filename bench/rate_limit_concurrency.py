@@ -0,0 +1,81 @@
+import argparse
+import os
+import sys
+import threading
+
+import redis
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from backend.rate_limit import acquire
+
+# Hammers one sliding-window limit from many threads and checks it is never exceeded.
+# Uses an in-memory Redis stand-in (fakeredis with Lua support) unless --redis-url is given.
+# Usage: python bench/rate_limit_concurrency.py --threads 64 --attempts 50 --limit 60
+
+def make_connection_factory(redis_url):
+    if redis_url:
+        return lambda: redis.from_url(redis_url)
+    import fakeredis
+    server = fakeredis.FakeServer()
+    return lambda: fakeredis.FakeStrictRedis(server=server)
+
+def legacy_can_send_request(conn, key, limit):
+    # The GET-then-SET/INCR sequence the backend used before the Lua limiter.
+    count = conn.get(key)
+    if count is None:
+        conn.set(key, 1, ex=60)
+        return True
+    elif int(count) < limit:
+        conn.incr(key)
+        return True
+    return False
+
+def hammer(connect, attempts, threads, check):
+    allowed = []
+    barrier = threading.Barrier(threads)
+
+    def worker():
+        conn = connect()
+        barrier.wait()
+        allowed.append(sum(1 for _ in range(attempts) if check(conn)))
+
+    pool = [threading.Thread(target=worker) for _ in range(threads)]
+    for t in pool:
+        t.start()
+    for t in pool:
+        t.join()
+    return sum(allowed)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--threads", type=int, default=64)
+    parser.add_argument("--attempts", type=int, default=50)
+    parser.add_argument("--limit", type=int, default=60)
+    parser.add_argument("--redis-url")
+    args = parser.parse_args()
+    connect = make_connection_factory(args.redis_url)
+    run_id = os.urandom(4).hex()
+    total = args.threads * args.attempts
+
+    legacy = hammer(connect, args.attempts, args.threads,
+                    lambda conn: legacy_can_send_request(conn, f"bench:legacy:{run_id}", args.limit))
+    lua = hammer(connect, args.attempts, args.threads,
+                 lambda conn: acquire(conn, [(f"bench:lua:{run_id}:rpm", args.limit, 1)])[0])
+    multi = hammer(connect, args.attempts, args.threads,
+                   lambda conn: acquire(conn, [
+                       (f"bench:multi:{run_id}:region", args.limit, 1),
+                       (f"bench:multi:{run_id}:key", args.limit // 2, 1),
+                       (f"bench:multi:{run_id}:tpm", args.limit * 100, 100),
+                   ])[0])
+
+    print(f"{total} attempts from {args.threads} threads, limit {args.limit}/min")
+    print(f"legacy GET/INCR allowed: {legacy}")
+    print(f"lua sliding window allowed: {lua}")
+    print(f"lua multi-limit allowed: {multi} (tightest limit {args.limit // 2})")
+    ok = lua == args.limit and multi == args.limit // 2
+    print("OK" if ok else "FAIL: limit exceeded or under-filled")
+    sys.exit(0 if ok else 1)
+
+if __name__ == "__main__":
+    main()
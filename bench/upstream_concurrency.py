@@ -0,0 +1,64 @@
+import argparse
+import asyncio
+import os
+import sys
+import threading
+import time
+
+import uvicorn
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+# Shows how many upstream calls one worker process keeps in flight through the shared pool.
+# Usage: python bench/upstream_concurrency.py --latency-ms 500 --levels 1,10,100,500
+
+def start_fake_gemini(port):
+    from bench.fake_gemini import app
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.05)
+    return server
+
+async def run_level(concurrency, requests_per_level):
+    from backend.gemini_client import generate_content
+    payload = {"contents": [{"role": "user", "parts": [{"text": "ping"}]}]}
+    sem = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def one():
+        async with sem:
+            t0 = time.perf_counter()
+            data, status = await generate_content(payload, "bench-key", "gemini-1.5-pro")
+            latencies.append(time.perf_counter() - t0)
+            assert status == 200, data
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one() for _ in range(requests_per_level)))
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return elapsed, latencies[len(latencies) // 2], latencies[min(int(len(latencies) * 0.99), len(latencies) - 1)]
+
+async def main(args):
+    from backend.gemini_client import close_session
+    print(f"fake upstream latency: {args.latency_ms:.0f} ms")
+    print(f"{'concurrency':>11} {'requests':>8} {'elapsed_s':>9} {'req/s':>8} {'p50_ms':>8} {'p99_ms':>8}")
+    for level in args.levels:
+        total = max(level * args.rounds, level)
+        elapsed, p50, p99 = await run_level(level, total)
+        print(f"{level:>11} {total:>8} {elapsed:>9.2f} {total / elapsed:>8.1f} {p50 * 1000:>8.0f} {p99 * 1000:>8.0f}")
+    await close_session()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--latency-ms", type=float, default=500)
+    parser.add_argument("--levels", default="1,10,100,300")
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+    args.levels = [int(x) for x in args.levels.split(",")]
+    os.environ["FAKE_GEMINI_LATENCY_MS"] = str(args.latency_ms)
+    os.environ["GEMINI_API_BASE"] = f"http://127.0.0.1:{args.port}/v1"
+    start_fake_gemini(args.port)
+    asyncio.run(main(args))
@@ -0,0 +1,148 @@
+import asyncio
+import hmac
+import logging
+import os
+import signal
+import sys
+import zlib
+
+from aiohttp import web
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from supabase_client import list_bot_configs, list_user_api_keys, on_snapshot_change, start_invalidation_listener
+from backend.tracing import setup_tracing, shutdown_tracing
+from template_bot import ChildBot, open_session, close_session
+
+# Runs every active row of the bots table as a ChildBot inside one asyncio loop, sharing
+# one connection pool to the backend. Bot rows are read from the shared Redis snapshot,
+# whose change notifications reach the host as soon as the admin bot creates a bot: new
+# bots are started, removed or deactivated ones stopped, and a bot whose token changed is
+# restarted, all without touching the others. A prompt or API key change is applied in
+# place. With BOT_HOST_SHARDS > 1, each host process (BOT_HOST_SHARD = 0..N-1) runs only
+# the bots whose id hashes to it.
+#
+# With BOT_WEBHOOK_URL set (https://<domain>/tg), bots receive updates by webhook instead
+# of long polling, so idle bots make no requests at all. nginx forwards /tg/<bot_id> to the
+# hosts' webhook servers (BOT_WEBHOOK_PORT + shard); a host answers 404 for bots it does
+# not run, and nginx then tries the next shard. A bot whose webhook cannot be set falls
+# back to polling.
+
+BOT_HOST_SHARDS = int(os.getenv("BOT_HOST_SHARDS", 1))
+BOT_HOST_SHARD = int(os.getenv("BOT_HOST_SHARD", 0))
+BOT_HOST_SYNC_INTERVAL = int(os.getenv("BOT_HOST_SYNC_INTERVAL", 30))  # fallback when notifications are missed
+BOT_WEBHOOK_URL = os.getenv("BOT_WEBHOOK_URL", "").rstrip("/")  # unset: long polling
+BOT_WEBHOOK_PORT = int(os.getenv("BOT_WEBHOOK_PORT", 8081))
+
+def owns(bot_id):
+    return zlib.crc32(str(bot_id).encode()) % BOT_HOST_SHARDS == BOT_HOST_SHARD
+
+def wanted_bots():
+    # bot id -> (token, api_key, base_prompt) for the active bots of this shard.
+    api_keys = {k["id"]: k["key"] for k in list_user_api_keys() if k["active"]}
+    return {
+        str(b["id"]): (b["token"], api_keys[b["api_key_id"]], b.get("base_prompt"))
+        for b in list_bot_configs()
+        if b.get("status") == "active" and b.get("api_key_id") in api_keys and owns(b["id"])
+    }
+
+class BotHost:
+    def __init__(self):
+        self.bots = {}  # bot id -> ChildBot
+        self.changed = asyncio.Event()
+
+    def notify(self):
+        # Called from the snapshot listener thread.
+        self._loop.call_soon_threadsafe(self.changed.set)
+
+    async def sync(self):
+        try:
+            wanted = await asyncio.to_thread(wanted_bots)
+        except Exception as e:
+            logging.error(f"Could not load bots, keeping the {len(self.bots)} running: {e}")
+            return
+        for bot_id in [b for b in self.bots if b not in wanted or wanted[b][0] != self.bots[b].token]:
+            await self.stop_bot(bot_id, forget_webhook=bot_id not in wanted)
+        for bot_id, (token, api_key, base_prompt) in wanted.items():
+            bot = self.bots.get(bot_id)
+            if bot is not None:
+                bot.api_key, bot.base_prompt = api_key, base_prompt
+            else:
+                await self.start_bot(bot_id, token, api_key, base_prompt)
+
+    async def start_bot(self, bot_id, token, api_key, base_prompt):
+        bot = ChildBot(bot_id, token, api_key, base_prompt)
+        try:
+            await bot.run(BOT_WEBHOOK_URL or None)
+        except Exception as e:
+            # Retried on the next sync; a bad token must not stop the other bots.
+            logging.error(f"Bot {bot_id} failed to start: {e}")
+            return
+        self.bots[bot_id] = bot
+        logging.info(f"Bot {bot_id} started with {'webhook' if bot.webhook else 'polling'} ({len(self.bots)} running)")
+
+    async def stop_bot(self, bot_id, forget_webhook=False):
+        bot = self.bots.pop(bot_id)
+        try:
+            await bot.stop(forget_webhook)
+        except Exception as e:
+            logging.warning(f"Bot {bot_id} did not stop cleanly: {e}")
+        logging.info(f"Bot {bot_id} stopped ({len(self.bots)} running)")
+
+    async def handle_webhook(self, request):
+        bot = self.bots.get(request.match_info["bot_id"])
+        if bot is None or not bot.webhook:
+            return web.Response(status=404)
+        if not hmac.compare_digest(request.headers.get("X-Telegram-Bot-Api-Secret-Token", ""), bot.webhook_secret):
+            return web.Response(status=403)
+        try:
+            data = await request.json()
+        except ValueError:
+            return web.Response(status=400)
+        await bot.process_update(data)
+        return web.Response()
+
+    async def start_webhook_server(self):
+        webapp = web.Application()
+        webapp.router.add_post("/tg/{bot_id}", self.handle_webhook)
+        runner = web.AppRunner(webapp, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, "127.0.0.1", BOT_WEBHOOK_PORT + BOT_HOST_SHARD).start()
+        return runner
+
+    async def run(self, stop):
+        self._loop = asyncio.get_running_loop()
+        on_snapshot_change(lambda name, data: self.notify() if name in ("bots", "user_keys") else None)
+        start_invalidation_listener()
+        await open_session()
+        webhook_server = await self.start_webhook_server() if BOT_WEBHOOK_URL else None
+        try:
+            while not stop.is_set():
+                self.changed.clear()
+                await self.sync()
+                waiters = [asyncio.ensure_future(self.changed.wait()), asyncio.ensure_future(stop.wait())]
+                await asyncio.wait(waiters, timeout=BOT_HOST_SYNC_INTERVAL, return_when=asyncio.FIRST_COMPLETED)
+                for waiter in waiters:
+                    waiter.cancel()
+        finally:
+            # Stop taking webhook calls first: Telegram retries failed deliveries, while an
+            # update accepted after its bot stopped would be lost.
+            if webhook_server is not None:
+                await webhook_server.cleanup()
+            await asyncio.gather(*(self.stop_bot(bot_id) for bot_id in list(self.bots)))
+            await close_session()
+
+async def main():
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+    await BotHost().run(stop)
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    setup_tracing(f"ggpt-bot-host-{BOT_HOST_SHARD}")
+    try:
+        asyncio.run(main())
+    finally:
+        shutdown_tracing()
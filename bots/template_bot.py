@@ -1,10 +1,20 @@
+import asyncio
+import hashlib
 import os
-import requests
+import sys
 import logging
+from contextlib import asynccontextmanager
+
+import aiohttp
 from telegram import Update
 from telegram.ext import ApplicationBuilder, MessageHandler, ContextTypes, filters, CommandHandler
-from supabase import create_client
 from dotenv import load_dotenv
+from opentelemetry import trace, propagate
+from opentelemetry.trace import SpanKind
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from backend.tracing import setup_tracing, shutdown_tracing
 
 load_dotenv()
 
@@ -13,12 +23,156 @@ BOT_ID = os.getenv("BOT_ID")
 BACKEND_URL = os.getenv("BACKEND_URL", "http://127.0.0.1:8000/v1/chat/completions")
 SUPABASE_URL = os.getenv("SUPABASE_URL")
 SUPABASE_SERVICE_KEY = os.getenv("SUPABASE_SERVICE_KEY")
+BACKEND_TIMEOUT = float(os.getenv("BACKEND_TIMEOUT", 60))
+BOT_CONCURRENCY = int(os.getenv("BOT_CONCURRENCY", 64))  # updates handled at once, per bot
+BACKEND_MAX_CONNECTIONS = int(os.getenv("BACKEND_MAX_CONNECTIONS", 256))
+BOT_MEMORY = os.getenv("BOT_MEMORY", "true").lower() == "true"  # multi-turn chats, history kept by the backend
+BOT_WEBHOOK_MAX_CONNECTIONS = int(os.getenv("BOT_WEBHOOK_MAX_CONNECTIONS", 40))  # Telegram's parallel deliveries, per bot
+
+# Tracing uses the backend's settings and setup: each reply is a trace, and its
+# traceparent is passed to the backend so the backend's spans join it.
+tracer = trace.get_tracer("ggpt.bot")
+
+# Updates are handled concurrently (up to BOT_CONCURRENCY per bot), so one slow Gemini
+# reply no longer holds up other chats; messages from the same chat still run one at a
+# time, in the order they arrived. All bots in a process share one keep-alive pool.
+_session = None
+
+async def open_session():
+    global _session
+    if _session is None:
+        _session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=BACKEND_TIMEOUT),
+                                         connector=aiohttp.TCPConnector(limit=BACKEND_MAX_CONNECTIONS,
+                                                                        keepalive_timeout=60))
+    return _session
+
+async def close_session():
+    global _session
+    if _session is not None:
+        await _session.close()
+        _session = None
+
+class ChildBot:
+    # One Telegram bot answering through the backend with its own user API key and base
+    # prompt. Run standalone below, or many per process by bots/host.py.
+    def __init__(self, bot_id, token, api_key, base_prompt):
+        self.bot_id = str(bot_id)
+        self.token = token
+        self.api_key = api_key
+        self.base_prompt = base_prompt
+        self.webhook = False
+        self._chat_locks = {}  # chat id -> [asyncio.Lock, updates holding or waiting for it]
+        self.app = ApplicationBuilder().token(token).concurrent_updates(BOT_CONCURRENCY).build()
+        self.app.add_handler(CommandHandler("start", self.start))
+        self.app.add_handler(CommandHandler("reset", self.reset))
+        self.app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, self.handle_message))
+
+    @asynccontextmanager
+    async def chat_turn(self, chat_id):
+        entry = self._chat_locks.setdefault(chat_id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._chat_locks[chat_id]
 
-supabase = create_client(SUPABASE_URL, SUPABASE_SERVICE_KEY)
+    async def handle_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        async with self.chat_turn(update.effective_chat.id):
+            with tracer.start_as_current_span("bot.reply", attributes={"bot.id": self.bot_id}):
+                await self.reply_to_message(update)
+
+    async def reply_to_message(self, update):
+        user_message = update.message.text
+        messages = []
+        if self.base_prompt:
+            messages.append({"role": "system", "content": self.base_prompt})
+        messages.append({"role": "user", "content": user_message})
+        headers = {"Authorization": f"Bearer {self.api_key}"}
+        if BOT_MEMORY:
+            # The backend adds this chat's earlier turns between the base prompt and the message.
+            headers["X-Conversation-Id"] = self.conversation_id(update.effective_chat.id)
+        payload = {
+            "model": "gpt-4",
+            "messages": messages,
+            "temperature": 0.7,
+            "max_tokens": 1024
+        }
+        try:
+            session = await open_session()
+            with tracer.start_as_current_span("backend.chat_completions", kind=SpanKind.CLIENT) as span:
+                propagate.inject(headers)
+                async with session.post(BACKEND_URL, json=payload, headers=headers) as resp:
+                    span.set_attribute("http.response.status_code", resp.status)
+                    data = await resp.json(content_type=None)
+            if resp.status == 200:
+                reply = data["choices"][0]["message"]["content"]
+            else:
+                reply = data.get("error", {}).get("message", "API error")
+        except Exception as e:
+            reply = f"Error: {e}"
+        with tracer.start_as_current_span("telegram.send_reply"):
+            await update.message.reply_text(reply)
+
+    async def start(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        await update.message.reply_text("Welcome! Send me a message and I'll reply using Gemini.")
+
+    def conversation_id(self, chat_id):
+        return f"{self.bot_id}:{chat_id}"
+
+    async def reset(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        url = f"{BACKEND_URL.rsplit('/chat/completions', 1)[0]}/conversations/{self.conversation_id(update.effective_chat.id)}"
+        try:
+            session = await open_session()
+            async with session.delete(url, headers={"Authorization": f"Bearer {self.api_key}"}) as resp:
+                reply = "Conversation cleared." if resp.status == 200 else "Could not clear the conversation."
+        except Exception as e:
+            reply = f"Error: {e}"
+        await update.message.reply_text(reply)
+
+    @property
+    def webhook_secret(self):
+        # Telegram sends this back in X-Telegram-Bot-Api-Secret-Token with every update.
+        return hashlib.sha256(f"ggpt-webhook:{self.token}".encode()).hexdigest()
+
+    async def run(self, webhook_url=None):
+        # Returns once the bot is receiving updates: pushed by Telegram to webhook_url/<bot id>
+        # (delivered through process_update), or by long polling when no URL is given or
+        # Telegram rejects it.
+        await self.app.initialize()
+        await self.app.start()
+        if webhook_url:
+            try:
+                await self.app.bot.set_webhook(f"{webhook_url}/{self.bot_id}", secret_token=self.webhook_secret,
+                                               max_connections=BOT_WEBHOOK_MAX_CONNECTIONS)
+                self.webhook = True
+                return
+            except Exception as e:
+                logging.warning(f"Bot {self.bot_id}: could not set webhook, polling instead: {e}")
+        await self.app.updater.start_polling()  # also removes any webhook left from webhook mode
+
+    async def process_update(self, data):
+        await self.app.update_queue.put(Update.de_json(data, self.app.bot))
+
+    async def stop(self, forget_webhook=False):
+        # The webhook is kept on a normal shutdown so Telegram holds updates until the bot is
+        # back; forget_webhook is for bots that were removed.
+        if self.webhook and forget_webhook:
+            try:
+                await self.app.bot.delete_webhook()
+            except Exception as e:
+                logging.warning(f"Bot {self.bot_id}: could not delete webhook: {e}")
+        if self.app.updater.running:
+            await self.app.updater.stop()
+        if self.app.running:
+            await self.app.stop()
+        await self.app.shutdown()
 
 # Fetch API key and base prompt for this bot
-def get_api_key_and_prompt():
-    bot = supabase.table("bots").select("api_key_id, base_prompt").eq("id", BOT_ID).single().execute()
+def get_api_key_and_prompt(supabase, bot_id):
+    bot = supabase.table("bots").select("api_key_id, base_prompt").eq("id", bot_id).single().execute()
     if not hasattr(bot, 'data') or not bot.data:
         return None, None
     api_key_id = bot.data["api_key_id"]
@@ -27,38 +181,24 @@ def get_api_key_and_prompt():
     api_key = key_row.data["key"] if hasattr(key_row, 'data') and key_row.data else None
     return api_key, base_prompt
 
-API_KEY, BASE_PROMPT = get_api_key_and_prompt()
-
-async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_message = update.message.text
-    messages = []
-    if BASE_PROMPT:
-        messages.append({"role": "user", "content": BASE_PROMPT})
-    messages.append({"role": "user", "content": user_message})
-    headers = {"Authorization": f"Bearer {API_KEY}"}
-    payload = {
-        "model": "gpt-4",
-        "messages": messages,
-        "temperature": 0.7,
-        "max_tokens": 1024
-    }
+async def run_standalone():
+    from supabase import create_client
+    supabase = create_client(SUPABASE_URL, SUPABASE_SERVICE_KEY)
+    api_key, base_prompt = get_api_key_and_prompt(supabase, BOT_ID)
+    bot = ChildBot(BOT_ID, TELEGRAM_BOT_TOKEN, api_key, base_prompt)
+    await bot.run()
     try:
-        resp = requests.post(BACKEND_URL, json=payload, headers=headers, timeout=30)
-        data = resp.json()
-        if resp.status_code == 200:
-            reply = data["choices"][0]["message"]["content"]
-        else:
-            reply = data.get("error", {}).get("message", "API error")
-    except Exception as e:
-        reply = f"Error: {e}"
-    await update.message.reply_text(reply)
-
-async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text("Welcome! Send me a message and I'll reply using Gemini.")
+        await asyncio.Event().wait()
+    finally:
+        await bot.stop()
+        await close_session()
 
 if __name__ == "__main__":
+    # One bot per process, configured by BOT_TOKEN and BOT_ID. Deployments normally run
+    # every bot inside bots/host.py instead.
     logging.basicConfig(level=logging.INFO)
-    app = ApplicationBuilder().token(TELEGRAM_BOT_TOKEN).build()
-    app.add_handler(CommandHandler("start", start))
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
-    app.run_polling() 
\ No newline at end of file
+    setup_tracing(f"ggpt-bot-{BOT_ID}")
+    try:
+        asyncio.run(run_standalone())
+    finally:
+        shutdown_tracing()
@@ -0,0 +1,34 @@
+import multiprocessing
+import os
+import shutil
+
+# Gunicorn settings for backend.main:app. Workers are async (uvicorn), so one per CPU
+# core keeps every core busy; shared state (rate limits, cooldowns, key snapshots, auth
+# invalidation) lives in Redis, so workers and hosts can be added freely.
+
+def _cpu_count():
+    try:
+        # Honors CPU pinning/cgroup cpusets, unlike multiprocessing.cpu_count().
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return multiprocessing.cpu_count()
+
+bind = os.getenv("BIND", "127.0.0.1:8000")
+worker_class = "uvicorn.workers.UvicornWorker"
+workers = int(os.getenv("WEB_CONCURRENCY", max(2, _cpu_count())))
+timeout = int(os.getenv("GUNICORN_TIMEOUT", 120))  # streamed completions can run long
+graceful_timeout = 30
+keepalive = 5
+
+# Prometheus multiprocess mode: workers write their samples under this directory and
+# /metrics merges them. It must be set before the workers import the app.
+PROMETHEUS_MULTIPROC_DIR = os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", "/tmp/ggpt-metrics")
+
+def on_starting(server):
+    # Samples left by a previous run would be merged into the new one.
+    shutil.rmtree(PROMETHEUS_MULTIPROC_DIR, ignore_errors=True)
+    os.makedirs(PROMETHEUS_MULTIPROC_DIR, exist_ok=True)
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
@@ -7,10 +7,16 @@ create table if not exists projects (
   model_name text,
   token_limit int default 250000,
   tokens_used int default 0,
+  rpm_limit int,
+  tpm_limit int,
   active boolean default true,
   last_used_at timestamptz
 );
 
+-- Per-key rate limits (null = use the backend's RATE_LIMIT_PER_KEY / RATE_LIMIT_TPM_PER_KEY)
+alter table projects add column if not exists rpm_limit int;
+alter table projects add column if not exists tpm_limit int;
+
 -- Users: Telegram admins and (optionally) end users
 create table if not exists users (
   id uuid primary key default uuid_generate_v4(),
@@ -22,7 +28,7 @@ create table if not exists users (
 -- Usage logs: Track API usage per project/user
 create table if not exists usage_logs (
   id uuid primary key default uuid_generate_v4(),
-  project_id uuid references projects(id),
+  project_id uuid references projects(id) on delete set null,
   user_id uuid references users(id),
   prompt_tokens int,
   response_tokens int,
@@ -48,4 +54,22 @@ create table if not exists bots (
   base_prompt text,
   api_key_id uuid references user_api_keys(id),
   created_at timestamptz default now()
-); 
\ No newline at end of file
+);
+
+-- Usage logs: which user API key made the request (added after user_api_keys exists)
+alter table usage_logs add column if not exists user_api_key_id uuid references user_api_keys(id);
+
+-- Usage logs: removing a Gemini key keeps its usage rows, detached from the key
+alter table usage_logs drop constraint if exists usage_logs_project_id_fkey;
+alter table usage_logs add constraint usage_logs_project_id_fkey
+  foreign key (project_id) references projects(id) on delete set null;
+
+-- Batched per-project usage increments from the backend's usage flusher
+create or replace function increment_project_usage(updates jsonb)
+returns void language sql as $$
+  update projects p
+  set tokens_used = coalesce(p.tokens_used, 0) + (u->>'tokens')::int,
+      last_used_at = greatest(p.last_used_at, (u->>'last_used_at')::timestamptz)
+  from jsonb_array_elements(updates) u
+  where p.id = (u->>'project_id')::uuid;
+$$;
@@ -19,14 +19,15 @@ def get_yesterday_stats():
     start = datetime(yesterday.year, yesterday.month, yesterday.day)
     end = datetime(today.year, today.month, today.day)
     # Query usage_logs for yesterday
-    res = supabase.table("usage_logs").select("user_id, project_id, prompt_tokens, response_tokens, total_tokens, timestamp").gte("timestamp", start.isoformat()).lt("timestamp", end.isoformat()).execute()
+    res = supabase.table("usage_logs").select("user_id, user_api_key_id, project_id, prompt_tokens, response_tokens, total_tokens, timestamp").gte("timestamp", start.isoformat()).lt("timestamp", end.isoformat()).execute()
     logs = res.data if hasattr(res, 'data') else []
     total_requests = len(logs)
     total_tokens = sum(l.get("total_tokens", 0) for l in logs)
     # Top users
     user_counts = {}
     for l in logs:
-        uid = l.get("user_id")
+        # API traffic is attributed to the user API key; older rows only carry user_id.
+        uid = ("key", l["user_api_key_id"]) if l.get("user_api_key_id") else ("user", l.get("user_id"))
         user_counts[uid] = user_counts.get(uid, 0) + 1
     top_users = sorted(user_counts.items(), key=lambda x: x[1], reverse=True)[:3]
     # Top bots/projects
@@ -45,6 +46,12 @@ def get_user_label(user_id):
         return res.data.get("user_label") or str(res.data.get("telegram_id"))
     return str(user_id)
 
+def get_api_key_label(key_id):
+    res = supabase.table("user_api_keys").select("user_label").eq("id", key_id).single().execute()
+    if hasattr(res, 'data') and res.data:
+        return res.data.get("user_label") or str(key_id)
+    return str(key_id)
+
 def get_bot_label(project_id):
     if not project_id:
         return "Unknown"
@@ -66,8 +73,8 @@ def main():
     msg += f"- Total requests: {total_requests}\n"
     msg += f"- Total tokens used: {total_tokens}\n"
     msg += "- Top users:\n"
-    for uid, count in top_users:
-        label = get_user_label(uid)
+    for (kind, uid), count in top_users:
+        label = get_api_key_label(uid) if kind == "key" else get_user_label(uid)
         msg += f"  - {label}: {count} requests\n"
     msg += "- Top bots/projects:\n"
     for pid, count in top_bots:
@@ -91,6 +91,12 @@ echo "DEFAULT_REGIONS=$DEFAULT_REGIONS" >> $envfile
 echo "RATE_LIMIT_PER_REGION=$RATE_LIMIT_PER_REGION" >> $envfile
 echo "USE_SEARCH_GROUNDING=$USE_SEARCH_GROUNDING" >> $envfile
 echo "REDIS_URL=redis://localhost:6379/0" >> $envfile
+# Child bots get updates by webhook through nginx (remove this line to use long polling)
+BOT_HOST_SHARDS=${BOT_HOST_SHARDS:-1}
+BOT_WEBHOOK_PORT=${BOT_WEBHOOK_PORT:-8081}
+echo "BOT_WEBHOOK_URL=https://$DOMAIN/tg" >> $envfile
+echo "BOT_WEBHOOK_PORT=$BOT_WEBHOOK_PORT" >> $envfile
+echo "BOT_HOST_SHARDS=$BOT_HOST_SHARDS" >> $envfile
 
 # 3. Install system dependencies
 sudo apt update
@@ -117,7 +123,11 @@ template="setup/nginx.conf.template"
 nginx_conf="/etc/nginx/sites-available/$DOMAIN"
 sudo cp $template $nginx_conf
 tmpfile=$(mktemp)
-sed "s/{{DOMAIN}}/$DOMAIN/g" $template > $tmpfile
+BOT_HOST_UPSTREAMS=""
+for shard in $(seq 0 $((BOT_HOST_SHARDS - 1))); do
+  BOT_HOST_UPSTREAMS="$BOT_HOST_UPSTREAMS server 127.0.0.1:$((BOT_WEBHOOK_PORT + shard));"
+done
+sed -e "s/{{DOMAIN}}/$DOMAIN/g" -e "s/{{BOT_HOST_UPSTREAMS}}/$BOT_HOST_UPSTREAMS/" $template > $tmpfile
 sudo mv $tmpfile $nginx_conf
 sudo ln -sf $nginx_conf /etc/nginx/sites-enabled/$DOMAIN
 sudo rm -f /etc/nginx/sites-enabled/default
@@ -136,7 +146,7 @@ sudo certbot certonly --standalone \
 sudo systemctl start nginx
 
 
-# 8. Create systemd service for backend
+# 8. Create systemd service for backend (one worker per CPU core; override with WEB_CONCURRENCY in .env)
 sudo tee /etc/systemd/system/ggpt-backend.service > /dev/null <<EOL
 [Unit]
 Description=GGPT Backend Service
@@ -146,7 +156,7 @@ After=network.target
 User=$USER
 WorkingDirectory=$(pwd)
 EnvironmentFile=$(pwd)/.env
-ExecStart=$(pwd)/.venv/bin/gunicorn -k uvicorn.workers.UvicornWorker backend.main:app --bind 127.0.0.1:8000
+ExecStart=$(pwd)/.venv/bin/gunicorn -c $(pwd)/gunicorn.conf.py backend.main:app
 Restart=always
 
 [Install]
@@ -170,17 +180,56 @@ Restart=always
 WantedBy=multi-user.target
 EOL
 
-# 10. Create systemd service for RQ worker (Gemini queue)
+# 10. Create systemd service for the Gemini queue consumer (admission queue and async jobs)
+# Queued completions mostly wait for rate-limit budget, so one process keeps many in flight
+# (OVERFLOW_CONCURRENCY in .env, default 64); queues drain high first.
 sudo tee /etc/systemd/system/ggpt-rq-worker.service > /dev/null <<EOL
 [Unit]
-Description=GGPT RQ Worker (Gemini Queue)
+Description=GGPT Queue Consumer (Gemini Queue)
+After=network.target
+
+[Service]
+User=$USER
+WorkingDirectory=$(pwd)
+EnvironmentFile=$(pwd)/.env
+ExecStart=$(pwd)/.venv/bin/python3 -m backend.overflow_worker
+Restart=always
+
+[Install]
+WantedBy=multi-user.target
+EOL
+
+# 10b. Create systemd service for Batch API runners (one running batch per worker)
+BATCH_WORKERS=${BATCH_WORKERS:-2}
+sudo tee /etc/systemd/system/ggpt-batch-worker.service > /dev/null <<EOL
+[Unit]
+Description=GGPT Batch Worker (Batch API)
 After=network.target
 
 [Service]
 User=$USER
 WorkingDirectory=$(pwd)
 EnvironmentFile=$(pwd)/.env
-ExecStart=$(pwd)/.venv/bin/rq worker gemini_requests
+ExecStart=$(pwd)/.venv/bin/rq worker-pool -n $BATCH_WORKERS gemini_batches
+Restart=always
+
+[Install]
+WantedBy=multi-user.target
+EOL
+
+# 10c. Create systemd template for the child bot host (all bots in the bots table, in one process)
+# Large fleets can be split over BOT_HOST_SHARDS processes; each instance runs the bots hashed to it.
+sudo tee /etc/systemd/system/ggpt-bot-host@.service > /dev/null <<EOL
+[Unit]
+Description=GGPT Child Bot Host (shard %i)
+After=network.target redis-server.service
+
+[Service]
+User=$USER
+WorkingDirectory=$(pwd)
+EnvironmentFile=$(pwd)/.env
+Environment=BOT_HOST_SHARD=%i
+ExecStart=$(pwd)/.venv/bin/python3 bots/host.py
 Restart=always
 
 [Install]
@@ -192,9 +241,15 @@ sudo systemctl daemon-reload
 sudo systemctl enable ggpt-backend.service
 sudo systemctl enable ggpt-telegram-bot.service
 sudo systemctl enable ggpt-rq-worker.service
+sudo systemctl enable ggpt-batch-worker.service
 sudo systemctl restart ggpt-backend.service
 sudo systemctl restart ggpt-telegram-bot.service
 sudo systemctl restart ggpt-rq-worker.service
+sudo systemctl restart ggpt-batch-worker.service
+for shard in $(seq 0 $((BOT_HOST_SHARDS - 1))); do
+    sudo systemctl enable ggpt-bot-host@$shard.service
+    sudo systemctl restart ggpt-bot-host@$shard.service
+done
 sudo systemctl restart nginx
 
 # 12. Make all shell scripts executable
@@ -205,12 +260,14 @@ chmod +x send_daily_usage_report.py
 echo "\nSetup complete!"
 echo "Your API is available at: https://$DOMAIN/v1/chat/completions"
 echo "Telegram admin bot is running."
-echo "RQ worker and Redis are running for Gemini queue."
+echo "The queue consumer, batch workers and Redis are running for the Gemini queues."
 echo "All services are managed by systemd."
 echo "You can check logs with:"
 echo "  sudo journalctl -u ggpt-backend -f"
 echo "  sudo journalctl -u ggpt-telegram-bot -f"
 echo "  sudo journalctl -u ggpt-rq-worker -f"
+echo "  sudo journalctl -u ggpt-batch-worker -f"
+echo "  sudo journalctl -u 'ggpt-bot-host@*' -f"
 echo "  sudo journalctl -u redis-server -f"
 echo "\nTo enable daily usage reports, add this to your crontab (crontab -e):"
 echo "0 0 * * * cd $(pwd) && .venv/bin/python3 send_daily_usage_report.py" 
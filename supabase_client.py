@@ -1,48 +1,226 @@
 import os
 import secrets
+import hashlib
+import json
+import logging
+import threading
+from collections import OrderedDict
 from supabase import create_client, Client
 from datetime import datetime
 import time
+import redis
+import redis.asyncio
 
 SUPABASE_URL = os.getenv("SUPABASE_URL")
 SUPABASE_SERVICE_KEY = os.getenv("SUPABASE_SERVICE_KEY")
 
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+
 supabase: Client = create_client(SUPABASE_URL, SUPABASE_SERVICE_KEY)
 
-# --- Gemini Key Caching ---
-_list_keys_cache = {"data": None, "ts": 0}
-_LIST_KEYS_TTL = 300  # seconds
+_redis = None
+_async_redis = None
 
-def list_keys():
-    now = time.time()
-    if _list_keys_cache["data"] is not None and now - _list_keys_cache["ts"] < _LIST_KEYS_TTL:
-        return _list_keys_cache["data"]
-    res = supabase.table("projects").select("id, name, region, api_key, model_name, active").execute()
+def get_redis():
+    global _redis
+    if _redis is None:
+        _redis = redis.from_url(REDIS_URL)
+    return _redis
+
+def get_async_redis():
+    # For code running on the event loop (pub/sub waits); created lazily per process.
+    global _async_redis
+    if _async_redis is None:
+        _async_redis = redis.asyncio.from_url(REDIS_URL)
+    return _async_redis
+
+# --- Shared Key Snapshots ---
+# The projects, user_api_keys and bots tables are snapshotted into Redis with a version number.
+# Writers (admin bot, backend) rebuild the snapshot and publish its new version on
+# STATE_CHANNEL, and every process with a listener swaps in the new copy as soon as the
+# message arrives, so a remove_key is visible to all workers and hosts at once. Processes
+# without a listener compare versions on each read. Snapshots expire after
+# STATE_SNAPSHOT_TTL so edits made directly in Supabase are picked up too. If Redis is
+# unreachable, each process falls back to its own short-lived copy read from Supabase.
+# Secrets (Gemini api_key, user key, bot token) never go into Redis: the snapshot there has
+# them stripped, and each process reads them from Supabase by id when it meets a row it has
+# no secret for, or its copy of the secrets is older than STATE_SNAPSHOT_TTL.
+STATE_SNAPSHOT_TTL = int(os.getenv("STATE_SNAPSHOT_TTL", 300))
+STATE_FALLBACK_TTL = 30  # seconds a copy read straight from Supabase is trusted
+STATE_CHANNEL = "state_changed"
+_SNAPSHOT_QUERIES = {
+    "keys": ("projects", "id, name, region, api_key, model_name, active, token_limit, tokens_used, rpm_limit, tpm_limit"),
+    "user_keys": ("user_api_keys", "id, user_label, key, active, created_at"),
+    "bots": ("bots", "id, name, token, status, base_prompt, api_key_id"),
+}
+_SNAPSHOT_SECRETS = {"keys": "api_key", "user_keys": "key", "bots": "token"}
+_snapshots = {}  # name -> {"data", "version", "expires"}, secrets included
+_secrets = {}  # name -> {"values": {row id: secret}, "expires"}
+_snapshot_callbacks = []
+_listening = False
+
+# New version, snapshot and notification in one step, so readers never see them disagree.
+_PUBLISH_SNAPSHOT_LUA = """
+local version = redis.call('INCR', KEYS[2])
+redis.call('HSET', KEYS[1], 'version', version, 'data', ARGV[1])
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+redis.call('PUBLISH', ARGV[3], ARGV[4] .. ':' .. version)
+return version
+"""
+_publish_snapshot_script = None
+
+def _snapshot_key(name):
+    return f"state:{name}"
+
+def _version_key(name):
+    return f"state:{name}:version"
+
+def _fetch_table(name):
+    table, columns = _SNAPSHOT_QUERIES[name]
+    res = supabase.table(table).select(columns).execute()
     data = res.data if hasattr(res, 'data') else []
-    _list_keys_cache["data"] = data
-    _list_keys_cache["ts"] = now
+    column = _SNAPSHOT_SECRETS[name]
+    _secrets[name] = {"values": {row["id"]: row[column] for row in data},
+                      "expires": time.time() + STATE_SNAPSHOT_TTL}
     return data
 
-def add_key(name, region, api_key, model_name):
-    return supabase.table("projects").insert({"name": name, "region": region, "api_key": api_key, "model_name": model_name, "active": True}).execute()
+def _without_secrets(name, data):
+    column = _SNAPSHOT_SECRETS[name]
+    return [{k: v for k, v in row.items() if k != column} for row in data]
 
-def remove_key(key_id):
-    return supabase.table("projects").delete().eq("id", key_id).execute()
+def _with_secrets(name, data):
+    # Puts this process's copy of the secrets back into rows read from Redis.
+    table, _ = _SNAPSHOT_QUERIES[name]
+    column = _SNAPSHOT_SECRETS[name]
+    ids = {row["id"] for row in data}
+    entry = _secrets.get(name)
+    if ids and (entry is None or entry["expires"] <= time.time() or not ids <= entry["values"].keys()):
+        res = supabase.table(table).select(f"id, {column}").in_("id", list(ids)).execute()
+        rows = res.data if hasattr(res, 'data') else []
+        entry = _secrets[name] = {"values": {row["id"]: row[column] for row in rows},
+                                  "expires": time.time() + STATE_SNAPSHOT_TTL}
+    values = entry["values"] if entry is not None else {}
+    return [dict(row, **{column: values.get(row["id"])}) for row in data]
 
-# --- User API Key Caching ---
-_list_user_keys_cache = {"data": None, "ts": 0}
-_LIST_USER_KEYS_TTL = 300  # seconds
+def _remember(name, data, version):
+    current = _snapshots.get(name)
+    if current is not None and None not in (version, current["version"]) and version < current["version"]:
+        return
+    ttl = STATE_SNAPSHOT_TTL if version is not None else STATE_FALLBACK_TTL
+    _snapshots[name] = {"data": data, "version": version, "expires": time.time() + ttl}
+    if current is None or current["data"] is not data:
+        for callback in _snapshot_callbacks:
+            try:
+                callback(name, data)
+            except Exception as e:
+                logging.warning(f"Snapshot callback for {name} failed: {e}")
 
-def list_user_api_keys():
+def on_snapshot_change(callback):
+    # callback(name, data) runs whenever this process takes in a new copy of a snapshot.
+    _snapshot_callbacks.append(callback)
+
+def publish_snapshot(name):
+    # Rebuilds a snapshot from Supabase and announces it to every process.
+    global _publish_snapshot_script
+    data = _fetch_table(name)
+    if _publish_snapshot_script is None:
+        _publish_snapshot_script = get_redis().register_script(_PUBLISH_SNAPSHOT_LUA)
+    version = _publish_snapshot_script(keys=[_snapshot_key(name), _version_key(name)],
+                                       args=[json.dumps(_without_secrets(name, data)), STATE_SNAPSHOT_TTL,
+                                             STATE_CHANNEL, name])
+    _remember(name, data, version)
+    return data, version
+
+def refresh_snapshot(name):
+    # Called after every write to the underlying table.
+    try:
+        publish_snapshot(name)
+    except redis.RedisError as e:
+        logging.warning(f"Snapshot publish for {name} failed, other workers catch up within their TTL: {e}")
+        _snapshots.pop(name, None)
+
+def renew_snapshot(name, margin):
+    # Rebuilds the snapshot before it expires, so no reader has to. If Supabase can't be
+    # reached the current snapshot is kept alive a little longer (retried once it is back
+    # within margin) and the error re-raised.
+    conn = get_redis()
+    if conn.ttl(_snapshot_key(name)) > margin:
+        return False
+    lock = f"{_snapshot_key(name)}:rebuild"
+    if not conn.set(lock, 1, nx=True, ex=10):
+        return False
+    try:
+        publish_snapshot(name)
+        return True
+    except redis.RedisError:
+        raise
+    except Exception:
+        conn.expire(_snapshot_key(name), margin + STATE_FALLBACK_TTL)
+        raise
+    finally:
+        conn.delete(lock)
+
+def _load_snapshot(name):
+    raw_version, raw_data = get_redis().hmget(_snapshot_key(name), "version", "data")
+    if raw_version is not None:
+        return _with_secrets(name, json.loads(raw_data)), int(raw_version)
+    # Missing or expired: one process rebuilds it, the others read Supabase this once.
+    lock = f"{_snapshot_key(name)}:rebuild"
+    if get_redis().set(lock, 1, nx=True, ex=10):
+        try:
+            return publish_snapshot(name)
+        finally:
+            get_redis().delete(lock)
+    return _fetch_table(name), None
+
+def _snapshot(name):
+    entry = _snapshots.get(name)
     now = time.time()
-    if _list_user_keys_cache["data"] is not None and now - _list_user_keys_cache["ts"] < _LIST_USER_KEYS_TTL:
-        return _list_user_keys_cache["data"]
-    res = supabase.table("user_api_keys").select("id, user_label, key, active, created_at").execute()
-    data = res.data if hasattr(res, 'data') else []
-    _list_user_keys_cache["data"] = data
-    _list_user_keys_cache["ts"] = now
+    try:
+        if entry is not None and entry["expires"] > now:
+            if _listening:
+                return entry["data"]
+            version = get_redis().get(_version_key(name))
+            if version is not None and entry["version"] is not None and int(version) <= entry["version"]:
+                return entry["data"]
+        data, version = _load_snapshot(name)
+    except redis.RedisError as e:
+        logging.warning(f"Snapshot read for {name} failed, using Supabase directly: {e}")
+        if entry is not None and entry["expires"] > now:
+            return entry["data"]
+        data, version = _fetch_table(name), None
+    _remember(name, data, version)
     return data
 
+def _apply_state_change(message):
+    name, version = message.rsplit(":", 1)
+    current = _snapshots.get(name)
+    if current is not None and current["version"] is not None and current["version"] >= int(version):
+        return
+    data, version = _load_snapshot(name)
+    _remember(name, data, version)
+
+def list_keys():
+    return _snapshot("keys")
+
+def add_key(name, region, api_key, model_name):
+    res = supabase.table("projects").insert({"name": name, "region": region, "api_key": api_key, "model_name": model_name, "active": True}).execute()
+    refresh_snapshot("keys")
+    return res
+
+def deactivate_key(key_id):
+    res = supabase.table("projects").update({"active": False}).eq("id", key_id).execute()
+    refresh_snapshot("keys")
+    return res
+
+def remove_key(key_id):
+    res = supabase.table("projects").delete().eq("id", key_id).execute()
+    refresh_snapshot("keys")
+    return res
+
+def list_user_api_keys():
+    return _snapshot("user_keys")
+
 def create_user_api_key(user_label):
     api_key = secrets.token_urlsafe(32)
     now = datetime.utcnow().isoformat()
@@ -52,17 +230,106 @@ def create_user_api_key(user_label):
         "active": True,
         "created_at": now
     }).execute()
+    publish_auth_invalidation([api_key])
+    refresh_snapshot("user_keys")
     return api_key if res else None
 
 def revoke_user_api_key(key_id):
     result = supabase.table("user_api_keys").update({"active": False}).eq("id", key_id).execute()
-    _list_user_keys_cache["data"] = None
-    _list_user_keys_cache["ts"] = 0
+    rows = result.data if hasattr(result, 'data') and result.data else []
+    publish_auth_invalidation([r["key"] for r in rows if r.get("key")])
+    refresh_snapshot("user_keys")
     return result
 
+# --- Authenticated User Key Cache ---
+# Keyed by sha256 of the key so raw keys are never held in memory. Bad keys are cached
+# too (for a shorter time) so a client hammering with a wrong key never reaches Supabase.
+# Revoke/create publish the affected hashes to every worker; the TTL bounds staleness if
+# a message is lost.
+_AUTH_CACHE_TTL = int(os.getenv("AUTH_CACHE_TTL", 60))
+_AUTH_NEGATIVE_TTL = int(os.getenv("AUTH_NEGATIVE_TTL", 10))
+_AUTH_CACHE_MAX = int(os.getenv("AUTH_CACHE_MAX", 10000))
+AUTH_INVALIDATION_CHANNEL = "auth_invalidate"
+_auth_cache = OrderedDict()  # key hash -> (user_api_keys.id or None, expires_at)
+_auth_cache_lock = threading.Lock()
+
+def _hash_key(api_key):
+    return hashlib.sha256(api_key.encode()).hexdigest()
+
+def owner_scope(api_key):
+    # Short hash of a user API key that scopes its Redis state (jobs, batches, caches,
+    # conversations, limits) without storing the key itself.
+    return _hash_key(api_key)[:16]
+
+def peek_user_api_key(api_key):
+    # Returns True/False from cache, or None if the key has to be looked up.
+    entry = _auth_cache.get(_hash_key(api_key))
+    if entry is not None and entry[1] > time.monotonic():
+        return entry[0] is not None
+    return None
+
+def cached_user_api_key_id(api_key):
+    # The user_api_keys.id of a key validated recently by this process, else None.
+    entry = _auth_cache.get(_hash_key(api_key))
+    return entry[0] if entry is not None else None
+
 def is_valid_user_api_key(api_key):
+    key_hash = _hash_key(api_key)
+    entry = _auth_cache.get(key_hash)
+    now = time.monotonic()
+    if entry is not None and entry[1] > now:
+        return entry[0] is not None
     res = supabase.table("user_api_keys").select("id").eq("key", api_key).eq("active", True).execute()
-    return bool(res.data)
+    key_id = res.data[0]["id"] if res.data else None
+    valid = key_id is not None
+    with _auth_cache_lock:
+        _auth_cache[key_hash] = (key_id, now + (_AUTH_CACHE_TTL if valid else _AUTH_NEGATIVE_TTL))
+        _auth_cache.move_to_end(key_hash)
+        while len(_auth_cache) > _AUTH_CACHE_MAX:
+            _auth_cache.popitem(last=False)
+    return valid
+
+def _drop_auth_entries(hashes):
+    with _auth_cache_lock:
+        for key_hash in hashes:
+            _auth_cache.pop(key_hash, None)
+
+def publish_auth_invalidation(api_keys):
+    hashes = [_hash_key(k) for k in api_keys]
+    _drop_auth_entries(hashes)
+    if not hashes:
+        return
+    try:
+        get_redis().publish(AUTH_INVALIDATION_CHANNEL, json.dumps(hashes))
+    except Exception as e:
+        logging.warning(f"Auth invalidation publish failed, relying on TTL: {e}")
+
+def _invalidation_loop():
+    global _listening
+    while True:
+        try:
+            pubsub = get_redis().pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(AUTH_INVALIDATION_CHANNEL, STATE_CHANNEL)
+            # Anything published while we were disconnected is lost, so start clean.
+            with _auth_cache_lock:
+                _auth_cache.clear()
+            _snapshots.clear()
+            _listening = True
+            for message in pubsub.listen():
+                if message["channel"] == STATE_CHANNEL.encode():
+                    _apply_state_change(message["data"].decode())
+                else:
+                    _drop_auth_entries(json.loads(message["data"]))
+        except Exception as e:
+            _listening = False
+            logging.warning(f"Invalidation listener error: {e}")
+            time.sleep(1)
+
+def start_invalidation_listener():
+    # Keeps the auth cache and key snapshots of this process in sync with every other one.
+    thread = threading.Thread(target=_invalidation_loop, name="invalidation-listener", daemon=True)
+    thread.start()
+    return thread
 
 # --- Admin Management ---
 def list_admins():
@@ -80,7 +347,15 @@ def is_admin(telegram_id):
     res = supabase.table("users").select("id").eq("telegram_id", telegram_id).eq("is_admin", True).execute()
     return bool(res.data)
 
-# TODO: Add functions for key management, user management, usage logging 
+# --- Usage Logging ---
+def insert_usage_logs(rows):
+    return supabase.table("usage_logs").insert(rows).execute()
+
+def increment_project_usage(updates):
+    # updates: [{"project_id", "tokens", "last_used_at"}]; summed server-side in one statement.
+    return supabase.rpc("increment_project_usage", {"updates": updates}).execute()
+
+# TODO: Add functions for key management, user management
 
 def create_bot(name, token, base_prompt=None):
     from datetime import datetime
@@ -94,6 +369,8 @@ def create_bot(name, token, base_prompt=None):
         "created_at": now
     }).execute()
     api_key_id = api_key_row.data[0]["id"] if hasattr(api_key_row, 'data') and api_key_row.data else None
+    publish_auth_invalidation([api_key])
+    refresh_snapshot("user_keys")
     # Create the bot
     res = supabase.table("bots").insert({
         "name": name,
@@ -103,8 +380,13 @@ def create_bot(name, token, base_prompt=None):
         "api_key_id": api_key_id,
         "created_at": now
     }).execute()
+    refresh_snapshot("bots")
     return res, api_key
 
+def list_bot_configs():
+    # Everything the bot host needs to run the bots, tokens included.
+    return _snapshot("bots")
+
 def list_bots():
     res = supabase.table("bots").select("id, name, status, created_at, base_prompt").execute()
     return res.data if hasattr(res, 'data') else []
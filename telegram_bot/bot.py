@@ -5,11 +5,13 @@ import subprocess
 import tempfile
 import requests
 import base64
+import html
 
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import BadRequest
 from telegram.ext import (
     ApplicationBuilder, CommandHandler, ContextTypes, CallbackQueryHandler, MessageHandler, filters
 )
@@ -17,12 +19,20 @@ from supabase_client import (
     list_keys, add_key, remove_key,
     create_user_api_key, list_user_api_keys, revoke_user_api_key,
     list_admins, add_admin, remove_admin, is_admin,
-    create_bot, list_bots
+    create_bot, list_bots, get_redis
 )
+from backend.circuit_breaker import breaker_states, describe, scopes
 
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 SUPERADMIN_TELEGRAM_ID = os.getenv("ADMIN_TELEGRAM_ID")
 
+def circuit_states(keys):
+    # Shared breaker state for these keys and their regions; empty if Redis is unreachable.
+    try:
+        return breaker_states(get_redis(), keys)
+    except Exception:
+        return {}
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE, use_edit=False):
     user_id = str(update.effective_user.id)
     if not (is_admin(user_id) or user_id == str(SUPERADMIN_TELEGRAM_ID)):
@@ -67,6 +77,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             [InlineKeyboardButton("Add Gemini API Key", callback_data="add_gemini_key")],
             [InlineKeyboardButton("Remove Gemini API Key", callback_data="remove_gemini_key")],
             [InlineKeyboardButton("List Gemini API Keys", callback_data="list_gemini_keys")],
+            [InlineKeyboardButton("Circuit Breakers", callback_data="circuit_breakers")],
             [InlineKeyboardButton("⬅️ Back", callback_data="main_menu")],
         ]
         await query.edit_message_text("Gemini API Key Management:", reply_markup=InlineKeyboardMarkup(keyboard))
@@ -186,8 +197,10 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if not keys:
             await query.edit_message_text("No Gemini API keys found.")
             return
+        states = circuit_states(keys)
         msg = "Gemini API Keys:\n" + "\n".join([
-            f"{k['name']} ({k['region']}, {k.get('model_name', '?')}) - {'Active' if k['active'] else 'Inactive'}" for k in keys
+            f"{k['name']} ({k['region']}, {k.get('model_name', '?')}) - {'Active' if k['active'] else 'Inactive'}"
+            + (f", circuit {describe(states[scopes(k)[0]])}" if scopes(k)[0] in states else "") for k in keys
         ])
         keyboard = []
         for k in keys:
@@ -196,6 +209,27 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             keyboard.append([InlineKeyboardButton(label, callback_data="noop"), revoke_btn])
         keyboard.append([InlineKeyboardButton("⬅️ Back", callback_data="menu_gemini")])
         await query.edit_message_text(msg, reply_markup=InlineKeyboardMarkup(keyboard))
+    elif query.data == "circuit_breakers":
+        keys = [k for k in list_keys() if k['active']]
+        states = circuit_states(keys)
+        if not states:
+            msg = "No active Gemini keys, or breaker state is unavailable."
+        else:
+            regions = sorted({k['region'] for k in keys})
+            msg = "<b>Circuit Breakers</b>\nRegions:\n" + "\n".join(
+                f"{html.escape(r)} - {describe(states[f'region:{r}'])}" for r in regions
+            ) + "\nKeys:\n" + "\n".join(
+                f"{html.escape(k['name'])} ({html.escape(k['region'])}) - {describe(states[scopes(k)[0]])}" for k in keys
+            )
+        keyboard = [
+            [InlineKeyboardButton("Reload", callback_data="circuit_breakers")],
+            [InlineKeyboardButton("⬅️ Back", callback_data="menu_gemini")],
+        ]
+        try:
+            await query.edit_message_text(msg, parse_mode='HTML', reply_markup=InlineKeyboardMarkup(keyboard))
+        except BadRequest as e:
+            if "message is not modified" not in str(e).lower():
+                raise  # anything but a Reload with nothing changed
     elif query.data.startswith("confirm_del_gemini_"):
         key_id = query.data[len("confirm_del_gemini_"):]
         # Find key info for display
@@ -275,7 +309,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await query.edit_message_text("Restarting all services...")
         with tempfile.NamedTemporaryFile(delete=False, mode="w+b", suffix=".txt") as logf:
             try:
-                for svc in ["ggpt-backend", "ggpt-telegram-bot", "ggpt-rq-worker"]:
+                for svc in ["ggpt-backend", "ggpt-telegram-bot", "ggpt-rq-worker", "ggpt-batch-worker", "ggpt-bot-host@*"]:
                     proc = subprocess.run(["sudo", "systemctl", "restart", svc], stdout=logf, stderr=logf)
                 logf.flush()
                 await query.edit_message_text("✅ All services restarted. Sending log...")
@@ -308,7 +342,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     os.unlink(logf.name)
                     return
                 proc = subprocess.run([".venv/bin/pip", "install", "-r", "requirements.txt"], stdout=logf, stderr=logf)
-                for svc in ["ggpt-backend", "ggpt-telegram-bot", "ggpt-rq-worker"]:
+                for svc in ["ggpt-backend", "ggpt-telegram-bot", "ggpt-rq-worker", "ggpt-batch-worker", "ggpt-bot-host@*"]:
                     proc = subprocess.run(["sudo", "systemctl", "restart", svc], stdout=logf, stderr=logf)
                 logf.flush()
                 await query.edit_message_text("✅ Update complete. All services restarted. Sending log...")
@@ -336,7 +370,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 proc = subprocess.run(["git", "reset", "--hard", "HEAD"], stdout=logf, stderr=logf)
                 proc = subprocess.run(["git", "pull", "origin", "main"], stdout=logf, stderr=logf)
                 proc = subprocess.run([".venv/bin/pip", "install", "-r", "requirements.txt"], stdout=logf, stderr=logf)
-                for svc in ["ggpt-backend", "ggpt-telegram-bot", "ggpt-rq-worker"]:
+                for svc in ["ggpt-backend", "ggpt-telegram-bot", "ggpt-rq-worker", "ggpt-batch-worker", "ggpt-bot-host@*"]:
                     proc = subprocess.run(["sudo", "systemctl", "restart", svc], stdout=logf, stderr=logf)
                 logf.flush()
                 await query.edit_message_text("✅ Force update complete. All services restarted. Sending log...")
@@ -529,7 +563,7 @@ async def text_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 # Get the new bot's id
                 bot_id = res.data[0]['id'] if hasattr(res, 'data') and res.data else None
                 await update.message.reply_text(f"Bot '{bot_creation['name']}' registered.\nAPI Key: {api_key}\nDeploying bot...")
-                # Deploy the bot as a systemd service
+                # Hand the bot to the bot host
                 if bot_id:
                     try:
                         subprocess.run([
@@ -1,29 +1,33 @@
 #!/bin/bash
 
-TEMPLATE="bots/template_bot.py"
-BOTS_DIR="bots"
-RESTARTED_BOTS=()
+# Child bots now run inside the ggpt-bot-host@ services. Remove the per-bot units and
+# folders left by older deployments, then restart the hosts so they load the latest code.
+REMOVED_BOTS=()
 
-for botfile in "$BOTS_DIR"/*.py; do
-    if [[ "$botfile" != "$TEMPLATE" ]]; then
-        cp "$TEMPLATE" "$botfile"
-    fi
-done
-
-echo "All bots updated with the latest template."
-
-# Restart all child bot systemd services
-echo "Restarting all ggpt-bot-* services..."
 sudo systemctl daemon-reload
 for svc in /etc/systemd/system/ggpt-bot-*.service; do
+    [ -e "$svc" ] || continue
     svcname=$(basename "$svc")
-    sudo systemctl restart "$svcname"
-    echo "Restarted $svcname"
-    RESTARTED_BOTS+=("$svcname")
+    if [[ "$svcname" == ggpt-bot-host@* ]]; then
+        continue
+    fi
+    sudo systemctl disable --now "$svcname"
+    sudo rm -f "$svc"
+    REMOVED_BOTS+=("$svcname")
+done
+for botdir in bots/*/; do
+    [ -f "$botdir/bot.py" ] && rm -rf "$botdir"
 done
+sudo systemctl daemon-reload
+
+echo "Restarting ggpt-bot-host@* services..."
+sudo systemctl restart 'ggpt-bot-host@*'
 
 echo ""
-echo "All child bot services restarted:"
-for name in "${RESTARTED_BOTS[@]}"; do
-    echo " - $name"
-done 
\ No newline at end of file
+echo "Bot host restarted."
+if [ ${#REMOVED_BOTS[@]} -gt 0 ]; then
+    echo "Removed legacy per-bot services:"
+    for name in "${REMOVED_BOTS[@]}"; do
+        echo " - $name"
+    done
+fi